@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+
+import argparse
+import contextlib
+import json
+import logging as _logging_
+import math
+import os
+import os.path
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import filechanges as fc
+
+#
+# constants
+#
+DEFAULT_NUM_FILES = 2000
+DEFAULT_REPEAT = 5
+DEFAULT_DEPTH = 3
+DEFAULT_FANOUT = 4
+DEFAULT_MIN_SIZE = 0
+DEFAULT_MAX_SIZE = 256 * 1024
+DEFAULT_CHURN_PCT = 5.0
+DEFAULT_SEED = 42
+DEFAULT_STARTUP_FILES = 10
+DEFAULT_TOP_IMPORTS = 10
+
+# synthetic trees look like they have not been touched for a day, so that
+# unchanged directory listings can be reused from the first warm pass
+SETTLED_AGE_SECS = 24 * 60 * 60
+
+
+def maketree(root: str, num_files: int) -> None:
+    """Creates num_files small files spread over a few directories"""
+    for i in range(num_files):
+        subdir = os.path.join(root, f"d{i % 20:02}")
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, f"f{i:06}.txt"), "wb") as f:
+            f.write(b"x" * (i % 512))
+
+
+def drawsize(rng: random.Random, args) -> int:
+    """Draws a file size from the configured distribution"""
+    if args.size_dist == "fixed":
+        return args.max_size
+    if args.size_dist == "uniform":
+        return rng.randint(args.min_size, args.max_size)
+    # loguniform: many small files and a few big ones, like real trees
+    lo = math.log(args.min_size + 1)
+    hi = math.log(args.max_size + 1)
+    return int(math.exp(rng.uniform(lo, hi))) - 1
+
+
+def writefile(rng: random.Random, path: str, size: int) -> None:
+    with open(path, "wb") as f:
+        f.write(rng.randbytes(size))
+
+
+def settle(root: str) -> None:
+    """Backdates the mtimes of all directories under root"""
+    past = time.time() - SETTLED_AGE_SECS
+    for subdir, dirs, files in os.walk(root):
+        os.utime(subdir, (past, past))
+
+
+def gentree(root: str, args) -> list:
+    """Creates a reproducible synthetic tree, returns the file paths
+
+    The tree has args.depth levels of args.fanout subdirectories each, and
+    args.files files spread over all of its directories, with sizes drawn
+    from args.size_dist. The same seed always gives the same tree.
+    """
+    rng = random.Random(args.seed)
+
+    dirs = [root]
+    level = [root]
+    for depth in range(args.depth):
+        level = [os.path.join(d, f"d{j}") for d in level for j in range(args.fanout)]
+        dirs.extend(level)
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+
+    paths = list()
+    for i in range(args.files):
+        path = os.path.join(rng.choice(dirs), f"f{i:07}.dat")
+        writefile(rng, path, drawsize(rng, args))
+        paths.append(path)
+
+    settle(root)
+    return paths
+
+
+def churntree(paths: list, args) -> list:
+    """Changes args.churn percent of the files, returns the new file paths
+
+    Nine in ten churned files are rewritten in place; the tenth is deleted
+    and a new file is created next to it.
+    """
+    rng = random.Random(args.seed + 1)
+
+    paths = list(paths)
+    count = round(len(paths) * args.churn / 100)
+    for n, i in enumerate(rng.sample(range(len(paths)), count)):
+        if n % 10 == 9:
+            os.remove(paths[i])
+            paths[i] = os.path.join(os.path.dirname(paths[i]), f"n{i:07}.dat")
+        writefile(rng, paths[i], drawsize(rng, args))
+
+    return paths
+
+
+def readprocio() -> dict:
+    """Returns this process's I/O counters, empty where /proc is missing"""
+    try:
+        with open("/proc/self/io", "rt") as f:
+            return {k: int(v) for k, v in (line.split(":") for line in f)}
+    except OSError:
+        return {}
+
+
+class CountedEntry:
+    """A DirEntry whose stat calls are counted"""
+
+    __slots__ = ("entry", "calls")
+
+    def __init__(self, entry: os.DirEntry, calls: dict):
+        self.entry = entry
+        self.calls = calls
+
+    def __getattr__(self, name: str):
+        return getattr(self.entry, name)
+
+    def stat(self, *, follow_symlinks: bool = True) -> os.stat_result:
+        self.calls["stat"] += 1
+        return self.entry.stat(follow_symlinks=follow_symlinks)
+
+
+class CountedScandir:
+    """A scandir iterator yielding CountedEntry objects"""
+
+    def __init__(self, it, calls: dict):
+        self.it = it
+        self.calls = calls
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.it.close()
+
+    def __iter__(self):
+        return (CountedEntry(entry, self.calls) for entry in self.it)
+
+    def close(self) -> None:
+        self.it.close()
+
+
+@contextlib.contextmanager
+def countcalls():
+    """Counts the stat and scandir calls made in the with block into a dict
+
+    os.stat, os.lstat and os.scandir are wrapped while the block runs, and
+    so is the stat method of every directory entry listed. The wrappers add
+    well under a microsecond per call to the measured times.
+    """
+    calls = {"stat": 0, "scandir": 0}
+    saved = os.stat, os.lstat, os.scandir
+
+    def counted(func):
+        def wrapper(*args, **kwargs):
+            calls["stat"] += 1
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    def scandir(*args, **kwargs):
+        calls["scandir"] += 1
+        return CountedScandir(saved[2](*args, **kwargs), calls)
+
+    os.stat, os.lstat, os.scandir = counted(saved[0]), counted(saved[1]), scandir
+    try:
+        yield calls
+    finally:
+        os.stat, os.lstat, os.scandir = saved
+
+
+def measure(tracker: fc.Tracker, phase: str) -> dict:
+    """Runs one pass and returns its throughput and resource figures
+
+    The read and write calls are those counted by the kernel in /proc, the
+    stat and scandir calls those made through the os module.
+    """
+    statements = [0]
+
+    def count(stmt):
+        statements[0] += 1
+
+    conn = fc.connectdb(tracker.state)
+    conn.set_trace_callback(count)
+    io_before = readprocio()
+    with countcalls() as calls:
+        elapsed = timed(lambda: fc.runfilechanges(tracker.state))
+    io_after = readprocio()
+    conn.set_trace_callback(None)
+
+    def delta(key):
+        if key in io_before and key in io_after:
+            return io_after[key] - io_before[key]
+        return None
+
+    checked = tracker.counters["checked"]
+    hashed_bytes = tracker.counters["bytes"]
+    return {
+        "phase": phase,
+        "seconds": elapsed,
+        "files": checked,
+        "files_per_sec": checked / elapsed,
+        "bytes_hashed": hashed_bytes,
+        "bytes_per_sec": hashed_bytes / elapsed,
+        "read_calls": delta("syscr"),
+        "write_calls": delta("syscw"),
+        "stat_calls": calls["stat"],
+        "scandir_calls": calls["scandir"],
+        "db_statements": statements[0],
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def benchtree(args) -> None:
+    """Cold, warm and after-churn passes over a synthetic tree"""
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        tree = os.path.join(workdir, "tree")
+        paths = gentree(tree, args)
+        tracker = opendb(
+            workdir,
+            [tree],
+            workers=args.workers,
+            algorithm=args.algorithm,
+            paranoid=args.paranoid,
+        )
+
+        results = [measure(tracker, "cold"), measure(tracker, "warm")]
+        churntree(paths, args)
+        results.append(measure(tracker, "churn"))
+        results.append(measure(tracker, "warm"))
+
+        tracker.close()
+
+    print(
+        f"{'phase':<6} {'seconds':>9} {'files/s':>10} {'MB/s':>8} "
+        f"{'reads':>8} {'writes':>8} {'stats':>8} {'scandirs':>8} "
+        f"{'db stmts':>9} {'peak RSS':>10}"
+    )
+    for r in results:
+        print(
+            f"{r['phase']:<6} {r['seconds']:9.3f} {r['files_per_sec']:10.0f} "
+            f"{r['bytes_per_sec'] / 1e6:8.1f} {r['read_calls'] or 0:8} "
+            f"{r['write_calls'] or 0:8} {r['stat_calls']:8} "
+            f"{r['scandir_calls']:8} {r['db_statements']:9} "
+            f"{r['peak_rss_kb']:8}kB"
+        )
+
+    if args.json is not None:
+        with open(args.json, "at") as f:
+            for r in results:
+                print(json.dumps(r), file=f)
+
+
+def opendb(workdir: str, folders: list, **options) -> fc.Tracker:
+    """Returns a tracker of a fresh config and DB in workdir"""
+    cfg_file_name = os.path.join(workdir, "bench.ini")
+    with open(cfg_file_name, "wt") as cfg:
+        for fld in folders:
+            print(fld, file=cfg)
+
+    return fc.Tracker(cfg_file_name, **options)
+
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def benchlogging(args) -> None:
+    """Per-file cost of a warm pass with logging off and on"""
+    with tempfile.TemporaryDirectory() as workdir:
+        tree = os.path.join(workdir, "tree")
+        maketree(tree, args.files)
+        tracker = opendb(workdir, [tree])
+
+        def run():
+            fc.runfilechanges(tracker.state)
+
+        run()
+
+        # the records are still formatted and emitted, just not shown
+        with open(os.devnull, "wt") as devnull:
+            for handler in _logging_.getLogger().handlers:
+                handler.setStream(devnull)
+
+            for label, level in (("off", _logging_.INFO), ("on", _logging_.DEBUG)):
+                fc.logger.setLevel(level)
+                best = min(timed(run) for _ in range(args.repeat))
+                per_file = best / max(tracker.counters["checked"], 1)
+                print(f"logging {label:3} : {per_file * 1e6:10.2f} us/file")
+
+        fc.logger.setLevel(_logging_.INFO)
+        tracker.close()
+
+
+def importtimes() -> list:
+    """Returns the (cumulative us, module) import times of filechanges, slowest first"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import filechanges"],
+        cwd=os.path.dirname(os.path.abspath(fc.__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = list()
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                times.append((int(cumulative), name.strip()))
+    return sorted(times, reverse=True)
+
+
+def timerun(argv: list, workdir: str) -> float:
+    """Runs a command in workdir, with filechanges importable, returns the wall time"""
+    env = dict(os.environ)
+    srcdir = os.path.dirname(os.path.abspath(fc.__file__))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (srcdir, env.get("PYTHONPATH"))))
+    start = time.perf_counter()
+    subprocess.run(argv, cwd=workdir, env=env, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def benchstartup(args) -> None:
+    """Import time, and wall time of whole runs over a single small folder
+
+    The script run as "python filechanges.py" is compiled on every run,
+    while "python -m filechanges" runs it from its cached bytecode.
+    """
+    best = min(
+        (importtimes() for _ in range(args.repeat)),
+        key=lambda times: times[0][0],
+    )
+    print(f"import filechanges       : {best[0][0] / 1000:8.1f} ms")
+    for us, name in best[1 : args.top + 1]:
+        print(f"    {us / 1000:8.1f} ms  {name}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        tree = os.path.join(workdir, "tree")
+        maketree(tree, args.files)
+        with open(os.path.join(workdir, "filechanges.ini"), "wt") as cfg:
+            print(tree, file=cfg)
+
+        script = [sys.executable, os.path.abspath(fc.__file__)]
+        print(f"first run                : {timerun(script, workdir) * 1000:8.1f} ms")
+        for label, argv in (
+            ("python -c pass", [sys.executable, "-c", "pass"]),
+            ("python filechanges.py", script),
+            ("python -m filechanges", [sys.executable, "-m", "filechanges"]),
+        ):
+            secs = min(timerun(argv, workdir) for _ in range(args.repeat))
+            print(f"{label:<25}: {secs * 1000:8.1f} ms")
+
+
+def main(argv: list) -> None:
+    parser = argparse.ArgumentParser(
+        description="""Benchmarks for the file change tracker."""
+    )
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("tree", help="cold/warm/churn passes over a synthetic tree")
+    p.add_argument("-n", "--files", type=int, default=DEFAULT_NUM_FILES)
+    p.add_argument("--depth", type=int, default=DEFAULT_DEPTH)
+    p.add_argument("--fanout", type=int, default=DEFAULT_FANOUT)
+    p.add_argument("--min-size", type=int, default=DEFAULT_MIN_SIZE)
+    p.add_argument("--max-size", type=int, default=DEFAULT_MAX_SIZE)
+    p.add_argument(
+        "--size-dist", choices=["fixed", "uniform", "loguniform"], default="loguniform"
+    )
+    p.add_argument(
+        "--churn",
+        type=float,
+        default=DEFAULT_CHURN_PCT,
+        help="percentage of files changed between the warm and churn passes",
+    )
+    p.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    p.add_argument("-w", "--workers", type=int, default=1)
+    p.add_argument(
+        "-a", "--algorithm", choices=sorted(fc.HASH_ALGORITHMS), default="md5"
+    )
+    p.add_argument("-p", "--paranoid", action="store_true")
+    p.add_argument("--dir", help="where to create the tree, default is $TMPDIR")
+    p.add_argument("--json", help="append the results as JSON lines to this file")
+    p.set_defaults(func=benchtree)
+
+    p = sub.add_parser("logging", help="per-file logging overhead, off vs. on")
+    p.add_argument("-n", "--files", type=int, default=DEFAULT_NUM_FILES)
+    p.add_argument("-r", "--repeat", type=int, default=DEFAULT_REPEAT)
+    p.set_defaults(func=benchlogging)
+
+    p = sub.add_parser(
+        "startup", help="import time and whole runs over one small folder"
+    )
+    p.add_argument("-n", "--files", type=int, default=DEFAULT_STARTUP_FILES)
+    p.add_argument("-r", "--repeat", type=int, default=DEFAULT_REPEAT)
+    p.add_argument(
+        "--top",
+        type=int,
+        default=DEFAULT_TOP_IMPORTS,
+        help="how many of the slowest imports to list",
+    )
+    p.set_defaults(func=benchstartup)
+
+    args = parser.parse_args(argv[1:])
+    _logging_.basicConfig(format=fc.LOG_FORMAT, level=_logging_.INFO)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
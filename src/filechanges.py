@@ -1,84 +1,701 @@
 #!/usr/bin/env python
 
-import argparse
+# only what a plain scan needs is imported here, since the program is
+# often run for a single small folder and its startup time then dominates;
+# argparse, asyncio, csv, ctypes, datetime, fnmatch, json, pprint, queue
+# and multiprocessing are imported where they are used
+import bisect
+import collections
+import contextlib
+import functools
 import hashlib
-import inspect
+import heapq
+import itertools
 import logging as _logging_
 import os
 import os.path
-import pprint
 import re
+import select
 import sys
 import sqlite3
+import stat
+import struct
+import threading
 import time
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    Executor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 #
 # constants
 #
+SCHEMA_VERSION = 3
+LOG_FORMAT = "%(asctime)s %(levelname)s : %(funcName)s[%(lineno)d]: %(message)s"
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_FOLDER_WORKERS = 4
+DEFAULT_PER_MOUNT = 1
+DEFAULT_HASH_ALGORITHM = "md5"
+HASH_BUFFER_SIZE = 1024 * 1024
+MAX_INFLIGHT_PER_WORKER = 4
+DEFAULT_RECONCILE_SECS = 600
+WATCH_DEBOUNCE_SECS = 0.5
+DIR_MTIME_SETTLE_NS = 2 * 1000 * 1000 * 1000
+SLOWEST_FILES = 10
+PARTIAL_HASH_BLOCK = 64 * 1024
+SAMPLE_BLOCKS = 16
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENTED = "-seg"
+DEFAULT_VERIFY_DAYS = 7
+DEFAULT_JOURNAL_DAYS = 30
+DEFAULT_JOURNAL_ROWS = 1000 * 1000
+DEFAULT_CHANGE_QUEUE_SIZE = 1000
+SCHEDULE_MIN_SECS = 1
+THROTTLE_BURST_SECS = 1.0
+
+# snapshot files: the magic, one record per file sorted by directory and
+# name, the names of the algorithms the records refer to, and a footer
+SNAPSHOT_MAGIC = b"FCSNAP01"
+SNAPSHOT_RECORD = struct.Struct("<HHBBqqq")
+SNAPSHOT_FOOTER = struct.Struct("<dQQI8s")
+SNAPSHOT_SAME_DIR = 0xFFFF
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+# ioprio_set(2) is not wrapped by the os module
+IOPRIO_SYSCALLS = {"x86_64": 251, "aarch64": 30, "i686": 289, "armv7l": 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+STOP_POLL_SECS = 0.5
+
+# algorithms that can be selected with -a/--algorithm; md5 is the default
+# because it is what every row written by older versions contains
+HASH_ALGORITHMS = {
+    "md5": hashlib.md5,
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+}
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh64"] = xxhash.xxh64
 
 #
 # global data
 #
-conn = None
-
-global cfg_file_name, db_file_name, table_name, flds, exts, counters
-cfg_file_name = None
-db_file_name = None
+global table_name, dir_table_name, dir_names_table_name, journal_table_name, scans_table_name
 table_name = "status"
-flds = None
-exts = None
-counters = { }
+dir_table_name = "dirs"
+dir_names_table_name = "dirnames"
+roots_table_name = "roots"
+progress_table_name = "progress"
+schedule_table_name = "schedule"
+journal_table_name = "journal"
+scans_table_name = "scans"
+
+# the id of a directory path, for the commands that refer to one by path
+DIR_ID_QUERY = f"SELECT id FROM {dir_names_table_name} WHERE path = ?"
+
+
+class State:
+    """The configuration, connection, caches and counters of one tracker
+
+    Everything a pass works on lives here rather than in module globals,
+    and is passed to the functions that need it as their first argument, so
+    several trackers can be used in one process. The attributes set from
+    the command line or as Tracker options are listed in OPTIONS.
+    """
+
+    OPTIONS = (
+        "workers",
+        "processes",
+        "folder_workers",
+        "per_mount",
+        "batch_size",
+        "paranoid",
+        "followlinks",
+        "large_size",
+        "verify_days",
+        "max_interval",
+        "budget_files",
+        "budget_bytes",
+        "bytes_throttle",
+        "files_throttle",
+        "drop_cache",
+        "noatime",
+        "algorithm",
+        "journal_days",
+        "journal_rows",
+    )
+
+    def __init__(self, cfg_file_name: str = None, db_file_name: str = None):
+        self.cfg_file_name = cfg_file_name
+        self.db_file_name = db_file_name
+
+        # options
+        self.workers = 1
+        self.processes = False
+        self.folder_workers = DEFAULT_FOLDER_WORKERS
+        self.per_mount = DEFAULT_PER_MOUNT
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.paranoid = False
+        self.followlinks = False
+        self.large_size = None
+        self.verify_days = DEFAULT_VERIFY_DAYS
+        self.max_interval = None
+        self.budget_files = None
+        self.budget_bytes = None
+        self.bytes_throttle = None
+        self.files_throttle = None
+        self.drop_cache = False
+        self.noatime = False
+        self.algorithm = DEFAULT_HASH_ALGORITHM
+        self.journal_days = DEFAULT_JOURNAL_DAYS
+        self.journal_rows = DEFAULT_JOURNAL_ROWS
+
+        # the shared connection, its queued writes and the hashing pool
+        self.conn = None
+        self.dblock = threading.RLock()
+        self.pending = {}
+        self.pending_fnames = set()
+        self.pending_dirs = set()
+        self.executor = None
+
+        # the configuration and what is cached between passes
+        self.flds = None
+        self.rules = None
+        self.cfg_stamp = None
+        self.indexes = {}
+        self.dirrows = {}
+        self.schedule = None
+        self.data_version = None
+
+        # the pass in progress
+        self.scan_id = None
+        self.onchange = None
+        self.stopping = None
+        self.counterslock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.metrics = None
+
+
+# the state of a process of a hashing pool, see initworker
+workerstate = None
+
+# the buffer each thread reads the files it hashes into, see readbuffer
+buffers = threading.local()
 
 #
-# do some basic initial setup
+# the handlers are only set up by main, so importing this module leaves
+# the logging configuration of the importer alone, and its records go
+# through a logger of its own, which the importer can tune separately
 #
-_logging_.basicConfig(
-    format="%(asctime)s %(levelname)s : %(message)s",
-    level=_logging_.DEBUG if os.getenv("DEBUG", "N") == "Y" else _logging_.INFO,
-)
+logger = _logging_.getLogger(__name__)
+
+
+#
+# the shared SQLite connection may be used by several folder scans at once
+#
+def dbsynchronized(func):
+    """Serializes calls that use the shared SQLite connection of their state"""
+
+    @functools.wraps(func)
+    def wrapper(state, *args, **kwargs):
+        with state.dblock:
+            return func(state, *args, **kwargs)
+
+    return wrapper
+
 
 #
 # basic logging helpers
 #
-def trace(msg: str) -> None:
-    f = inspect.currentframe()
-    _logging_.debug(f"TRACE : {f.f_back.f_code.co_name}[{f.f_back.f_lineno}]: {msg}")
+# The caller's name and line number come from the log format, so the stack
+# is only looked at for records that are actually emitted. Any args are
+# %-formatted lazily, and trace/debug return straight away unless DEBUG is
+# on, so code on the per-file path passes its values as args rather than
+# building f-strings. The logger caches whether DEBUG is on until its level
+# is changed, so asking it every time is cheap.
+#
+def trace(msg: str, *args) -> None:
+    if logger.isEnabledFor(_logging_.DEBUG):
+        logger.debug("TRACE : " + msg, *args, stacklevel=2)
 
 
-def debug(msg: str) -> None:
-    f = inspect.currentframe()
-    _logging_.debug(f"{f.f_back.f_code.co_name}[{f.f_back.f_lineno}]: {msg}")
+def debug(msg: str, *args) -> None:
+    if logger.isEnabledFor(_logging_.DEBUG):
+        logger.debug(msg, *args, stacklevel=2)
 
 
-def info(msg: str) -> None:
-    # f = inspect.currentframe()
-    # _logging_.info(msg)
-    f = inspect.currentframe()
-    _logging_.info(f"{f.f_back.f_code.co_name}[{f.f_back.f_lineno}]: {msg}")
+def info(msg: str, *args) -> None:
+    logger.info(msg, *args, stacklevel=2)
 
 
-def error(msg: str) -> None:
-    f = inspect.currentframe()
-    _logging_.error(f"{f.f_back.f_code.co_name}[{f.f_back.f_lineno}]: {msg}")
+def error(msg: str, *args) -> None:
+    logger.error(msg, *args, stacklevel=2)
 
 
-def fatal(msg: str) -> None:
-    f = inspect.currentframe()
-    _logging_.error(f"{f.f_back.f_code.co_name}[{f.f_back.f_lineno}]: {msg}")
+def fatal(msg: str, *args) -> None:
+    logger.error(msg, *args, stacklevel=2)
     exit(1)
 
 
-def trim_to_none(inp_value: str) -> str:
-    trace(f"{inp_value=}")
+#
+# per-phase instrumentation
+#
+class Metrics:
+    """Per-phase timings and per-file hash latencies of a pass
+
+    Every folder checked collects its own Metrics, which are merged into the
+    one of the pass at the end of the folder, like the counters.
+    """
+
+    PHASES = ("walk", "stat", "lookup", "hash", "write")
+    BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
+        self.hashes = 0
+        self.slowest = []
+
+    def addhash(self, path: str, secs: float) -> None:
+        self.seconds["hash"] += secs
+        self.hashes += 1
+        self.buckets[bisect.bisect_left(self.BUCKETS, secs)] += 1
+        self.addslow(secs, path)
+
+    def addslow(self, secs: float, path: str) -> None:
+        # a min-heap of the SLOWEST_FILES slowest hashes seen so far
+        if len(self.slowest) < SLOWEST_FILES:
+            heapq.heappush(self.slowest, (secs, path))
+        elif secs > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (secs, path))
+
+    def merge(self, other) -> None:
+        for phase, secs in other.seconds.items():
+            self.seconds[phase] += secs
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.hashes += other.hashes
+        for secs, path in other.slowest:
+            self.addslow(secs, path)
+
+    def tojson(self, counters: dict) -> str:
+        """Returns the metrics of the pass as a single line of JSON"""
+        import json
+
+        bounds = [str(b) for b in self.BUCKETS] + ["+Inf"]
+        return json.dumps(
+            {
+                "time": time.time(),
+                "counters": counters,
+                "phase_seconds": self.seconds,
+                "hash_seconds_buckets": dict(zip(bounds, self.buckets)),
+                "slowest": [
+                    [path, secs] for secs, path in sorted(self.slowest, reverse=True)
+                ],
+            }
+        )
+
+    def toprometheus(self, counters: dict) -> str:
+        """Returns the metrics of the pass in the Prometheus text format"""
+        lines = [
+            "# HELP filechanges_files Files in the last pass, by outcome",
+            "# TYPE filechanges_files gauge",
+        ]
+        for k, v in counters.items():
+            if k != "bytes":
+                lines.append(f'filechanges_files{{outcome="{k}"}} {v}')
+        lines += [
+            "# HELP filechanges_bytes_hashed Bytes hashed in the last pass",
+            "# TYPE filechanges_bytes_hashed gauge",
+            f"filechanges_bytes_hashed {counters.get('bytes', 0)}",
+            "# HELP filechanges_phase_seconds Cumulative seconds spent per phase in the last pass",
+            "# TYPE filechanges_phase_seconds gauge",
+        ]
+        for phase, secs in self.seconds.items():
+            lines.append(f'filechanges_phase_seconds{{phase="{phase}"}} {secs:.6f}')
+        lines += [
+            "# HELP filechanges_hash_seconds Time taken to hash a file in the last pass",
+            "# TYPE filechanges_hash_seconds histogram",
+        ]
+        total = 0
+        for bound, n in zip(list(self.BUCKETS) + ["+Inf"], self.buckets):
+            total += n
+            lines.append(f'filechanges_hash_seconds_bucket{{le="{bound}"}} {total}')
+        lines += [
+            f"filechanges_hash_seconds_sum {self.seconds['hash']:.6f}",
+            f"filechanges_hash_seconds_count {self.hashes}",
+            "# HELP filechanges_last_pass_timestamp_seconds When the last pass finished",
+            "# TYPE filechanges_last_pass_timestamp_seconds gauge",
+            f"filechanges_last_pass_timestamp_seconds {time.time():.3f}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class Throttle:
+    """Limits the rate of something, e.g. bytes read, across threads
+
+    Each caller reserves the time its amount takes at the given rate, and
+    sleeps until it is reached. Up to THROTTLE_BURST_SECS of unused time is
+    carried over, so short pauses are made up for.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def take(self, amount: int, stopping: threading.Event = None) -> None:
+        """Waits until amount is due, or until stopping is set if given"""
+        with self.lock:
+            now = time.monotonic()
+            self.next = max(self.next, now - THROTTLE_BURST_SECS) + amount / self.rate
+            delay = self.next - now
+        if delay > 0:
+            if stopping is not None:
+                stopping.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+class Report:
+    """Streams one row per added, modified or deleted file to a spreadsheet
+
+    A path ending in .xlsx is written with openpyxl in write-only mode,
+    anything else as CSV. Either way rows go straight to the file rather
+    than being kept in memory, so a report can grow to millions of rows.
+    openpyxl is only imported when an .xlsx report is asked for.
+    """
+
+    HEADER = ("Scan", "Time", "Change", "File", "Old digest", "New digest")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.rows = 0
+        if path.lower().endswith(".xlsx"):
+            try:
+                import openpyxl
+            except ImportError:
+                fatal(f'the openpyxl package is needed to write report "{path}"')
+            self.workbook = openpyxl.Workbook(write_only=True)
+            self.sheet = self.workbook.create_sheet("Changes")
+            self.sheet.append(self.HEADER)
+            self.file = None
+        else:
+            import csv
+
+            self.workbook = None
+            self.file = open(path, "wt", newline="")
+            self.sheet = csv.writer(self.file)
+            self.sheet.writerow(self.HEADER)
+
+    def append(self, change: tuple) -> None:
+        """Adds the row of a Change"""
+        import datetime
+
+        when = None
+        if change.time is not None:
+            when = datetime.datetime.fromtimestamp(change.time)
+            if self.workbook is None:
+                when = when.isoformat(timespec="seconds")
+        row = (change.scan, when, change.kind, change.fname, change.old, change.new)
+        with self.lock:
+            if self.workbook is not None:
+                self.sheet.append(row)
+            else:
+                self.sheet.writerow(row)
+            self.rows += 1
+
+    def close(self) -> None:
+        """Finishes the report, which an .xlsx one is only written out on"""
+        debug(f'writing {self.rows} rows to report "{self.path}"')
+        if self.workbook is not None:
+            self.workbook.save(self.path)
+            self.workbook.close()
+        else:
+            self.file.close()
+
+
+#
+# event-driven change detection for -W/--watch
+#
+class Inotify:
+    """Minimal ctypes wrapper around the Linux inotify API"""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = (
+        IN_MODIFY
+        | IN_ATTRIB
+        | IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_ONLYDIR
+    )
+
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = dict()
+
+    def addwatch(self, path: str) -> None:
+        """Watches a directory, silently ignoring ones that have gone"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            import ctypes
+
+            errno = ctypes.get_errno()
+            debug('cannot watch "%s": %s', path, os.strerror(errno))
+        else:
+            self.paths[wd] = path
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def read(self, timeout: float) -> list:
+        """Returns the (path, mask) events available within the timeout"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+
+        events = list()
+        buf = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos < len(buf):
+            wd, mask, _, size = self.EVENT_HEADER.unpack_from(buf, pos)
+            pos += self.EVENT_HEADER.size
+            name = os.fsdecode(buf[pos : pos + size].rstrip(b"\0"))
+            pos += size
+
+            if mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif wd in self.paths:
+                path = self.paths[wd]
+                events.append((os.path.join(path, name) if name else path, mask))
+
+        return events
+
+
+@contextlib.contextmanager
+def openfile(state: State, fname: str):
+    """Opens a file to be hashed, keeping it from crowding the page cache
+
+    The kernel is told the file is read sequentially, its access time is
+    left alone when noatime is set, and its pages are dropped from the page
+    cache once it is closed when drop_cache is set.
+    """
+    flags = os.O_RDONLY | getattr(os, "O_CLOEXEC", 0)
+    fd = None
+    if state.noatime and hasattr(os, "O_NOATIME"):
+        try:
+            fd = os.open(fname, flags | os.O_NOATIME)
+        except PermissionError:
+            # only allowed to the owner of the file
+            pass
+    if fd is None:
+        fd = os.open(fname, flags)
+
+    with open(fd, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        try:
+            yield f
+        finally:
+            if state.drop_cache and hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def setidle() -> None:
+    """Lowers the CPU and I/O priority of the process to idle, where possible
+
+    Must be called before any thread is started, as both priorities are per
+    thread on Linux and only inherited by threads started afterwards.
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except (AttributeError, OSError) as ex:
+        debug("failed to set the idle CPU scheduling policy: %s", ex)
+        os.nice(19)
+
+    nr = IOPRIO_SYSCALLS.get(os.uname().machine)
+    if nr is None:
+        debug("no ioprio_set syscall known for %s", os.uname().machine)
+        return
+    import ctypes
+    import ctypes.util
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if (
+        libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+        < 0
+    ):
+        debug(
+            "failed to set the idle I/O priority: %s", os.strerror(ctypes.get_errno())
+        )
+
+
+def openentries(path: str):
+    """Yields the Entry of every file in a snapshot or a DB file, in snapshot order"""
+    with open(path, "rb") as f:
+        magic = f.read(len(SQLITE_MAGIC))
+
+    if magic.startswith(SNAPSHOT_MAGIC):
+        yield from readsnapshot(path)
+    elif magic == SQLITE_MAGIC:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            # a DB is read as it is, without migrating it to the current schema
+            have = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+            if "fname" in have:
+                yield from legacyentries(conn, have)
+            elif "dir" in have:
+                yield from dbentries(conn)
+            else:
+                raise ValueError(f'"{path}" holds no table of recorded files')
+        finally:
+            conn.close()
+    else:
+        raise ValueError(f'"{path}" is neither a snapshot nor a database')
+
+
+def openinotify() -> Inotify:
+    """Returns an Inotify instance, or None where inotify is not available"""
+    trace("enter")
+
+    try:
+        return Inotify()
+    except (AttributeError, OSError, TypeError) as ex:
+        debug(f"inotify is not available: {ex}")
+
+    return None
+
 
-    out_value = None
-    if inp_value is not None:
-        inp_value = inp_value.strip()
-        if len(inp_value) > 0:
-            out_value = inp_value
+def watchdirs(state: State, notifier: Inotify, folder: str) -> None:
+    """Adds a watch for every directory under a folder, the folder included
 
-    trace(f"{out_value=}")
-    return out_value
+    Pruned directories are neither watched nor descended.
+    """
+    for subdir, dirs, files in os.walk(folder, followlinks=state.followlinks):
+        notifier.addwatch(subdir)
+        dirs[:] = [
+            d for d in dirs if not excluded(os.path.join(subdir, d), state.rules, True)
+        ]
+
+
+def watchfilechanges(
+    state: State, notifier: Inotify, reconcile: int, rescan, ws: object = None
+) -> None:
+    """Checks only the files inotify reports as touched, until interrupted
+
+    Events are coalesced per path and a path is only checked once it has
+    been quiet for WATCH_DEBOUNCE_SECS, so files written in bursts are
+    hashed once. rescan is called every reconcile seconds, and whenever
+    events were lost, to run a full pass as a safety net. The changes
+    found are appended to ws, if given, as in checkfilechanges.
+    """
+    trace(f"enter: {reconcile=}")
+
+    def rewatch() -> None:
+        rescan()
+        for fld in dedupfolders(state.flds):
+            watchdirs(state, notifier, os.path.realpath(fld))
+
+    rewatch()
+    next_reconcile = time.monotonic() + reconcile
+    pending = dict()
+
+    while not stopped(state):
+        now = time.monotonic()
+        deadline = min([next_reconcile] + list(pending.values()))
+        timeout = max(0, deadline - now)
+        if state.stopping is not None:
+            timeout = min(timeout, STOP_POLL_SECS)
+        for path, mask in notifier.read(timeout):
+            if path is None:
+                info("inotify events were lost, a full scan will be run")
+                next_reconcile = 0
+            elif not mask & Inotify.IN_ISDIR:
+                pending[path] = time.monotonic() + WATCH_DEBOUNCE_SECS
+            elif mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                if excluded(path, state.rules, True):
+                    continue
+                # a new directory may already have files in it
+                watchdirs(state, notifier, path)
+                scratch = dict.fromkeys(state.counters, 0)
+                for origin, st in walkfiles(
+                    path, state.rules, scratch, state.followlinks
+                ):
+                    pending[origin] = time.monotonic() + WATCH_DEBOUNCE_SECS
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                prefix, index = loadindex(state, path)
+                for origin in index:
+                    pending[origin] = time.monotonic() + WATCH_DEBOUNCE_SECS
+
+        now = time.monotonic()
+        if now >= next_reconcile:
+            pending.clear()
+            info("running a full reconciliation scan")
+            rewatch()
+            next_reconcile = time.monotonic() + reconcile
+            continue
+
+        # folders added to the config file are scanned and watched, and
+        # files outside the remaining ones are skipped from then on
+        if loadflds(state):
+            pending.clear()
+            info("the configuration changed, a full scan will be run")
+            rewatch()
+            next_reconcile = time.monotonic() + reconcile
+            continue
+
+        due = sorted(path for path, when in pending.items() if when <= now)
+        if len(due) == 0:
+            continue
+
+        counts = dict.fromkeys(state.counters, 0)
+        beginscan(state)
+        for path in due:
+            del pending[path]
+            kind = checkfile(state, path, state.rules, counts, ws)
+            # library callers get the change through onchange instead
+            if kind is not None and state.onchange is None:
+                print(f"{kind:<8} {path}")
+        endscan(state)
+        flushdb(state)
+
+        debug("checked %d touched files: counts=%r", len(due), counts)
 
 
 #
@@ -88,102 +705,364 @@ def trim_to_none(inp_value: str) -> str:
 #
 
 
-def checkfilechanges(folder: str, excludes: list, ws: object) -> bool:
-    """Checks for files changes"""
-    trace(f"enter: {folder=}, {excludes=}")
+@contextlib.asynccontextmanager
+async def aclosing(agen):
+    """Closes an async generator when the with block is left, as contextlib.aclosing does from Python 3.10"""
+    try:
+        yield agen
+    finally:
+        await agen.aclose()
+
+
+def algorithmfor(state: State, st: os.stat_result) -> str:
+    """Returns the algorithm recorded for a file, segmented for large ones"""
+    if state.large_size is not None and st.st_size >= state.large_size:
+        return state.algorithm + SEGMENTED
+    return state.algorithm
+
+
+def beginscan(state: State) -> int:
+    """Records the start of a scan, returns the id its journal entries get"""
+    trace("enter")
+
+    # lastrowid rather than RETURNING, which needs SQLite 3.35
+    cmd = f"INSERT INTO {scans_table_name} (started) VALUES (?)"
+    try:
+        with state.dblock:
+            state.scan_id = connectdb(state).execute(cmd, (time.time(),)).lastrowid
+    except sqlite3.Error as err:
+        fatal(f'Failed to record a new scan in table "{scans_table_name}": {err}')
+
+    debug(f"returning {state.scan_id=}")
+    return state.scan_id
+
+
+@dbsynchronized
+def cacherow(state: State, fname: str, row: tuple) -> None:
+    """Keeps the index of the folder holding a file in step with a write to it
+
+    A row of None removes the file from the index.
+    """
+    path = os.path.dirname(fname)
+    while True:
+        cached = state.indexes.get(path)
+        if cached is not None:
+            if row is not None:
+                cached[1][fname] = row
+            else:
+                cached[1].pop(fname, None)
+            return
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
+
+
+def checkfilechanges(state: State, folder: str, rules: dict, ws: object) -> bool:
+    """Checks for files changes
 
-    global counters
+    Every file added, modified or deleted is appended as a Change to ws,
+    e.g. a Report, unless it is None.
+    """
+    trace("enter: folder=%r", folder)
+
+    # counted locally and merged at the end, since several folders may be
+    # checked at the same time
+    counts = dict.fromkeys(state.counters, 0)
+    m = Metrics()
 
     changed = False
     debug("=" * 100)
     debug(f'checking dir "{folder}"')
-    counters["folders"] += 1
-
-    for subdir, dirs, files in os.walk(folder):
-        for fname in files:
-            counters["checked"] += 1
-
-            origin = os.path.realpath(os.path.join(subdir, fname))
-            debug("-" * 100)
-            debug(f'checking file "{origin}"')
-            if not os.path.isfile(origin):
-                debug(f'skipping non-file "{origin}"')
-                counters["skipped"] += 1
-            else:
-                # Get file extension and check if it is not excluded
-                ext = getfileext(origin)
-                debug(f'file extension is "{ext}"')
-
-                if len(ext) == 0:
-                    debug(f'will process file "{origin}"')
-                elif ext not in excludes:
-                    debug(f'will process file "{origin}" with extension "{ext}"')
-                else:
-                    debug(f'skipping file "{origin}" with excluded extension "{ext}"')
-                    counters["skipped"] += 1
-                    continue
+    counts["folders"] += 1
+
+    # every row already recorded under this folder, loaded with one query;
+    # whatever is not seen during the walk has been deleted since
+    start = time.perf_counter()
+    prefix, index = getindex(state, folder)
+    seen = set()
+
+    # directories whose listing has not changed are not listed again
+    dirindex = (
+        None
+        if state.paranoid or state.followlinks
+        else loaddirindex(state, folder, index, rules)
+    )
+    dirstats = dict()
+    m.seconds["lookup"] += time.perf_counter() - start
+
+    executor = getexecutor(state)
+    inflight = dict()
+    complete = True
+
+    for origin, st in walkfiles(
+        folder, rules, counts, state.followlinks, dirindex, dirstats, m
+    ):
+        if stopped(state):
+            debug('stopping the check of dir "%s" early', folder)
+            complete = False
+            break
+
+        debug('checking file "%s"', origin)
+        pace(state, nfiles=1)
+
+        # symlinks can resolve to the same file more than once
+        if origin in seen:
+            debug('skipping already checked file "%s"', origin)
+            counts["skipped"] += 1
+            continue
+        seen.add(origin)
+
+        # check to see if the file already exists in the table - we do
+        # this by looking up its name in the preloaded index, falling
+        # back to the DB for symlinks resolving outside the folder
 
-                # check to see if the file already exists in the table - we do
-                # this by computing the MD5 and looking it up in the index
-
-                hits = list()
-                file_in_table = is_file_in_table(origin, hits=hits)
-                debug(f"QQRXQ {origin=} {file_in_table=}")
-                debug(f"QQRXQ     {hits=}")
-                debug(f"QQRXQ     {type(hits)=}")
-                if len(hits) > 0:
-                    if len(hits[0]) == 2:
-                        debug(f"QQRXQ      {hits[0][0]=}")
-                        debug(f"QQRXQ      {hits[0][1]=}")
-                        md5_val_from_db = hits[0][1]
-                # debug(f"QQRXQ     {hits[0]=}")
-                # debug(f"QQRXQ     {type(hits[0])=}")
-
-                cur_md5_val = md5short(origin)
-                debug(f"QQRXQ {origin=} {cur_md5_val=}")
-
-                if not file_in_table:
-                    r = inserthashtable(origin, cur_md5_val)
-                    debug(
-                        f"QQRXQ {origin=} {cur_md5_val=} inserthashtable returned {r=}"
-                    )
-                    changed = True
-                    counters["changed"] += 1
-                elif cur_md5_val == md5_val_from_db:
-                    debug(
-                        f"QQRXQ UP-TO-DATE: {origin=} {cur_md5_val=} {md5_val_from_db=}"
-                    )
-                    counters["unchanged"] += 1
-                else:
-                    debug(
-                        f"QQRXQ NEED-TO-UPDATE: {origin=} {cur_md5_val=} {md5_val_from_db=}"
-                    )
-                    r = updatehashtable(origin, cur_md5_val)
-                    debug(
-                        f"QQRXQ {origin=} {cur_md5_val=} updatehashtable returned {r=}"
-                    )
+        hits = list()
+        if origin.startswith(prefix):
+            row = index.get(origin)
+            file_in_table = row is not None
+            if file_in_table:
+                hits.append(row)
+        else:
+            start = time.perf_counter()
+            file_in_table = is_file_in_table(state, origin, hits=hits)
+            m.seconds["lookup"] += time.perf_counter() - start
+        debug("origin=%r file_in_table=%r hits=%r", origin, file_in_table, hits)
+        if file_in_table:
+            if (
+                not state.paranoid
+                and statmatches(hits[0], st)
+                and not verifydue(state, hits[0], st)
+            ):
+                debug("STAT-UNCHANGED: origin=%r", origin)
+                counts["unchanged"] += 1
+                continue
+
+        row = hits[0] if file_in_table else None
+        if state.large_size is not None and st.st_size >= state.large_size:
+            # large files are hashed here, a segment at a time, so that a
+            # stopped scan can save its progress and resume later
+            try:
+                digests, sample, verified, secs = hashlargejob(state, origin, st, row)
+            except OSError as ex:
+                debug('skipping unhashed large file "%s": %s', origin, ex)
+                counts["skipped"] += 1
+                continue
+            m.addhash(origin, secs)
+            if recordhash(
+                state, origin, st, row, digests, counts, sample, verified, ws
+            ):
+                changed = True
+            continue
+
+        algorithms = hashalgorithms(state, row)
+        if executor is None:
+            try:
+                digests, secs = hashjob(state, origin, algorithms)
+            except OSError as ex:
+                debug('skipping unreadable file "%s": %s', origin, ex)
+                counts["skipped"] += 1
+                continue
+            m.addhash(origin, secs)
+            if recordhash(state, origin, st, row, digests, counts, ws=ws):
+                changed = True
+        else:
+            # hashing happens in the pool, but results are always
+            # written to the DB from this thread; a process has a state of
+            # its own, see initworker
+            if state.processes:
+                future = executor.submit(workerjob, origin, algorithms)
+            else:
+                future = executor.submit(hashjob, state, origin, algorithms)
+            inflight[future] = (origin, st, row)
+            if len(inflight) >= MAX_INFLIGHT_PER_WORKER * state.workers:
+                if drainhashes(state, inflight, FIRST_COMPLETED, counts, m, ws):
                     changed = True
-                    counters["changed"] += 1
+
+    if drainhashes(state, inflight, ALL_COMPLETED, counts, m, ws):
+        changed = True
+
+    # after a partial walk, files not seen may just not have been reached,
+    # so only the files hashed so far are recorded
+    if complete:
+        # the index may be updated by other folders reaching a file in
+        # this one through a symlink
+        with state.dblock:
+            gone = index.keys() - seen
+        for origin in gone:
+            # rows for files that still exist but are now skipped are kept
+            if os.path.lexists(origin):
+                continue
+            journalchange(state, "deleted", origin, index[origin][1], None, ws)
+            r = deletehashtable(state, origin)
+            debug("DELETED: origin=%r, deletehashtable returned r=%r", origin, r)
+            changed = True
+            counts["deleted"] += 1
+
+        start = time.perf_counter()
+        updatedirtable(state, folder, index, dirstats)
+        if scheduling(state):
+            reschedule(state, folder, changed, counts)
+        m.seconds["write"] += time.perf_counter() - start
+
+    with state.counterslock:
+        for k, v in counts.items():
+            state.counters[k] += v
+        state.metrics.merge(m)
+
     debug("=" * 100)
     debug(f"returning {changed=}")
     return changed
 
 
-def connectdb() -> sqlite3.Connection:
-    assert db_file_name is not None
+def checkfile(
+    state: State, origin: str, rules: dict, counts: dict, ws: object = None
+) -> str:
+    """Checks one file, returns "added", "modified", "deleted" or None"""
+    trace("enter: origin=%r", origin)
+
+    counts["checked"] += 1
+    pace(state, nfiles=1)
+    origin = os.path.realpath(origin)
+
+    if excluded(origin, rules):
+        debug('skipping excluded file "%s"', origin)
+        counts["skipped"] += 1
+        return None
+
+    hits = list()
+    row = hits[0] if is_file_in_table(state, origin, hits=hits) else None
+
+    try:
+        st = os.stat(origin)
+    except FileNotFoundError:
+        if row is None:
+            counts["skipped"] += 1
+            return None
+        deletehashtable(state, origin)
+        journalchange(state, "deleted", origin, row[1], None, ws)
+        counts["deleted"] += 1
+        return "deleted"
+    except OSError as ex:
+        debug('skipping unreadable file "%s": %s', origin, ex)
+        counts["skipped"] += 1
+        return None
+
+    if not stat.S_ISREG(st.st_mode):
+        debug('skipping non-file "%s"', origin)
+        counts["skipped"] += 1
+        return None
+
+    if (
+        row is not None
+        and not state.paranoid
+        and statmatches(row, st)
+        and not verifydue(state, row, st)
+    ):
+        counts["unchanged"] += 1
+        return None
+
+    sample = verified = None
+    try:
+        if state.large_size is not None and st.st_size >= state.large_size:
+            digests, sample, verified, secs = hashlargejob(state, origin, st, row)
+        else:
+            digests, secs = hashjob(state, origin, hashalgorithms(state, row))
+    except OSError as ex:
+        debug('skipping unreadable file "%s": %s', origin, ex)
+        counts["skipped"] += 1
+        return None
+
+    if not recordhash(state, origin, st, row, digests, counts, sample, verified, ws):
+        return None
+
+    return "added" if row is None else "modified"
+
+
+def closeexecutor(state: State) -> None:
+    """Shuts down the shared hashing pool, if one was started"""
+    trace("enter")
+
+    if state.executor is not None:
+        state.executor.shutdown()
+        state.executor = None
+
+
+@dbsynchronized
+def closedb(state: State) -> None:
+    """Flushes any queued writes and closes the shared connection"""
+    trace("enter")
+
+    if state.conn is not None:
+        flushdb(state)
+        state.conn.close()
+        state.conn = None
+        # the data version of a new connection tells nothing
+        state.data_version = None
+
+
+@dbsynchronized
+def compactjournal(state: State) -> None:
+    """Drops the journal entries of scans beyond the retention limits
 
-    debug(f'calling _connectdb to connect to dbfilename "{db_file_name}"')
-    conn = _connectdb(db_file_name)
+    Entries are dropped a whole scan at a time, oldest first, once they are
+    more than journal_days old or once the journal holds more than
+    journal_rows entries. A limit of 0 disables it.
+    """
+    trace(f"enter: {state.journal_days=}, {state.journal_rows=}")
+
+    conn = connectdb(state)
+    cutoff = 0
+    if state.journal_days > 0:
+        row = conn.execute(
+            f"SELECT id FROM {scans_table_name} WHERE started >= ? ORDER BY id LIMIT 1",
+            (time.time() - state.journal_days * 24 * 60 * 60,),
+        ).fetchone()
+        if row is not None:
+            cutoff = row[0]
+    if state.journal_rows > 0:
+        row = conn.execute(
+            f"SELECT scan FROM {journal_table_name} WHERE id > (SELECT max(id) FROM {journal_table_name}) - ? ORDER BY id LIMIT 1",
+            (state.journal_rows,),
+        ).fetchone()
+        if row is not None:
+            cutoff = max(cutoff, row[0])
+
+    oldest = conn.execute(f"SELECT min(id) FROM {scans_table_name}").fetchone()[0]
+    if oldest is None or cutoff <= oldest:
+        return
+
+    # the scans go first, so a failure part way through can only make the
+    # journal look more compacted than it is
+    debug(f"dropping scans before {cutoff=}")
+    runcmd(state, f"DELETE FROM {scans_table_name} WHERE id < ?", (cutoff,))
+    runcmd(state, f"DELETE FROM {journal_table_name} WHERE scan < ?", (cutoff,))
+
+
+@dbsynchronized
+def connectdb(state: State) -> sqlite3.Connection:
+    """Returns the shared connection, opening it on first use"""
+    assert state.db_file_name is not None
+
+    if state.conn is None:
+        debug(f'calling _connectdb to connect to dbfilename "{state.db_file_name}"')
+        state.conn = _connectdb(state.db_file_name)
+        debug(
+            f'_connectdb for dbfilename "{state.db_file_name}" returned {state.conn=}'
+        )
 
-    debug(f'_connectdb for dbfilename "{db_file_name}" returned {conn=}')
-    return conn
+    return state.conn
 
 
-# @lru_cache
 def _connectdb(dbfilename: str) -> sqlite3.Connection:
     debug(f'connecting to dbfilename "{dbfilename}"')
     try:
-        conn = sqlite3.connect(dbfilename, timeout=2)
+        # transactions are managed explicitly with BEGIN/END
+        conn = sqlite3.connect(
+            dbfilename, timeout=2, isolation_level=None, check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
         debug(f"success: {conn=}")
         return conn
 
@@ -194,69 +1073,174 @@ def _connectdb(dbfilename: str) -> sqlite3.Connection:
 def corecursor(
     conn: sqlite3.Connection, query: str, args: list = None, hits: list = None
 ) -> bool:
-    """Perform a query on the database table."""
+    """Perform a query on the database table.
 
-    trace(f'query = "{query}"')
+    The caller holds the lock of the state the connection belongs to.
+    """
+
+    trace('query = "%s"', query)
 
     result = None
     cursor = conn.cursor()
     try:
         if args is None:
-            debug("invoking cursor.execute() without args")
             r = cursor.execute(query)
-            debug(f"cursor.execute() returned {r}")
         else:
-            debug("invoking cursor.execute() with {args=}")
             r = cursor.execute(query, args)
-            debug(f"cursor.execute() returned {r}")
+        debug("cursor.execute() with args=%r returned %r", args, r)
         rows = cursor.fetchall()
-        numrows = len(list(rows))
-        debug(f"{numrows=}")
-        debug(f"before {len(hits) if hits is not None else 0}")
+        numrows = len(rows)
+        debug("numrows=%d", numrows)
         if numrows == 0:
             result = False
         else:
             result = True
             if hits is not None:
                 for row in rows:
-                    debug(f"  {row=}")
                     hits.append(list(row))
-        debug(f"after  {len(hits) if hits is not None else 0}")
     except sqlite3.OperationalError as err:
         error(str(err))  # fatal, maybe?
     finally:
         cursor.close()
 
-    debug(f"returning {result}")
+    debug("returning %r", result)
     return result
 
 
-def createhashtable() -> None:
-    """Creates the named table if it does not exist"""
+def createhashtable(state: State) -> None:
+    """Creates the named table if it does not exist
+
+    Each file is keyed by the id of its directory, interned in a separate
+    table, and its base name, and its digest is stored as a BLOB. Large
+    files also have a sampled fingerprint and the time of their last full
+    hash.
+    """
+    trace(f"enter")
+    for name, cmd in (
+        (
+            dir_names_table_name,
+            f"CREATE TABLE {dir_names_table_name} (id integer primary key, path text not null)",
+        ),
+        (
+            table_name,
+            f"CREATE TABLE {table_name} (dir integer not null, name text not null, digest blob, moddate integer, size integer, mtime_ns integer, inode integer, algorithm text, sample blob, verified integer, primary key (dir, name)) WITHOUT ROWID",
+        ),
+    ):
+        debug(f"command = {cmd}")
+
+        result = runcmd(state, cmd)
+        debug(f"runcmd returned {result}")
+        if not result:
+            fatal(f'Failed to create table "{name}"')
+
+        debug(f'created table "{name}"')
+
+
+def createcontentidx(state: State) -> None:
+    """Creates the optional index used to find files sharing the same content"""
+    trace(f"enter")
+    index_name = f"idx_{table_name}_content"
+    cmd = f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} (size, digest)"
+    debug(f"command = {cmd}")
+
+    result = runcmd(state, cmd)
+    debug(f"runcmd returned {result}")
+    if not result:
+        fatal(f'Failed to create index "{index_name}" on table "{table_name}"')
+
+
+def createdirtable(state: State) -> None:
+    """Creates the directory tables if they do not exist
+
+    Besides the directories themselves, the rules each folder was last
+    walked with are recorded, since listings recorded under other rules
+    cannot be reused.
+    """
+    trace(f"enter")
+    for name, cmd in (
+        (
+            dir_table_name,
+            f"CREATE TABLE IF NOT EXISTS {dir_table_name} (path text primary key, parent text, mtime_ns integer, entries integer, hash text)",
+        ),
+        (
+            roots_table_name,
+            f"CREATE TABLE IF NOT EXISTS {roots_table_name} (path text primary key, rules text)",
+        ),
+    ):
+        debug(f"command = {cmd}")
+
+        result = runcmd(state, cmd)
+        debug(f"runcmd returned {result}")
+        if not result:
+            fatal(f'Failed to create table "{name}"')
+
+
+def createjournaltable(state: State) -> None:
+    """Creates the scan and change journal tables if they do not exist
+
+    The journal is append-only: every added, modified and deleted file is
+    recorded with the id of the scan that saw it, in the same transaction
+    as the change to the main table.
+    """
+    trace(f"enter")
+    for name, cmd in (
+        (
+            scans_table_name,
+            f"CREATE TABLE IF NOT EXISTS {scans_table_name} (id integer primary key autoincrement, started real not null, finished real)",
+        ),
+        (
+            journal_table_name,
+            f"CREATE TABLE IF NOT EXISTS {journal_table_name} (id integer primary key, scan integer not null, time real not null, kind text not null, dir integer not null, name text not null, old_digest blob, new_digest blob)",
+        ),
+        (
+            journal_table_name,
+            f"CREATE INDEX IF NOT EXISTS idx_{journal_table_name}_scan ON {journal_table_name} (scan)",
+        ),
+    ):
+        debug(f"command = {cmd}")
+
+        result = runcmd(state, cmd)
+        debug(f"runcmd returned {result}")
+        if not result:
+            fatal(f'Failed to create table "{name}"')
+
+
+def createprogresstable(state: State) -> None:
+    """Creates the table holding the progress of interrupted large file hashes"""
     trace(f"enter")
-    cmd = f"CREATE TABLE {table_name} (id integer primary key, fname text, md5 text, moddate integer)"
+    cmd = f"CREATE TABLE IF NOT EXISTS {progress_table_name} (dir integer not null, name text not null, size integer, mtime_ns integer, inode integer, algorithm text, offset integer, digests blob, primary key (dir, name)) WITHOUT ROWID"
     debug(f"command = {cmd}")
 
-    result = runcmd(cmd)
+    result = runcmd(state, cmd)
     debug(f"runcmd returned {result}")
     if not result:
-        fatal(f'Failed to create table "{table_name}"')
+        fatal(f'Failed to create table "{progress_table_name}"')
+
+
+def createscheduletable(state: State) -> None:
+    """Creates the table holding when each folder was last checked and is next due"""
+    trace(f"enter")
+    cmd = f"CREATE TABLE IF NOT EXISTS {schedule_table_name} (path text primary key, checked real, interval real, files integer, bytes integer) WITHOUT ROWID"
+    debug(f"command = {cmd}")
 
-    debug(f'created table "{table_name}"')
+    result = runcmd(state, cmd)
+    debug(f"runcmd returned {result}")
+    if not result:
+        fatal(f'Failed to create table "{schedule_table_name}"')
 
 
-def createhashtableidx() -> None:
+def createhashtableidx(state: State) -> None:
     """Creates the SQLite DB Table Indices"""
     trace(f"enter")
 
-    def create_index(column_name):
-        trace(f"enter: {column_name=}")
+    def create_index(table_name, column_name):
+        trace(f"enter: {table_name=}, {column_name=}")
 
         index_name = f"idx_{table_name}_{column_name}"
         cmd = f"CREATE UNIQUE INDEX {index_name} ON {table_name} ({column_name})"
         debug(f"command = {cmd}")
 
-        result = runcmd(cmd)
+        result = runcmd(state, cmd)
         debug(f"runcmd returned {result}")
         if not result:
             fatal(
@@ -267,246 +1251,2146 @@ def createhashtableidx() -> None:
             f'created index "{index_name}" on column "{column_name}" of table "{table_name}"'
         )
 
-    create_index("fname")
-    # create_index("md5")
+    # the status table's primary key is its only index
+    create_index(dir_names_table_name, "path")
 
 
-def getbasefile() -> str:
-    """Returns the name of the SQLite DB file"""
-    trace("enter")
-    return os.path.splitext(os.path.basename(__file__))[0]
+def deletehashtable(state: State, fname: str) -> bool:
+    """Delete from the SQLite File Table"""
+
+    cmd = f"DELETE FROM {table_name} WHERE dir = ({DIR_ID_QUERY}) AND name = ?"
+    args = (os.path.dirname(fname), os.path.basename(fname))
+
+    debug("queueing SQL DELETE command for fname=%r", fname)
+    cacherow(state, fname, None)
+    return queuecmd(state, cmd, args, fname)
+
+
+Entry = collections.namedtuple("Entry", "dir name digest size mtime_ns inode algorithm")
 
 
-def getfileext(fname: str) -> str:
-    """Get the file name extension.
+def dbentries(conn: sqlite3.Connection):
+    """Yields the Entry of every file recorded in a DB, sorted by directory and name
 
-    Extension does NOT include the dot. Dotfiles like ".bashrc" are handled as
-    expected, with the filename = ".bashrc" and the extension as "".
+    The directories are walked in the order of their path index and the
+    files of each in the order of the primary key, so no sort is needed and
+    the rows are streamed however many there are.
     """
-    trace(f"enter: fname = {fname}")
-    return os.path.splitext(os.path.basename(fname))[1]
+    query = (
+        f"SELECT d.path, s.name, s.digest, s.size, s.mtime_ns, s.inode, s.algorithm"
+        f" FROM {dir_names_table_name} d JOIN {table_name} s ON s.dir = d.id ORDER BY d.path, s.name"
+    )
+    for dirpath, name, digest, size, mtime_ns, inode, alg in conn.execute(query):
+        yield Entry(
+            dirpath,
+            name,
+            digest.hex() if digest is not None else None,
+            size,
+            mtime_ns,
+            inode,
+            alg,
+        )
 
 
-def getmoddate(fname: str) -> int:
-    """Get file modified date"""
-    try:
-        debug(f"{fname=}")
-        mtime = os.path.getmtime(fname)
-        debug(f"{type(mtime)=}, {mtime=}")
-        return mtime
-    except FileNotFoundError as ex:
-        debug(f'no such file: "{fname}"')
+def dedupfolders(folders: list) -> list:
+    """Drops folders that resolve to, or lie inside, another folder"""
+    trace(f"enter: {folders=}")
 
-    except Exception as ex:
-        error(f'caught exception of type {type(ex)}: "{ex}", program abending')
-        exit(1)
+    roots = list()
+    for real, fld in sorted(
+        (os.path.join(os.path.realpath(fld), ""), fld) for fld in folders
+    ):
+        # sorting by real path keeps every folder right after its ancestors
+        if len(roots) > 0 and real.startswith(roots[-1][0]):
+            debug(f'skipping "{fld}", it is already covered by "{roots[-1][1]}"')
+            continue
+        roots.append((real, fld))
 
-    return None
+    return [fld for real, fld in roots]
 
 
-def inserthashtable(fname: str, md5: str) -> bool:
-    """Insert into the SQLite File Table"""
+def diffentries(old, new):
+    """Yields a Change for every file that differs between two streams of Entry
 
-    cmd = f"INSERT INTO {table_name} (fname, md5, moddate) VALUES (?, ?, ?)"
-    args = (fname, md5, int(getmoddate(fname)))
+    Both streams must be sorted by directory and name, as dbentries and
+    readsnapshot yield them, so they are merge-joined in one pass holding
+    one entry of each. The changes have no scan or time. Files recorded
+    with different algorithms on each side are only compared by size.
+    """
 
-    debug(f"QQRXQ running SQL INSERT command for {md5=} {fname=}")
-    hits = list()
-    result = runcmd(cmd, args, hits=hits)
-    debug(f"QQRXQ runcmd INSERT returned {result=}, {hits=}")
+    def checked(entries, what):
+        last = None
+        for entry in entries:
+            key = (entry.dir, entry.name)
+            if last is not None and key <= last:
+                raise ValueError(
+                    f"the {what} files are not sorted at {os.path.join(*key)}"
+                )
+            last = key
+            yield entry
+
+    old, new = checked(old, "old"), checked(new, "new")
+    o, n = next(old, None), next(new, None)
+    while o is not None or n is not None:
+        if n is None or (o is not None and (o.dir, o.name) < (n.dir, n.name)):
+            yield Change(
+                None, None, "deleted", os.path.join(o.dir, o.name), o.digest, None
+            )
+            o = next(old, None)
+        elif o is None or (n.dir, n.name) < (o.dir, o.name):
+            yield Change(
+                None, None, "added", os.path.join(n.dir, n.name), None, n.digest
+            )
+            n = next(new, None)
+        else:
+            if (o.algorithm or "md5") == (n.algorithm or "md5"):
+                modified = o.digest != n.digest
+            else:
+                modified = o.size != n.size
+            if modified:
+                yield Change(
+                    None,
+                    None,
+                    "modified",
+                    os.path.join(n.dir, n.name),
+                    o.digest,
+                    n.digest,
+                )
+            o, n = next(old, None), next(new, None)
+
+
+def drainhashes(
+    state: State,
+    inflight: dict,
+    return_when: str,
+    counts: dict,
+    m: Metrics,
+    ws: object = None,
+) -> bool:
+    """Records the results of completed hash jobs, returns True if any file changed"""
 
-    return result
+    changed = False
 
+    if len(inflight) == 0:
+        return changed
+
+    done, _ = wait(inflight, return_when=return_when)
+    for future in done:
+        origin, st, row = inflight.pop(future)
+        try:
+            digests, secs = future.result()
+        except OSError as ex:
+            debug('skipping unreadable file "%s": %s', origin, ex)
+            counts["skipped"] += 1
+            continue
+        m.addhash(origin, secs)
+        if recordhash(state, origin, st, row, digests, counts, ws=ws):
+            changed = True
 
-def is_file_in_table(fname: str, hits: list = None) -> bool:
-    """Checks if md5 hash tag exists in the SQLite DB"""
+    return changed
 
-    conn = connectdb()
 
-    result = False
+def endscan(state: State) -> None:
+    """Queues the end time of the current scan with its other writes"""
+    cmd = f"UPDATE {scans_table_name} SET finished = ? WHERE id = ?"
+    queuecmd(state, cmd, (time.time(), state.scan_id), None)
+
+
+def exportsnapshot(fname: str, entries) -> int:
+    """Writes a stream of Entry, sorted as dbentries yields them, to a snapshot file
+
+    Each record holds the size, mtime_ns and inode, the lengths of the
+    directory, name and digest and the index of the algorithm, followed by
+    the directory, unless it is the same as the previous record's, the name
+    and the raw digest. The file is written under a temporary name and only
+    replaces fname once complete. Returns the number of records.
+    """
+    trace(f"enter: {fname=}")
+
+    algorithms = dict()
+    count = 0
+    last = None
+    tmp_name = f"{fname}.tmp"
+    with open(tmp_name, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        for entry in entries:
+            name = os.fsencode(entry.name)
+            digest = bytes.fromhex(entry.digest) if entry.digest is not None else b""
+            alg = algorithms.setdefault(entry.algorithm or "", len(algorithms))
+            dirpath = b"" if entry.dir == last else os.fsencode(entry.dir)
+            f.write(
+                SNAPSHOT_RECORD.pack(
+                    SNAPSHOT_SAME_DIR if entry.dir == last else len(dirpath),
+                    len(name),
+                    alg,
+                    len(digest),
+                    entry.size if entry.size is not None else -1,
+                    entry.mtime_ns if entry.mtime_ns is not None else -1,
+                    entry.inode if entry.inode is not None else -1,
+                )
+            )
+            f.write(dirpath)
+            f.write(name)
+            f.write(digest)
+            last = entry.dir
+            count += 1
+
+        trailer = f.tell()
+        for alg in algorithms:
+            encoded = alg.encode()
+            f.write(bytes((len(encoded),)) + encoded)
+        f.write(
+            SNAPSHOT_FOOTER.pack(
+                time.time(), count, trailer, len(algorithms), SNAPSHOT_MAGIC
+            )
+        )
+
+    os.replace(tmp_name, fname)
+    debug(f"returning {count=}")
+    return count
+
+
+def excluded(path: str, rules: dict, isdir: bool = False) -> bool:
+    """Checks if a path is excluded by the rules of the folder it lies in
+
+    Unlike walkfiles, which never descends pruned directories, every
+    directory between the folder and the path is checked as well.
+    """
+    base, ruleset = findrules(path, rules)
+    if base is None:
+        # not under any configured folder (any more)
+        return True
+
+    parts = os.path.relpath(path, base).split(os.sep)
+    reldir = ""
+    for name in parts[:-1]:
+        if ruleset.skipdir(reldir, name):
+            return True
+        reldir = f"{reldir}/{name}" if reldir else name
+
+    if isdir:
+        return ruleset.skipdir(reldir, parts[-1])
+    return ruleset.skipfile(reldir, parts[-1])
+
+
+def findduplicates(state: State) -> list:
+    """Finds the groups of recorded files sharing the same content
+
+    The rows are streamed in a single pass over the content index, so files
+    only need to be looked at when another file has the same size. A
+    stored digest is trusted when the file's stat still matches its row,
+    a large file was hashed in full since it was last modified, and all
+    files of that size were hashed with the same algorithm; otherwise candidates are first narrowed down with hashpartial and only
+    files sharing a partial hash are hashed in full.
+
+    Returns a list of (size, hex digest, algorithm, [fname, ...]) tuples,
+    largest first.
+    """
+    trace(f"enter")
+
+    flushdb(state)
+    createcontentidx(state)
+
+    query = (
+        f"SELECT d.path, s.name, s.digest, s.size, s.mtime_ns, s.inode, s.algorithm, s.sample, s.verified FROM {table_name} s"
+        f" INDEXED BY idx_{table_name}_content JOIN {dir_names_table_name} d ON s.dir = d.id"
+        f" WHERE s.size > 0 ORDER BY s.size, s.digest"
+    )
+    debug(f"{query=}")
+
+    def rows():
+        # only one size group is held in memory, and the connection is only
+        # locked while the next batch of rows is fetched
+        with state.dblock:
+            cursor = connectdb(state).execute(query)
+        try:
+            while True:
+                with state.dblock:
+                    batch = cursor.fetchmany(state.batch_size)
+                if len(batch) == 0:
+                    break
+                for row in batch:
+                    yield rowtuple(*row)
+        finally:
+            with state.dblock:
+                cursor.close()
+
+    groups = list()
+    for size, same_size in itertools.groupby(rows(), key=lambda row: row[2]):
+        same_size = list(same_size)
+        if len(same_size) < 2:
+            continue
+
+        stale = set()
+        for row in same_size:
+            try:
+                if not statmatches(row, os.stat(row[0])):
+                    stale.add(row[0])
+            except OSError:
+                stale.add(row[0])
+            # a large file whose sample was last checked may have changed
+            # where the sample does not look, unless it was hashed in full
+            # since it was last modified
+            if (row[5] or "").endswith(SEGMENTED) and (
+                row[7] is None or row[7] * 1_000_000_000 < row[3]
+            ):
+                stale.add(row[0])
+
+        if not stale and len({row[5] for row in same_size}) == 1:
+            keyed = collections.defaultdict(list)
+            for row in same_size:
+                keyed[(row[1], row[5] or "md5")].append(row[0])
+        else:
+            keyed = collections.defaultdict(list)
+            candidates = collections.defaultdict(list)
+            for row in same_size:
+                try:
+                    candidates[hashpartial(state, row[0])].append(row)
+                except OSError:
+                    debug("cannot read fname=%r", row[0])
+            for rows_ in candidates.values():
+                if len(rows_) < 2:
+                    continue
+                for row in rows_:
+                    if row[0] not in stale and row[5] == state.algorithm:
+                        digest = row[1]
+                    else:
+                        try:
+                            digest = hashfile(state, row[0], state.algorithm)
+                        except OSError:
+                            debug("cannot read fname=%r", row[0])
+                            continue
+                    keyed[(digest, state.algorithm)].append(row[0])
+
+        for (digest, alg), fnames in keyed.items():
+            if len(fnames) > 1:
+                groups.append((size, digest, alg, sorted(fnames)))
+
+    groups.sort(key=lambda g: (-g[0] * (len(g[3]) - 1), g[3][0]))
+    debug(f"found {len(groups)} groups")
+    return groups
+
+
+def findrules(path: str, rules: dict) -> tuple:
+    """Returns the (real path, Rules) of the innermost folder holding a path
+
+    Both are None when the path lies outside every configured folder.
+    """
+    while True:
+        ruleset = rules.get(path)
+        if ruleset is not None:
+            return path, ruleset
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None, None
+        path = parent
+
+
+@dbsynchronized
+def flushdb(state: State) -> bool:
+    """Writes all queued commands to the SQLite DB in a single transaction"""
+
+    trace(f"enter: {len(state.pending_fnames)=}")
+
+    if len(state.pending) == 0:
+        return True
+
+    result = None
+    start = time.perf_counter()
+
+    conn = connectdb(state)
+    cursor = conn.cursor()
     try:
-        query = f"SELECT fname, md5 FROM {table_name} WHERE fname = ?"
-        debug(f"{query=}")
-        args = (fname,)
-        debug(f"{args=}")
-        r = corecursor(conn, query, args, hits)
-        debug(f"{r=}, {hits=}")
-        if r and len(hits) == 1:
-            result = True
-    except sqlite3.OperationalError as err:
+        cursor.execute("BEGIN TRANSACTION")
+        # new directories are interned inside the transaction, and the
+        # commands look their ids up by path, so writers sharing the DB
+        # never hand out the same id
+        cursor.executemany(
+            f"INSERT OR IGNORE INTO {dir_names_table_name} (path) VALUES (?)",
+            ((path,) for path in sorted(state.pending_dirs)),
+        )
+        for cmd, rows in state.pending.items():
+            debug(f"invoking cursor.executemany() for {len(rows)} rows of {cmd=}")
+            cursor.executemany(cmd, rows)
+        cursor.execute("END TRANSACTION")
+        result = True
+    except (sqlite3.IntegrityError, sqlite3.OperationalError) as err:
         error(str(err))
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK TRANSACTION")
+        # the cached indexes already hold the lost writes
+        state.indexes.clear()
+        state.dirrows.clear()
     finally:
-        conn.close()
+        cursor.close()
+        state.pending = {}
+        state.pending_fnames = set()
+        state.pending_dirs = set()
+
+    if state.metrics is not None:
+        with state.counterslock:
+            state.metrics.seconds["write"] += time.perf_counter() - start
+
+    debug(f"returning {result}")
+    return result
+
+
+def getbasefile() -> str:
+    """Returns the name of the SQLite DB file"""
+    trace("enter")
+    return os.path.splitext(os.path.basename(__file__))[0]
+
+
+@dbsynchronized
+def getdirhash(state: State, folder: str) -> str:
+    """Returns the aggregate hash of everything under a folder, or None
+
+    The hash covers the names and hashes of all files and subdirectories
+    below the folder, so comparing it with an earlier value tells whether
+    anything under the folder changed without looking at the files.
+    """
+    trace(f"enter: {folder=}")
+
+    hits = list()
+    query = f"SELECT hash FROM {dir_table_name} WHERE path = ?"
+    corecursor(connectdb(state), query, (os.path.realpath(folder),), hits)
+
+    return hits[0][0] if len(hits) > 0 else None
+
+
+@dbsynchronized
+def getschemaversion(state: State) -> int:
+    """Returns the schema version recorded in the SQLite DB"""
+    return connectdb(state).execute("PRAGMA user_version").fetchone()[0]
+
+
+@dbsynchronized
+def getindex(state: State, folder: str) -> tuple:
+    """Returns loadindex(folder), loading it only on the first call
+
+    The index of every configured folder is kept between passes, and each
+    write to the table is applied to it as it is queued, so later passes
+    do not read the table again unless another connection wrote to it,
+    see revalidatecaches.
+    """
+    root = os.path.realpath(folder)
+    cached = state.indexes.get(root)
+    if cached is None:
+        cached = state.indexes[root] = loadindex(state, folder)
+    return cached
+
+
+def getexecutor(state: State) -> Executor:
+    """Returns the shared hashing pool, or None when hashing serially"""
+
+    if state.executor is None and state.workers > 1:
+        debug(
+            f"starting a pool of {state.workers} {'processes' if state.processes else 'threads'}"
+        )
+        if state.processes:
+            from concurrent.futures import ProcessPoolExecutor
+
+            # each process gets an even share of the rate of bytes read
+            rate = (
+                state.bytes_throttle.rate / state.workers
+                if state.bytes_throttle is not None
+                else None
+            )
+            state.executor = ProcessPoolExecutor(
+                max_workers=state.workers,
+                initializer=initworker,
+                initargs=(rate, state.drop_cache, state.noatime),
+            )
+        else:
+            state.executor = ThreadPoolExecutor(max_workers=state.workers)
+
+    return state.executor
+
+
+def hashalgorithms(state: State, row: tuple) -> tuple:
+    """Returns the algorithms a file with the given row must be hashed with
+
+    A row recorded with another algorithm is compared using that algorithm,
+    and then rewritten with the current one.
+    """
+    if row is not None:
+        algorithm_from_db = row[5] or "md5"
+        if (
+            algorithm_from_db != state.algorithm
+            and algorithm_from_db in HASH_ALGORITHMS
+        ):
+            return (state.algorithm, algorithm_from_db)
+
+    return (state.algorithm,)
+
+
+def hashfile(state: State, fname: str, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    """Get file hash, reading the file in fixed-size chunks
+
+    A stopped scan raises InterruptedError between chunks.
+    """
+
+    if algorithm.endswith(SEGMENTED):
+        return hashsegments(state, fname, None, algorithm.removesuffix(SEGMENTED))
+
+    md = HASH_ALGORITHMS[algorithm]()
+
+    # the file is streamed through the buffer of this thread, so memory use
+    # does not grow with file size; a read may return less than was asked
+    # for, e.g. on NFS or FUSE or after a signal, so only an empty read
+    # means the end of the file
+    view = readbuffer()
+    with openfile(state, fname) as f:
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            md.update(view[:n])
+            pace(state, n)
+            if stopped(state):
+                raise InterruptedError(f'hashing of "{fname}" stopped')
+
+    return md.hexdigest()
+
+
+def hashjob(state: State, fname: str, algorithms: tuple) -> tuple:
+    """Hash one file with each of the given algorithms, in order
+
+    Returns the tuple of digests and the number of seconds it took.
+    """
+    start = time.perf_counter()
+    digests = tuple(hashfile(state, fname, a) for a in algorithms)
+    return digests, time.perf_counter() - start
+
+
+def hashlargejob(state: State, fname: str, st: os.stat_result, row: tuple) -> tuple:
+    """Hash one large file, sampling it first
+
+    When the sampled fingerprint still matches the row and the last full
+    hash is less than verify_days old, the recorded digest is reused.
+    Otherwise the file is hashed in full with hashsegments. Returns the
+    tuple of digests (see hashalgorithms), the sample, the time of the full
+    hash or None, and the number of seconds it took.
+    """
+    start = time.perf_counter()
+    sample = hashpartial(state, fname, SAMPLE_BLOCKS)
+
+    if row is not None and row[5] == algorithmfor(state, st) and not state.paranoid:
+        if row[6] == sample and not verifydue(state, row, st):
+            return (row[1],), sample, None, time.perf_counter() - start
+
+    digests = (hashsegments(state, fname, st, state.algorithm),)
+    if row is not None:
+        # a row recorded with another algorithm is compared using it
+        old = row[5] or "md5"
+        if (
+            old != algorithmfor(state, st)
+            and old.removesuffix(SEGMENTED) in HASH_ALGORITHMS
+        ):
+            digests += (hashfile(state, fname, old),)
+
+    return digests, sample, int(time.time()), time.perf_counter() - start
+
+
+def hashpartial(state: State, fname: str, blocks: int = 2) -> str:
+    """Get a cheap fingerprint of a file from its size and a few blocks
+
+    The blocks are spread evenly over the file, the first one at its start
+    and the last one at its end.
+    """
+
+    md = HASH_ALGORITHMS[state.algorithm]()
+
+    with openfile(state, fname) as f:
+        size = os.fstat(f.fileno()).st_size
+        md.update(size.to_bytes(8, "little"))
+        md.update(f.read(PARTIAL_HASH_BLOCK))
+        if size > PARTIAL_HASH_BLOCK:
+            last = size - PARTIAL_HASH_BLOCK
+            for i in range(1, blocks):
+                f.seek(last * i // (blocks - 1))
+                md.update(f.read(PARTIAL_HASH_BLOCK))
+    pace(state, min(size, blocks * PARTIAL_HASH_BLOCK))
+
+    return md.hexdigest()
+
+
+def hashsegments(state: State, fname: str, st: os.stat_result, algorithm: str) -> str:
+    """Get the hash of the digests of each SEGMENT_SIZE segment of a file
+
+    Unlike a plain hash, this can be resumed: when st is given, the
+    digests of the segments hashed so far are saved after each one, and
+    picked up again if the file is unchanged when it is next hashed. A
+    stopped scan raises InterruptedError between segments.
+    """
+
+    offset, digests = 0, b""
+    if st is not None:
+        offset, digests = loadprogress(state, fname, st, algorithm)
+    resumed = offset > 0
+
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with openfile(state, fname) as f:
+        f.seek(offset)
+        while True:
+            md = HASH_ALGORITHMS[algorithm]()
+            left = SEGMENT_SIZE
+            while left > 0:
+                n = f.readinto(view[: min(left, HASH_BUFFER_SIZE)])
+                if not n:
+                    break
+                md.update(view[:n])
+                pace(state, n)
+                left -= n
+            if left == SEGMENT_SIZE and offset > 0:
+                break
+            digests += md.digest()
+            offset += SEGMENT_SIZE - left
+            if left > 0:
+                break
+            if st is not None:
+                saveprogress(state, fname, st, algorithm, offset, digests)
+                resumed = True
+            if stopped(state):
+                raise InterruptedError(
+                    f'hashing of "{fname}" stopped at offset {offset}'
+                )
+
+    if resumed:
+        saveprogress(state, fname, st, algorithm, None, None)
+
+    md = HASH_ALGORITHMS[algorithm]()
+    md.update(digests)
+    return md.hexdigest()
+
+
+def initworker(rate: float, drop: bool, atime: bool) -> None:
+    """Sets up a hashing process with the settings of the main one"""
+    global workerstate
+
+    workerstate = State()
+    workerstate.bytes_throttle = Throttle(rate) if rate is not None else None
+    workerstate.drop_cache = drop
+    workerstate.noatime = atime
+
+
+def workerjob(fname: str, algorithms: tuple) -> tuple:
+    """Runs hashjob in a process of a hashing pool, see initworker"""
+    return hashjob(workerstate, fname, algorithms)
+
+
+def inserthashtable(
+    state: State,
+    fname: str,
+    md5: str,
+    st: os.stat_result = None,
+    sample: str = None,
+    verified: int = None,
+) -> bool:
+    """Insert into the SQLite File Table"""
+
+    if st is None:
+        st = os.stat(fname)
+
+    # two folders can reach the same file through a symlink, so an insert
+    # racing with another one for the same file updates it instead
+    cmd = (
+        f"INSERT INTO {table_name} (dir, name, digest, moddate, size, mtime_ns, inode, algorithm, sample, verified)"
+        f" VALUES (({DIR_ID_QUERY}), ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT (dir, name) DO UPDATE SET digest = excluded.digest, moddate = excluded.moddate, size = excluded.size,"
+        " mtime_ns = excluded.mtime_ns, inode = excluded.inode, algorithm = excluded.algorithm,"
+        " sample = excluded.sample, verified = excluded.verified"
+    )
+    args = (
+        queuedir(state, os.path.dirname(fname)),
+        os.path.basename(fname),
+        bytes.fromhex(md5),
+        int(st.st_mtime),
+        st.st_size,
+        st.st_mtime_ns,
+        st.st_ino,
+        algorithmfor(state, st),
+        bytes.fromhex(sample) if sample is not None else None,
+        verified,
+    )
+
+    debug("queueing SQL INSERT command for md5=%r fname=%r", md5, fname)
+    cacherow(
+        state,
+        fname,
+        (
+            fname,
+            md5,
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_ino,
+            algorithmfor(state, st),
+            sample,
+            verified,
+        ),
+    )
+    return queuecmd(state, cmd, args, fname)
+
+
+@dbsynchronized
+def is_file_in_table(state: State, fname: str, hits: list = None) -> bool:
+    """Checks if md5 hash tag exists in the SQLite DB"""
+
+    # a queued write for this file must land before it can be looked up
+    if fname in state.pending_fnames:
+        flushdb(state)
+
+    conn = connectdb(state)
+
+    result = False
+    try:
+        query = (
+            f"SELECT s.name, s.digest, s.size, s.mtime_ns, s.inode, s.algorithm, s.sample, s.verified FROM {table_name} s"
+            f" JOIN {dir_names_table_name} d ON s.dir = d.id WHERE d.path = ? AND s.name = ?"
+        )
+        args = (os.path.dirname(fname), os.path.basename(fname))
+        rows = list()
+        r = corecursor(conn, query, args, rows)
+        debug("query=%r args=%r r=%r rows=%r", query, args, r, rows)
+        if r and len(rows) == 1:
+            # rows have the same shape as the ones in loadindex
+            hits.append(rowtuple(os.path.dirname(fname), *rows[0]))
+            result = True
+    except sqlite3.OperationalError as err:
+        error(str(err))
+
+    debug("result=%r", result)
+    return result
+
+
+Change = collections.namedtuple("Change", "scan time kind fname old new")
+
+
+def journalchange(
+    state: State, kind: str, fname: str, old: str, new: str, ws: object = None
+) -> bool:
+    """Queue a journal entry for a file added, modified or deleted by this scan
+
+    The change is also passed to onchange, if set, and appended to ws, if
+    given, as it is found.
+    """
+
+    now = time.time()
+    if state.onchange is not None or ws is not None:
+        change = Change(state.scan_id, now, kind, fname, old, new)
+        if state.onchange is not None:
+            state.onchange(change)
+        if ws is not None:
+            ws.append(change)
+
+    cmd = f"INSERT INTO {journal_table_name} (scan, time, kind, dir, name, old_digest, new_digest) VALUES (?, ?, ?, ({DIR_ID_QUERY}), ?, ?, ?)"
+    args = (
+        state.scan_id,
+        now,
+        kind,
+        queuedir(state, os.path.dirname(fname)),
+        os.path.basename(fname),
+        bytes.fromhex(old) if old is not None else None,
+        bytes.fromhex(new) if new is not None else None,
+    )
+
+    debug("queueing SQL INSERT command for kind=%r fname=%r", kind, fname)
+    return queuecmd(state, cmd, args, fname)
+
+
+def journalchanges(state: State, since_scan: int = None, since_time: float = None):
+    """Yields the journalled changes made after a scan, or since a time
+
+    Each change is a Change of the scan id, time, kind, fname and old and
+    new hex digests, oldest first. The entries are fetched batch_size at a
+    time, so the journal can be streamed while scans keep adding to it.
+    Raises ValueError if the entries asked for have been compacted away.
+    """
+    trace(f"enter: {since_scan=}, {since_time=}")
+
+    with state.dblock:
+        flushdb(state)
+        conn = connectdb(state)
+        oldest, started = conn.execute(
+            f"SELECT id, started FROM {scans_table_name} ORDER BY id LIMIT 1"
+        ).fetchone() or (None, None)
+        # scan ids are never reused, so any gap before the oldest scan left
+        # means older entries were dropped
+        if oldest is not None and oldest > 1:
+            if since_scan is not None and since_scan + 1 < oldest:
+                raise ValueError(
+                    f"the journal no longer goes back to scan {since_scan}"
+                )
+            if since_time is not None and since_time < started:
+                raise ValueError(f"the journal no longer goes back to {since_time}")
+
+        if since_time is not None:
+            row = conn.execute(
+                f"SELECT id FROM {scans_table_name} WHERE finished IS NULL OR finished >= ? ORDER BY id LIMIT 1",
+                (since_time,),
+            ).fetchone()
+            if row is None:
+                return
+            since_scan = row[0] - 1
+
+        last = conn.execute(
+            f"SELECT min(id) - 1 FROM {journal_table_name} WHERE scan > ?",
+            (since_scan or 0,),
+        ).fetchone()[0]
+        if last is None:
+            return
+
+    query = (
+        f"SELECT j.id, j.scan, j.time, j.kind, d.path, j.name, j.old_digest, j.new_digest FROM {journal_table_name} j"
+        f" JOIN {dir_names_table_name} d ON j.dir = d.id WHERE j.id > ? AND j.time >= ? ORDER BY j.id LIMIT ?"
+    )
+    while True:
+        with state.dblock:
+            rows = (
+                connectdb(state)
+                .execute(query, (last, since_time or 0, state.batch_size))
+                .fetchall()
+            )
+        if len(rows) == 0:
+            break
+        for id, scan, when, kind, dirpath, name, old, new in rows:
+            yield Change(
+                scan,
+                when,
+                kind,
+                os.path.join(dirpath, name),
+                old.hex() if old is not None else None,
+                new.hex() if new is not None else None,
+            )
+        last = rows[-1][0]
+
+
+def legacyentries(conn: sqlite3.Connection, have: set):
+    """Yields the Entry of every file recorded in a DB of the original schema
+
+    That status table is keyed by full file names, which do not sort by
+    directory and name, so its rows are sorted in memory. have is the set
+    of its columns, those of later versions may be missing.
+    """
+    columns = ", ".join(
+        c if c in have else "NULL"
+        for c in ("fname", "md5", "size", "mtime_ns", "inode", "algorithm")
+    )
+    entries = [
+        Entry(
+            os.path.dirname(fname),
+            os.path.basename(fname),
+            md5,
+            size,
+            mtime_ns,
+            inode,
+            alg,
+        )
+        for fname, md5, size, mtime_ns, inode, alg in conn.execute(
+            f"SELECT {columns} FROM {table_name}"
+        )
+    ]
+    entries.sort(key=lambda entry: (entry.dir, entry.name))
+    yield from entries
+
+
+@dbsynchronized
+def loadindex(state: State, folder: str) -> tuple:
+    """Loads the rows of all files under a folder into a dict keyed by name
+
+    Returns the (prefix, index) pair, where prefix is the real path of the
+    folder with a trailing separator. Each row is a (fname, hex digest,
+    size, mtime_ns, inode, algorithm, hex sample, verified) tuple. The rows are fetched with a
+    single range query on the directory path index rather than one query
+    per file.
+    """
+    trace(f"enter: {folder=}")
+
+    # rows queued by an earlier folder may fall under this one
+    flushdb(state)
+
+    root = os.path.realpath(folder)
+    prefix = os.path.join(root, "")
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    query = (
+        f"SELECT d.path, s.name, s.digest, s.size, s.mtime_ns, s.inode, s.algorithm, s.sample, s.verified FROM {dir_names_table_name} d"
+        f" JOIN {table_name} s ON s.dir = d.id WHERE d.path = ? OR (d.path >= ? AND d.path < ?)"
+    )
+    debug(f"{query=}, {prefix=}, {upper=}")
+
+    index = dict()
+    cursor = connectdb(state).cursor()
+    try:
+        for row in cursor.execute(query, (root, prefix, upper)):
+            row = rowtuple(*row)
+            index[row[0]] = row
+    except sqlite3.OperationalError as err:
+        error(str(err))
+    finally:
+        cursor.close()
+
+    debug(f"loaded {len(index)} rows")
+    return prefix, index
+
+
+DirRow = collections.namedtuple("DirRow", "mtime_ns entries subdirs files")
+
+
+@dbsynchronized
+def loaddirindex(state: State, folder: str, index: dict, rules: dict) -> dict:
+    """Loads the recorded directories under a folder into a dict keyed by path
+
+    Each value is a DirRow holding the recorded mtime and number of entries,
+    and the subdirectories and files (from the file index) inside it.
+    Directories whose listing cannot be reused have no mtime and are left out.
+    When the rules of the folder, or of folders nested in it, changed since
+    the listings were recorded, they are all dropped instead.
+    """
+    trace(f"enter: {folder=}")
+
+    root = os.path.realpath(folder)
+    prefix = os.path.join(root, "")
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    signature = "\n".join(
+        f"{os.path.relpath(path, root)}|{ruleset.signature}"
+        for path, ruleset in sorted(rules.items())
+        if path == root or path.startswith(prefix)
+    )
+    conn = connectdb(state)
+    row = conn.execute(
+        f"SELECT rules FROM {roots_table_name} WHERE path = ?", (root,)
+    ).fetchone()
+    if row is None or row[0] != signature:
+        debug(f'the rules of "{root}" changed, dropping its recorded dirs')
+        state.dirrows.pop(root, None)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN TRANSACTION")
+            cursor.execute(
+                f"DELETE FROM {dir_table_name} WHERE path = ? OR (path >= ? AND path < ?)",
+                (root, prefix, upper),
+            )
+            cursor.execute(
+                f"INSERT OR REPLACE INTO {roots_table_name} (path, rules) VALUES (?, ?)",
+                (root, signature),
+            )
+            cursor.execute("END TRANSACTION")
+        except (sqlite3.IntegrityError, sqlite3.OperationalError) as err:
+            error(str(err))
+            if conn.in_transaction:
+                cursor.execute("ROLLBACK TRANSACTION")
+        finally:
+            cursor.close()
+        return dict()
+
+    # the rows written by updatedirtable are kept between passes
+    rows = state.dirrows.get(root)
+    if rows is None:
+        query = f"SELECT path, parent, mtime_ns, entries, hash FROM {dir_table_name} WHERE path = ? OR (path >= ? AND path < ?)"
+        debug(f"{query=}, {prefix=}, {upper=}")
+
+        cursor = connectdb(state).cursor()
+        try:
+            rows = {row[0]: row for row in cursor.execute(query, (root, prefix, upper))}
+            state.dirrows[root] = rows
+        except sqlite3.OperationalError as err:
+            error(str(err))
+            rows = dict()
+        finally:
+            cursor.close()
+    rows = rows.values()
+
+    subdirs = collections.defaultdict(list)
+    for path, parent, mtime_ns, entries, hash in rows:
+        subdirs[parent].append(path)
+
+    files = collections.defaultdict(list)
+    for origin in index:
+        files[os.path.dirname(origin)].append(origin)
+
+    dirindex = dict()
+    for path, parent, mtime_ns, entries, hash in rows:
+        if mtime_ns is not None:
+            dirindex[path] = DirRow(
+                mtime_ns, entries, tuple(subdirs[path]), tuple(files[path])
+            )
+
+    debug(f"loaded {len(dirindex)} reusable dirs out of {len(rows)}")
+    return dirindex
+
+
+@dbsynchronized
+def loadprogress(state: State, fname: str, st: os.stat_result, algorithm: str) -> tuple:
+    """Returns the offset and segment digests an interrupted hash of a file got to
+
+    Progress saved for another version of the file is ignored.
+    """
+    row = (
+        connectdb(state)
+        .execute(
+            f"SELECT size, mtime_ns, inode, algorithm, offset, digests FROM {progress_table_name} WHERE dir = ({DIR_ID_QUERY}) AND name = ?",
+            (os.path.dirname(fname), os.path.basename(fname)),
+        )
+        .fetchone()
+    )
+    if row is None or row[:4] != (st.st_size, st.st_mtime_ns, st.st_ino, algorithm):
+        return 0, b""
+
+    debug('resuming hash of "%s" at offset %d', fname, row[4])
+    return row[4], row[5]
+
+
+Schedule = collections.namedtuple("Schedule", "checked interval files bytes")
+
+
+@dbsynchronized
+def loadschedule(state: State) -> dict:
+    """Returns the Schedule of each folder checked before, loading it once"""
+
+    if state.schedule is None:
+        rows = connectdb(state).execute(
+            f"SELECT path, checked, interval, files, bytes FROM {schedule_table_name}"
+        )
+        state.schedule = {row[0]: Schedule(*row[1:]) for row in rows}
+        debug(f"loaded the schedule of {len(state.schedule)} folders")
+
+    return state.schedule
+
+
+class Rules:
+    r"""The compiled include and exclude rules of one configured folder
+
+    The rules follow the folder's path in the config file, separated by
+    commas:
+
+        .ext or ext        skip files with this extension
+        -glob              skip files and directories matching the glob
+        -glob/             skip directories matching the glob
+        +glob              only check files matching one of the + rules
+        -~regex, +~regex   the same with a regular expression
+
+    e.g. "src|.pyc,-node_modules/,-.git/,+*.py". Globs with a "/" in them
+    are matched against the path relative to the folder, other globs
+    against the name alone, and regular expressions are searched for in
+    the relative path. Relative paths always use "/", and a comma inside a
+    pattern is written as "\,". Skipped directories are never descended.
+    """
+
+    def __init__(self):
+        self.items = set()
+        self.extensions = set()
+        # (regex, matched against the relative path rather than the name)
+        self.excludes = list()
+        self.prunes = list()
+        self.includes = list()
+        self.compile()
+
+    def add(self, item: str) -> None:
+        """Adds one rule, raising re.error if its pattern is invalid"""
+        self.items.add(item)
+        if item.startswith(("+", "-")):
+            rules = self.includes if item[0] == "+" else self.excludes
+            pattern = item[1:]
+            if pattern.startswith("~"):
+                re.compile(pattern[1:])
+                rules.append((f".*?(?:{pattern[1:]})", True))
+                return
+            if item[0] == "-" and pattern.endswith("/"):
+                rules = self.prunes
+                pattern = pattern.rstrip("/")
+            import fnmatch
+
+            regex = fnmatch.translate(pattern)
+            re.compile(regex)
+            rules.append((regex, "/" in pattern))
+        elif len(item) > 0:
+            self.extensions.add(item if item.startswith(".") else "." + item)
+
+    def compile(self) -> None:
+        """Combines the rules into one regular expression per kind of match"""
+
+        def combine(rules, bypath):
+            patterns = [regex for regex, path in rules if path == bypath]
+            if len(patterns) == 0:
+                return None
+            return re.compile("|".join(f"(?:{p})" for p in patterns))
+
+        self.exts = frozenset(self.extensions)
+        self.filename = combine(self.excludes, False)
+        self.filepath = combine(self.excludes, True)
+        self.dirname = combine(self.excludes + self.prunes, False)
+        self.dirpath = combine(self.excludes + self.prunes, True)
+        self.inname = combine(self.includes, False)
+        self.inpath = combine(self.includes, True)
+        self.including = len(self.includes) > 0
+        self.signature = ",".join(sorted(self.items))
+
+    def skipdir(self, reldir: str, name: str) -> bool:
+        """Checks if a directory in the directory reldir is to be skipped"""
+        if self.dirname is not None and self.dirname.match(name):
+            return True
+        if self.dirpath is not None:
+            return (
+                self.dirpath.match(f"{reldir}/{name}" if reldir else name) is not None
+            )
+        return False
+
+    def skipfile(self, reldir: str, name: str) -> bool:
+        """Checks if a file in the directory reldir is to be skipped"""
+        if len(self.exts) > 0 and os.path.splitext(name)[1] in self.exts:
+            return True
+        if self.filename is not None and self.filename.match(name):
+            return True
+        if self.filepath is not None or self.inpath is not None:
+            relpath = f"{reldir}/{name}" if reldir else name
+            if self.filepath is not None and self.filepath.match(relpath):
+                return True
+        if not self.including:
+            return False
+        if self.inname is not None and self.inname.match(name):
+            return False
+        return self.inpath is None or self.inpath.match(relpath) is None
+
+
+def loadflds(state: State) -> bool:
+    """Loads the folders and their rules from the config file
+
+    The config file is only read again once its modification time, size or
+    inode changed, and True is returned when it was. If it cannot be read
+    again, the previous configuration is kept.
+    """
+    trace(f"entry")
+
+    def readconfig() -> tuple:
+        trace(f"entry")
+
+        dirs_and_exts_map = dict()
+        dirs_map = dict()
+        exts_map = dict()
+        rules_map = dict()
+
+        def process_dir(dir_path: str) -> str:
+            trace(f"entry")
+
+            if "\\" in dir_path and ":" in dir_path:
+                debug(f'       processing windows-style path "{dir_path}"')
+                style = "windows"
+            else:
+                debug(f'       processing posix-style path "{dir_path}"')
+                style = "posix"
+
+            if dir_path not in dirs_and_exts_map:
+                dirs_and_exts_map[dir_path] = {"count": 1, "exts": {}, "style": style}
+            else:
+                dirs_and_exts_map[dir_path]["count"] += 1
+            dirs_map[dir_path] = {}
+            # folders reached through different paths share their rules
+            rules_map.setdefault(os.path.realpath(dir_path), Rules())
+
+            return style
+
+        def process_exts(dir_path: str, exts: str) -> None:
+            trace(f"entry")
+
+            def process_ext(ext: str) -> None:
+                trace(f"entry")
+                rules_map[os.path.realpath(dir_path)].add(ext)
+                if ext.startswith("."):
+                    ext = ext[1:]
+                dirs_and_exts_map[dir_path]["exts"][ext] = {"count": 0}
+
+            debug(f"      processing {exts=}")
+            for ext in re.split(r"(?<!\\),", exts):
+                ext = ext.strip().replace("\\,", ",")
+                debug(f"          processing {ext=}")
+                process_ext(ext)
+                exts_map[ext] = None
+
+        debug("=" * 78)
+        debug(f'reading config file "{state.cfg_file_name}"')
+        with open(state.cfg_file_name, "rt") as cfg:
+            all_styles = None
+
+            for line_num, line_buf in enumerate(cfg):
+                line_buf = line_buf.strip()
+                debug("-" * 78)
+                debug(f"[{line_num:04}] : {line_buf}")
+
+                if len(line_buf) == 0 or line_buf.startswith("#"):
+                    debug("    skipping blank or comment line")
+                    continue
+
+                parts = line_buf.split("|")
+                debug(f"    {len(parts)=} : {parts=}")
+
+                if len(parts) == 1:
+                    debug(f'    process dir "{parts[0]}"')
+                    this_style = process_dir(parts[0])
+                elif len(parts) == 2:
+                    debug(f'    process dir  "{parts[0]}"')
+                    this_style = process_dir(parts[0])
+                    debug(f'    process exts "{parts[1]}"')
+                    try:
+                        process_exts(parts[0], parts[1])
+                    except re.error as ex:
+                        msg = f"error in line {line_num}: invalid pattern: {ex}"
+                        error(msg)
+                        raise ValueError(msg)
+                else:
+                    msg = f"error in line {line_num}: too many '|' characters ({len(parts)-1})"
+                    error(msg)
+                    raise ValueError(msg)
+                if all_styles is None:
+                    all_styles = this_style
+                elif this_style != all_styles:
+                    msg = f'error in line {line_num}: {this_style} style dir path "{parts[0]}" cannot be mixed with {all_styles} dir paths'
+                    error(msg)
+                    raise ValueError(msg)
+
+        if logger.isEnabledFor(_logging_.DEBUG):
+            import pprint
+
+            debug("=" * 78)
+            debug(f"dir to ext map = \n{pprint.pformat(dirs_and_exts_map)}")
+            debug("-" * 78)
+            debug(f"dirs map = \n{pprint.pformat(dirs_map)}")
+            debug("-" * 78)
+            debug(f"exts map = \n{pprint.pformat(exts_map)}")
+            debug("=" * 78)
+
+        for ruleset in rules_map.values():
+            ruleset.compile()
+
+        a = sorted(list(dirs_map.keys()))
+        return a, rules_map
+
+    assert state.cfg_file_name is not None
+    stamp = None
+    try:
+        st = os.stat(state.cfg_file_name)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if state.flds is not None and stamp == state.cfg_stamp:
+            return False
+        new_flds, new_rules = readconfig()
+    except (OSError, ValueError) as ex:
+        if state.flds is None:
+            raise
+        error(
+            f'keeping the previous configuration, "{state.cfg_file_name}" cannot be loaded: {ex}'
+        )
+        # reported once, until the file changes again
+        state.cfg_stamp = stamp
+        return False
+
+    if state.flds is not None:
+        for fld in sorted(set(new_flds) - set(state.flds)):
+            info(f'folder "{fld}" was added to the configuration')
+        for fld in sorted(set(state.flds) - set(new_flds)):
+            info(f'folder "{fld}" was removed from the configuration')
+
+    # the cached indexes of folders no longer checked on their own go
+    roots = {os.path.realpath(fld) for fld in dedupfolders(new_flds)}
+    for root in state.indexes.keys() - roots:
+        del state.indexes[root]
+    for root in state.dirrows.keys() - roots:
+        del state.dirrows[root]
+
+    state.flds, state.rules, state.cfg_stamp = new_flds, new_rules, stamp
+    return True
+
+
+@dbsynchronized
+def migratehashtable(state: State) -> None:
+    """Converts a status table created by an older version to the current schema
+
+    The original table, keyed by the full file name with the hex MD5 in a
+    text column and possibly without the size, mtime_ns, inode and
+    algorithm columns, is renamed, copied row by row into the new tables
+    and dropped. Later versions only need columns added. Either way it all
+    happens in a single transaction.
+    """
+    trace("enter")
+
+    conn = connectdb(state)
+    have = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+
+    if "fname" not in have:
+        missing = [
+            (c, k)
+            for c, k in (("sample", "blob"), ("verified", "integer"))
+            if c not in have
+        ]
+        if len(missing) == 0:
+            return
+        info(f'migrating table "{table_name}" to schema version {SCHEMA_VERSION}')
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN TRANSACTION")
+            for column, kind in missing:
+                cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {kind}")
+            cursor.execute("END TRANSACTION")
+        except sqlite3.Error as err:
+            if conn.in_transaction:
+                cursor.execute("ROLLBACK TRANSACTION")
+            fatal(f'Failed to migrate table "{table_name}": {err}')
+        finally:
+            cursor.close()
+        return
+    columns = ", ".join(
+        c if c in have else "NULL"
+        for c in ("fname", "md5", "moddate", "size", "mtime_ns", "inode", "algorithm")
+    )
+    old_table_name = f"{table_name}_old"
+
+    info(f'migrating table "{table_name}" to schema version {SCHEMA_VERSION}')
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN TRANSACTION")
+        cursor.execute(f"DROP INDEX IF EXISTS idx_{table_name}_fname")
+        cursor.execute(f"ALTER TABLE {table_name} RENAME TO {old_table_name}")
+        createhashtable(state)
+        createhashtableidx(state)
+
+        # the directories are interned here, inside the migration transaction
+        migrated = dict()
+
+        def dirid(path: str) -> int:
+            if path not in migrated:
+                migrated[path] = conn.execute(
+                    f"INSERT INTO {dir_names_table_name} (path) VALUES (?)", (path,)
+                ).lastrowid
+            return migrated[path]
+
+        def rows():
+            for fname, md5, moddate, size, mtime_ns, inode, alg in conn.execute(
+                f"SELECT {columns} FROM {old_table_name}"
+            ):
+                yield (
+                    dirid(os.path.dirname(fname)),
+                    os.path.basename(fname),
+                    bytes.fromhex(md5) if md5 is not None else None,
+                    moddate,
+                    size,
+                    mtime_ns,
+                    inode,
+                    alg,
+                )
+
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {table_name} (dir, name, digest, moddate, size, mtime_ns, inode, algorithm) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows(),
+        )
+        cursor.execute(f"DROP TABLE {old_table_name}")
+        cursor.execute("END TRANSACTION")
+    except sqlite3.Error as err:
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK TRANSACTION")
+        fatal(f'Failed to migrate table "{table_name}": {err}')
+    finally:
+        cursor.close()
+
+
+def pace(state: State, nbytes: int = 0, nfiles: int = 0) -> None:
+    """Waits as long as the bytes read or files checked take at the set rates"""
+    if nbytes and state.bytes_throttle is not None:
+        state.bytes_throttle.take(nbytes, state.stopping)
+    if nfiles and state.files_throttle is not None:
+        state.files_throttle.take(nfiles, state.stopping)
+
+
+DEFAULT_LOOP_DELAY_TIME_SECS = 3
+
+
+def parsecmdline(argv: list) -> object:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="""Program to monitor for changed files."""
+    )
+    parser.add_argument(
+        "-l",
+        "--loop",
+        action="store_true",
+        help="""
+    if specified, the program will just loop and loop checking for
+    changed files until interrupted with a Control-C
+    """,
+    )
+    parser.add_argument(
+        "-t",
+        "--time",
+        type=int,
+        help=f"""
+    if the -l/--loop option is specified, the -t/--time option can be used
+    to specify the delay in seconds between each loop. The default value
+    is {DEFAULT_LOOP_DELAY_TIME_SECS} seconds
+    """,
+    )
+
+    parser.add_argument(
+        "-p",
+        "--paranoid",
+        action="store_true",
+        help="""
+    if specified, every file is re-hashed on every pass, even when its size,
+    modification time and inode are the same as when it was last recorded
+    """,
+    )
+
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"""
+    the number of inserts and updates grouped into a single database
+    transaction. The default value is {DEFAULT_BATCH_SIZE}
+    """,
+    )
+
+    parser.add_argument(
+        "-a",
+        "--algorithm",
+        choices=sorted(HASH_ALGORITHMS),
+        default=DEFAULT_HASH_ALGORITHM,
+        help=f"""
+    the hash algorithm used for new and changed files. Rows recorded with
+    another algorithm are still compared correctly. The default value is
+    {DEFAULT_HASH_ALGORITHM}
+    """,
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="""
+    the number of files hashed in parallel. The default value of 1 hashes
+    files one at a time in the main thread
+    """,
+    )
+    parser.add_argument(
+        "-P",
+        "--processes",
+        action="store_true",
+        help="""
+    if specified together with -w/--workers, hash in a pool of processes
+    instead of a pool of threads, which suits trees of many small files
+    """,
+    )
+
+    parser.add_argument(
+        "-f",
+        "--folder-workers",
+        type=int,
+        default=DEFAULT_FOLDER_WORKERS,
+        help=f"""
+    the number of configured folders checked at the same time. The default
+    value is {DEFAULT_FOLDER_WORKERS}
+    """,
+    )
+    parser.add_argument(
+        "-m",
+        "--per-mount",
+        type=int,
+        default=DEFAULT_PER_MOUNT,
+        help=f"""
+    the number of folders on the same device checked at the same time, so a
+    slow mount cannot hold up folders on other mounts. The default value
+    is {DEFAULT_PER_MOUNT}
+    """,
+    )
+
+    parser.add_argument(
+        "-L",
+        "--follow-links",
+        action="store_true",
+        help="""
+    if specified, symlinked directories are descended into as well. Each
+    directory is still visited only once, so symlink loops are harmless
+    """,
+    )
+
+    parser.add_argument(
+        "-W",
+        "--watch",
+        action="store_true",
+        help="""
+    if specified, the program runs one full scan and then only checks the
+    files reported as touched by inotify, until interrupted with a
+    Control-C. Where inotify is not available this behaves like -l/--loop
+    """,
+    )
+    parser.add_argument(
+        "-r",
+        "--reconcile",
+        type=int,
+        help=f"""
+    if the -W/--watch option is specified, the -r/--reconcile option can be
+    used to specify the delay in seconds between full reconciliation scans.
+    The default value is {DEFAULT_RECONCILE_SECS} seconds
+    """,
+    )
+
+    parser.add_argument(
+        "--metrics-json",
+        metavar="FILE",
+        help="""
+    if specified, the counters, per-phase timings, hash latency histogram and
+    slowest files of every pass are appended to this file as a line of JSON
+    """,
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        metavar="FILE",
+        help="""
+    if specified, the same figures are written to this file in the
+    Prometheus text format after every pass
+    """,
+    )
+    parser.add_argument(
+        "-R",
+        "--report",
+        metavar="FILE",
+        help="""
+    if specified, a row is written to this file for every file added,
+    modified or deleted, as an Excel workbook if its name ends in .xlsx or
+    as CSV otherwise. Rows are streamed to the file as the changes are
+    found, in every pass until the program ends. With -s/--since-scan or
+    -S/--since-time, the changes are written to it instead of printed
+    """,
+    )
+
+    parser.add_argument(
+        "-D",
+        "--duplicates",
+        action="store_true",
+        help="""
+    if specified, instead of checking for changed files, report the groups
+    of recorded files that share the same content and the number of bytes
+    that could be reclaimed. The first report creates an index on the
+    stored hashes that is kept up to date from then on
+    """,
+    )
+
+    parser.add_argument(
+        "--dir-hash",
+        metavar="FOLDER",
+        help="""
+    if specified, instead of checking for changed files, print the aggregate
+    hash of everything under a folder as of the last check, which differs
+    from an earlier one whenever anything under the folder changed
+    """,
+    )
+    parser.add_argument(
+        "--export",
+        metavar="FILE",
+        help="""
+    if specified, instead of checking for changed files, write the recorded
+    files to a snapshot file, sorted so that it can be compared with
+    --diff in a single pass however many files it holds
+    """,
+    )
+    parser.add_argument(
+        "--diff",
+        nargs="+",
+        metavar="FILE",
+        help="""
+    if specified with one or two snapshot or database files, instead of
+    checking for changed files, print the files added, modified and deleted
+    between the first and the second, or the recorded files if there is no
+    second. Files recorded with different hash algorithms are compared by
+    size only. With -R/--report, the files are written to it instead
+    """,
+    )
+
+    since = parser.add_mutually_exclusive_group()
+    since.add_argument(
+        "-s",
+        "--since-scan",
+        type=int,
+        metavar="ID",
+        help="""
+    if specified, instead of checking for changed files, print the files
+    added, modified and deleted by the scans after the scan with this id.
+    The id of every scan is shown in its summary statistics
+    """,
+    )
+    since.add_argument(
+        "-S",
+        "--since-time",
+        type=parsetime,
+        metavar="TIME",
+        help="""
+    like -s/--since-scan, but print the changes made since a time, given
+    either in ISO 8601 format or in seconds since the epoch
+    """,
+    )
+    parser.add_argument(
+        "--journal-days",
+        type=int,
+        default=DEFAULT_JOURNAL_DAYS,
+        help=f"""
+    the number of days the changes found by each scan are kept for, or 0 to
+    keep them regardless of age. The default value is {DEFAULT_JOURNAL_DAYS}
+    """,
+    )
+    parser.add_argument(
+        "--journal-rows",
+        type=int,
+        default=DEFAULT_JOURNAL_ROWS,
+        help=f"""
+    the number of changes kept, older scans being dropped first, or 0 for
+    no limit. The default value is {DEFAULT_JOURNAL_ROWS}
+    """,
+    )
+    parser.add_argument(
+        "--large-size",
+        type=parsesize,
+        metavar="SIZE",
+        help="""
+    if specified, files of at least this size, in bytes or with a K, M or G
+    suffix, are large: a scan only samples a few blocks of them, and hashes
+    them in full when the sample or their stat changes, or when their last
+    full hash is older than --verify-days. Their full hash is computed one
+    segment at a time and resumes where it left off after an interruption
+    """,
+    )
+    parser.add_argument(
+        "--verify-days",
+        type=float,
+        default=DEFAULT_VERIFY_DAYS,
+        help=f"""
+    the number of days after which large files are hashed in full again,
+    even when their sample is unchanged. The default value is {DEFAULT_VERIFY_DAYS}
+    """,
+    )
+    parser.add_argument(
+        "--max-interval",
+        type=int,
+        metavar="SECS",
+        help="""
+    if specified with the -l/--loop or -W/--watch option, each folder is
+    checked on its own schedule: on every pass while changes are found in
+    it, and twice as rarely after each pass finding none, up to once every
+    SECS seconds
+    """,
+    )
+    parser.add_argument(
+        "--budget-files",
+        type=int,
+        metavar="N",
+        help="""
+    if specified with the -l/--loop or -W/--watch option, a pass only
+    checks the folders due for a check, most overdue first, as long as the
+    files their last check went through add up to at most N. The others are
+    left for a later pass. At least one folder is always checked
+    """,
+    )
+    parser.add_argument(
+        "--budget-bytes",
+        type=parsesize,
+        metavar="SIZE",
+        help="""
+    like --budget-files, but limits the bytes the last check of the folders
+    of a pass hashed, given in bytes or with a K, M or G suffix
+    """,
+    )
+    parser.add_argument(
+        "--max-bytes-rate",
+        type=parsesize,
+        metavar="SIZE",
+        help="""
+    if specified, files are read for hashing at no more than SIZE bytes per
+    second overall, given in bytes or with a K, M or G suffix
+    """,
+    )
+    parser.add_argument(
+        "--max-files-rate",
+        type=float,
+        metavar="N",
+        help="""
+    if specified, no more than N files per second are checked overall
+    """,
+    )
+    parser.add_argument(
+        "--drop-cache",
+        action="store_true",
+        help="""
+    if specified, the pages of each file hashed are dropped from the page
+    cache once it has been read, so that a pass does not evict the pages
+    of other programs. The pages of files other programs had just read are
+    dropped too
+    """,
+    )
+    parser.add_argument(
+        "--noatime",
+        action="store_true",
+        help="""
+    if specified, the access time of the files hashed is not updated, for
+    the files owned by the user running the program
+    """,
+    )
+    parser.add_argument(
+        "--idle",
+        action="store_true",
+        help="""
+    if specified, the program runs with the idle CPU scheduling policy and
+    I/O priority class, so that it only gets the CPU time and disk
+    bandwidth no other program wants
+    """,
+    )
+
+    args = parser.parse_args(argv)
+    debug(f"{args=}")
+
+    reporting = (
+        args.duplicates or args.since_scan is not None or args.since_time is not None
+    )
+    if reporting and (args.loop or args.watch):
+        parser.error(
+            "the -D/--duplicates, -s/--since-scan and -S/--since-time options cannot be combined with the -l/--loop or -W/--watch options"
+        )
+    if args.diff is not None and len(args.diff) > 2:
+        parser.error("the --diff option takes at most two files")
+    snapshots = args.export is not None or args.diff is not None
+    if snapshots and (reporting or args.loop or args.watch):
+        parser.error(
+            "the --export and --diff options cannot be combined with the -D/--duplicates, -s/--since-scan, -S/--since-time, -l/--loop or -W/--watch options"
+        )
+    if args.export is not None and args.diff is not None:
+        parser.error("the --export and --diff options cannot be combined")
+    if args.export is not None and args.report is not None:
+        parser.error("the --export and -R/--report options cannot be combined")
+    if args.dir_hash is not None and (
+        reporting or snapshots or args.loop or args.watch or args.report is not None
+    ):
+        parser.error(
+            "the --dir-hash option cannot be combined with the -D/--duplicates, -s/--since-scan, -S/--since-time, --export, --diff, -R/--report, -l/--loop or -W/--watch options"
+        )
+    if args.duplicates and args.report is not None:
+        parser.error("the -D/--duplicates and -R/--report options cannot be combined")
+    if args.duplicates and (args.since_scan is not None or args.since_time is not None):
+        parser.error(
+            "the -D/--duplicates option cannot be combined with the -s/--since-scan or -S/--since-time options"
+        )
+
+    if args.journal_days < 0:
+        parser.error(
+            f"invalid number of journal days {args.journal_days}: only values >= 0 are allowed for the number of journal days"
+        )
+    if args.journal_rows < 0:
+        parser.error(
+            f"invalid number of journal rows {args.journal_rows}: only values >= 0 are allowed for the number of journal rows"
+        )
+    scheduled = (args.max_interval, args.budget_files, args.budget_bytes)
+    if any(v is not None for v in scheduled) and not (args.loop or args.watch):
+        parser.error(
+            "the --max-interval, --budget-files and --budget-bytes options are only valid in conjunction with the -l/--loop or -W/--watch options"
+        )
+    if args.max_interval is not None and args.max_interval < SCHEDULE_MIN_SECS:
+        parser.error(
+            f"invalid maximum interval {args.max_interval}: only values >= {SCHEDULE_MIN_SECS} are allowed for the maximum interval"
+        )
+    if args.budget_files is not None and args.budget_files < 1:
+        parser.error(
+            f"invalid number of budget files {args.budget_files}: only values > 0 are allowed for the number of budget files"
+        )
+    if args.max_files_rate is not None and args.max_files_rate <= 0:
+        parser.error(
+            f"invalid files rate {args.max_files_rate}: only values > 0 are allowed for the files rate"
+        )
+    if args.verify_days < 0:
+        parser.error(
+            f"invalid number of verify days {args.verify_days}: only values >= 0 are allowed for the number of verify days"
+        )
+
+    if args.watch and args.loop:
+        parser.error("the -W/--watch and -l/--loop options cannot be combined")
+    if args.reconcile is None:
+        if args.watch:
+            args.reconcile = DEFAULT_RECONCILE_SECS
+    elif not args.watch:
+        parser.error(
+            "the -r/--reconcile option is only valid in conjunction with the -W/--watch option"
+        )
+    elif args.reconcile < 1:
+        parser.error(
+            f"invalid reconcile time {args.reconcile}: only values >= 1 are allowed for the reconcile time"
+        )
+
+    if args.folder_workers < 1:
+        parser.error(
+            f"invalid number of folder workers {args.folder_workers}: only values >= 1 are allowed for the number of folder workers"
+        )
+    if args.per_mount < 1:
+        parser.error(
+            f"invalid number of folders per mount {args.per_mount}: only values >= 1 are allowed for the number of folders per mount"
+        )
+
+    if args.workers < 1:
+        parser.error(
+            f"invalid number of workers {args.workers}: only values >= 1 are allowed for the number of workers"
+        )
+
+    if args.batch_size < 1:
+        parser.error(
+            f"invalid batch size {args.batch_size}: only values >= 1 are allowed for the batch size"
+        )
+
+    if args.time is None:
+        if args.loop:
+            args.time = DEFAULT_LOOP_DELAY_TIME_SECS
+    elif not args.loop:
+        parser.error(
+            "the -t/--time option is only valid in conjunction with the -l/--loop option"
+        )
+    elif args.time < 0:
+        parser.error(
+            f"invalid delay time {args.time}: only values >= 0 are allowed for the delay time"
+        )
+
+    return args
+
+
+def parsesize(value: str) -> int:
+    """Parses a size given in bytes, or with a K, M or G suffix"""
+    import argparse
+
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    try:
+        unit = units.get(value[-1:].upper(), 1)
+        size = int(value[:-1] if unit > 1 else value) * unit
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size {value!r}")
+    if size <= 0:
+        raise argparse.ArgumentTypeError(
+            f"invalid size {value!r}: only values > 0 are allowed"
+        )
+    return size
+
+
+def parsetime(value: str) -> float:
+    """Parses a time given in ISO 8601 format or in seconds since the epoch"""
+    import argparse
+    import datetime
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time {value!r}")
+
 
-    debug(f"{result=}")
-    return result
+def preparedb(state: State) -> None:
+    """Creates the tables that do not exist yet and migrates older ones
 
+    The schema version is only recorded once every table of that version
+    exists, so a DB already at the current version needs a single PRAGMA
+    rather than a look at sqlite_master and a statement per table.
+    """
+    trace("enter")
 
-def loadflds() -> tuple:
-    trace(f"entry")
+    if getschemaversion(state) >= SCHEMA_VERSION:
+        debug(f"schema version {SCHEMA_VERSION} is up to date")
+        return
 
-    global flds, exts
+    #
+    # check that the main table exists, and if not create it
+    #
+    if tableexists(state):
+        debug(f'table "{table_name}" exists')
+        migratehashtable(state)
+    else:
+        debug(f'table "{table_name}" does not exist and will be created')
+        createhashtable(state)
+        createhashtableidx(state)
+    createdirtable(state)
+    createjournaltable(state)
+    createprogresstable(state)
+    createscheduletable(state)
 
-    def readconfig() -> tuple:
-        trace(f"entry")
+    runcmd(state, f"PRAGMA user_version = {SCHEMA_VERSION}")
 
-        dirs_and_exts_map = dict()
-        dirs_map = dict()
-        exts_map = dict()
 
-        def process_dir(dir_path: str) -> str:
-            trace(f"entry")
+@dbsynchronized
+def queuedir(state: State, path: str) -> str:
+    """Queues the interning of a directory path, returns the path
 
-            if "\\" in dir_path and ":" in dir_path:
-                debug(f'       processing windows-style path "{dir_path}"')
-                style = "windows"
-            else:
-                debug(f'       processing posix-style path "{dir_path}"')
-                style = "posix"
+    A new path is inserted at the start of the transaction the queued
+    commands are written in, see flushdb; the commands refer to it with
+    DIR_ID_QUERY.
+    """
+    state.pending_dirs.add(path)
+    return path
 
-            if dir_path not in dirs_and_exts_map:
-                dirs_and_exts_map[dir_path] = {"count": 1, "exts": {}, "style": style}
-            else:
-                dirs_and_exts_map[dir_path]["count"] += 1
-            dirs_map[dir_path] = {}
 
-            return style
+@dbsynchronized
+def queuecmd(state: State, cmd: str, args: tuple, fname: str) -> bool:
+    """Queue a write command, flushing the queue once the batch is full"""
 
-        def process_exts(dir_path: str, exts: str) -> None:
-            trace(f"entry")
+    state.pending.setdefault(cmd, []).append(args)
+    state.pending_fnames.add(fname)
 
-            def process_ext(ext: str) -> None:
-                trace(f"entry")
-                if ext.startswith("."):
-                    ext = ext[1:]
-                dirs_and_exts_map[dir_path]["exts"][ext] = {"count": 0}
+    if len(state.pending_fnames) >= state.batch_size:
+        return flushdb(state)
 
-            debug(f"      processing {exts=}")
-            for ext in exts.split(","):
-                ext = ext.strip()
-                debug(f"          processing {ext=}")
-                process_ext(ext)
-                exts_map[ext] = None
+    return True
 
-        debug("=" * 78)
-        debug(f'reading config file "{cfg_file_name}"')
-        with open(cfg_file_name, "rt") as cfg:
-            all_styles = None
 
-            for line_num, line_buf in enumerate(cfg):
-                line_buf = line_buf.strip()
-                debug("-" * 78)
-                debug(f"[{line_num:04}] : {line_buf}")
+def readbuffer() -> memoryview:
+    """Returns the HASH_BUFFER_SIZE buffer of the calling thread
 
-                if len(line_buf) == 0 or line_buf.startswith("#"):
-                    debug("    skipping blank or comment line")
-                    continue
+    The buffer is allocated once per thread and then reused, so hashing a
+    small file allocates nothing.
+    """
+    view = getattr(buffers, "view", None)
+    if view is None:
+        view = buffers.view = memoryview(bytearray(HASH_BUFFER_SIZE))
+    return view
 
-                parts = line_buf.split("|")
-                debug(f"    {len(parts)=} : {parts=}")
 
-                if len(parts) == 1:
-                    debug(f'    process dir "{parts[0]}"')
-                    this_style = process_dir(parts[0])
-                elif len(parts) == 2:
-                    debug(f'    process dir  "{parts[0]}"')
-                    this_style = process_dir(parts[0])
-                    debug(f'    process exts "{parts[1]}"')
-                    process_exts(parts[0], parts[1])
-                else:
-                    msg = f"error in line {line_num}: too many '|' characters ({len(parts)-1})"
-                    error(msg)
-                    raise ValueError(msg)
-                if all_styles is None:
-                    all_styles = this_style
-                elif this_style != all_styles:
-                    msg = f'error in line {line_num}: {this_style} style dir path "{parts[0]}" cannot be mixed with {all_styles} dir paths'
-                    error(msg)
-                    raise ValueError(msg)
+def readsnapshot(fname: str):
+    """Yields the Entry of every record of a snapshot file, see exportsnapshot
 
-        debug("=" * 78)
-        debug(f"dir to ext map = \n{pprint.pformat(dirs_and_exts_map)}")
-        debug("-" * 78)
-        debug(f"dirs map = \n{pprint.pformat(dirs_map)}")
-        debug("-" * 78)
-        debug(f"exts map = \n{pprint.pformat(exts_map)}")
-        debug("=" * 78)
+    The file is memory-mapped rather than read, so only the pages being
+    looked at are held in memory.
+    """
+    import mmap
+
+    with open(fname, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(SNAPSHOT_MAGIC) + SNAPSHOT_FOOTER.size:
+            raise ValueError(f'"{fname}" is not a snapshot')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            created, count, trailer, nalgs, magic = SNAPSHOT_FOOTER.unpack_from(
+                mm, size - SNAPSHOT_FOOTER.size
+            )
+            if mm[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or magic != SNAPSHOT_MAGIC:
+                raise ValueError(f'"{fname}" is not a snapshot')
+
+            algorithms = list()
+            pos = trailer
+            for _ in range(nalgs):
+                n = mm[pos]
+                algorithms.append(mm[pos + 1 : pos + 1 + n].decode() or None)
+                pos += 1 + n
+
+            pos = len(SNAPSHOT_MAGIC)
+            dirpath = None
+            for _ in range(count):
+                dirlen, namelen, alg, digestlen, size, mtime_ns, inode = (
+                    SNAPSHOT_RECORD.unpack_from(mm, pos)
+                )
+                pos += SNAPSHOT_RECORD.size
+                if dirlen != SNAPSHOT_SAME_DIR:
+                    dirpath = os.fsdecode(mm[pos : pos + dirlen])
+                    pos += dirlen
+                name = os.fsdecode(mm[pos : pos + namelen])
+                pos += namelen
+                digest = mm[pos : pos + digestlen].hex() if digestlen > 0 else None
+                pos += digestlen
+                yield Entry(
+                    dirpath,
+                    name,
+                    digest,
+                    size if size >= 0 else None,
+                    mtime_ns if mtime_ns >= 0 else None,
+                    inode if inode >= 0 else None,
+                    algorithms[alg],
+                )
+
+
+def recordhash(
+    state: State,
+    origin: str,
+    st: os.stat_result,
+    row: tuple,
+    digests: tuple,
+    counts: dict,
+    sample: str = None,
+    verified: int = None,
+    ws: object = None,
+) -> bool:
+    """Records the freshly computed hash(es) of a file, returns True if it changed
 
-        a = sorted(list(dirs_map.keys()))
-        b = sorted(list(exts_map.keys()))
-        return a, b
+    For a large file, sample is its sampled fingerprint and verified the
+    time it was last hashed in full, None when only the sample was taken.
+    """
 
-    assert cfg_file_name is not None
-    flds, exts = readconfig()
+    cur_md5_val = digests[0]
+    sampled = sample is not None and verified is None
+    if sampled:
+        counts["sampled"] += 1
+    else:
+        counts["hashed"] += len(digests)
+        counts["bytes"] += st.st_size * len(digests)
+    debug("origin=%r cur_md5_val=%r", origin, cur_md5_val)
+
+    if row is None:
+        r = inserthashtable(state, origin, cur_md5_val, st, sample, verified)
+        debug("inserthashtable returned r=%r", r)
+        journalchange(state, "added", origin, None, cur_md5_val, ws)
+        counts["changed"] += 1
+        return True
+
+    md5_val_from_db = row[1]
+    if len(digests) > 1 and digests[1] == md5_val_from_db:
+        # unchanged, but recorded with a different algorithm
+        md5_val_from_db = cur_md5_val
+
+    if cur_md5_val == md5_val_from_db:
+        debug("UP-TO-DATE: origin=%r md5_val_from_db=%r", origin, md5_val_from_db)
+        # the content is the same but the stat tuple is not, so
+        # refresh it to keep the next pass on the fast path; a sampled
+        # file keeps the stat its digest was computed for, so it is
+        # sampled again until it is next hashed in full
+        if not sampled:
+            updatehashtable(state, origin, cur_md5_val, st, sample, verified)
+        counts["unchanged"] += 1
+        return False
 
+    debug("NEED-TO-UPDATE: origin=%r md5_val_from_db=%r", origin, md5_val_from_db)
+    r = updatehashtable(state, origin, cur_md5_val, st, sample, verified)
+    debug("updatehashtable returned r=%r", r)
+    journalchange(state, "modified", origin, md5_val_from_db, cur_md5_val, ws)
+    counts["changed"] += 1
+    return True
 
-def md5short(fname: str) -> str:
-    """Get md5 file hash"""
 
-    data = open(fname, "rb").read()
-    # debug(f'read {len(data)} {type(data)} from "{fname}"')
+def reportdiff(state: State, old: str, new: str = None, ws: object = None) -> None:
+    """Prints the files that differ between two snapshot or DB files
 
-    md = hashlib.new("md5")
-    md.update(data)
-    md5val = md.hexdigest()
+    Without new, the files recorded in the DB are compared with old. The
+    differences are appended to ws instead of printed, if it is given.
+    """
+    trace(f"enter: {old=}, {new=}")
 
-    # debug(f'MD5 for "{fname=}" is {md5val}')
+    if new is None:
+        flushdb(state)
+        entries = dbentries(connectdb(state))
+    else:
+        entries = openentries(new)
+
+    counts = dict.fromkeys(("added", "modified", "deleted"), 0)
+    if ws is None:
+        print("=== DIFFERENCES ===")
+    for change in diffentries(openentries(old), entries):
+        counts[change.kind] += 1
+        if ws is not None:
+            ws.append(change)
+        else:
+            print(
+                f"{change.kind:<8} {change.fname} {change.old or '-'} {change.new or '-'}"
+            )
+    print(f"Number of files   added     = {counts['added']}")
+    print(f"Number of files   modified  = {counts['modified']}")
+    print(f"Number of files   deleted   = {counts['deleted']}")
 
-    return md5val
 
+def reportduplicates(state: State) -> None:
+    """Prints the groups of files sharing the same content"""
+    trace(f"enter")
 
-DEFAULT_LOOP_DELAY_TIME_SECS = 3
+    groups = findduplicates(state)
+    reclaimable = 0
+    print("=== DUPLICATES ===")
+    for size, digest, alg, fnames in groups:
+        wasted = size * (len(fnames) - 1)
+        reclaimable += wasted
+        print(
+            f"{len(fnames)} files of {size} bytes, {wasted} reclaimable, {alg} {digest}"
+        )
+        for fname in fnames:
+            print(f"    {fname}")
+    print(f"Number of duplicate groups  = {len(groups)}")
+    print(f"Number of duplicate files   = {sum(len(g[3]) for g in groups)}")
+    print(f"Number of bytes reclaimable = {reclaimable}")
 
 
-def parsecmdline(argv: list) -> object:
-    parser = argparse.ArgumentParser(
-        description="""Program to monitor for changed files."""
-    )
-    parser.add_argument(
-        "-l",
-        "--loop",
-        action="store_true",
-        help="""
-    if specified, the program will just loop and loop checking for
-    changed files until interrupted with a Control-C
-    """,
-    )
-    parser.add_argument(
-        "-t",
-        "--time",
-        type=int,
-        help=f"""
-    if the -l/--loop option is specified, the -t/--time option can be used
-    to specify the delay in seconds between each loop. The default value
-    is {DEFAULT_LOOP_DELAY_TIME_SECS} seconds
-    """,
-    )
+@dbsynchronized
+def reschedule(state: State, folder: str, changed: bool, counts: dict) -> None:
+    """Records a complete check of a folder and works out when it is next due
 
-    args = parser.parse_args(argv)
-    debug(f"{args=}")
+    A folder with changes is checked again on every pass; each pass finding
+    none doubles the time until its next check, up to max_interval seconds.
+    The files checked and bytes hashed are kept as the cost of the next check.
+    """
+    previous = loadschedule(state).get(folder)
+    if changed or previous is None:
+        interval = 0
+    else:
+        interval = max(SCHEDULE_MIN_SECS, previous.interval * 2)
+        if state.max_interval is not None:
+            interval = min(interval, state.max_interval)
 
-    if args.time is None:
-        if args.loop:
-            args.time = DEFAULT_LOOP_DELAY_TIME_SECS
-    elif not args.loop:
-        parser.error(
-            "the -t/--time option is only valid in conjunction with the -l/--loop option"
-        )
-    elif args.time < 0:
-        parser.error(
-            f"invalid delay time {args.time}: only values >= 0 are allowed for the delay time"
-        )
+    entry = Schedule(time.time(), interval, counts["checked"], counts["bytes"])
+    debug("folder=%r changed=%r entry=%r", folder, changed, entry)
+    state.schedule[folder] = entry
+    cmd = f"INSERT OR REPLACE INTO {schedule_table_name} (path, checked, interval, files, bytes) VALUES (?, ?, ?, ?, ?)"
+    queuecmd(state, cmd, (folder,) + entry, folder)
 
-    return args
+
+@dbsynchronized
+def revalidatecaches(state: State) -> None:
+    """Drops the cached indexes, listings and schedule if another connection wrote to the DB
+
+    The caches only follow the writes of this tracker, while PRAGMA
+    data_version changes with every commit made through any other
+    connection, be it of another tracker or another process.
+    """
+    version = connectdb(state).execute("PRAGMA data_version").fetchone()[0]
+    if version == state.data_version:
+        return
+
+    if state.data_version is not None:
+        debug("the DB was written by another connection, dropping the cached rows")
+    state.indexes.clear()
+    state.dirrows.clear()
+    state.schedule = None
+    state.data_version = version
+
+
+def rowtuple(
+    dirpath: str,
+    name: str,
+    digest: bytes,
+    size: int,
+    mtime_ns: int,
+    inode: int,
+    algorithm: str,
+    sample: bytes,
+    verified: int,
+) -> tuple:
+    """Turns a stored row into the (fname, hex digest, size, mtime_ns, inode, algorithm, hex sample, verified) tuple used in memory"""
+    return (
+        os.path.join(dirpath, name),
+        digest.hex() if digest is not None else None,
+        size,
+        mtime_ns,
+        inode,
+        algorithm,
+        sample.hex() if sample is not None else None,
+        verified,
+    )
 
 
-def runcmd(cmd: str, args: list = None, hits: list = None) -> bool:
+def runcmd(state: State, cmd: str, args: list = None, hits: list = None) -> bool:
     """Run a specific command on the SQLite DB"""
     trace(f"entry: {cmd=}")
 
     result = None
 
-    conn = connectdb()
+    conn = connectdb(state)
     debug(f"{conn=}, {type(conn)=}")
     debug(f"{cmd=}")
     debug(f"{args=}")
@@ -515,10 +3399,15 @@ def runcmd(cmd: str, args: list = None, hits: list = None) -> bool:
     cursor = conn.cursor()
     debug(f"cursor = {cursor}")
 
+    # a command run inside an enclosing transaction becomes part of it, and
+    # it is up to the owner of that transaction to commit or roll it back
+    own_transaction = not conn.in_transaction
+
     try:
-        xcmd = "BEGIN TRANSACTION"
-        r = cursor.execute(xcmd)
-        debug(f"{xcmd} : returned {r}")
+        if own_transaction:
+            xcmd = "BEGIN TRANSACTION"
+            r = cursor.execute(xcmd)
+            debug(f"{xcmd} : returned {r}")
 
         if args is None:
             debug("invoking cursor.execute() without args")
@@ -538,9 +3427,10 @@ def runcmd(cmd: str, args: list = None, hits: list = None) -> bool:
                     hits.append(list(row))
         result = True
 
-        ycmd = "END TRANSACTION"
-        r = cursor.execute(ycmd)
-        debug(f"{ycmd} : returned {r}")
+        if own_transaction:
+            ycmd = "END TRANSACTION"
+            r = cursor.execute(ycmd)
+            debug(f"{ycmd} : returned {r}")
 
     except sqlite3.IntegrityError as err:
         error(str(err))
@@ -550,24 +3440,33 @@ def runcmd(cmd: str, args: list = None, hits: list = None) -> bool:
         else:
             error(str(err))
     finally:
+        # the connection is shared, so never leave a failed transaction open
+        if own_transaction and conn.in_transaction:
+            cursor.execute("ROLLBACK TRANSACTION")
         cursor.close()
 
-    conn.close()
-
     debug(f"returning {result}")
     return result
 
 
-def runfilechanges(ws: object = None) -> bool:
+def runfilechanges(state: State, ws: object = None) -> bool:
     trace(f"enter: {ws=}")
 
-    global counters
-    counters = {
+    # a pass deferring every folder does not start a scan
+    state.scan_id = None
+    state.timings = {}
+    state.metrics = Metrics()
+    state.counters = {
         "folders": 0,
         "checked": 0,
         "skipped": 0,
         "changed": 0,
         "unchanged": 0,
+        "deleted": 0,
+        "hashed": 0,
+        "sampled": 0,
+        "bytes": 0,
+        "deferred": 0,
     }
 
     #
@@ -575,41 +3474,215 @@ def runfilechanges(ws: object = None) -> bool:
     #
     debug("getting list of dirs to be scanned and extensions to be ignored")
 
-    loadflds()
-    assert flds is not None
-    assert exts is not None
+    loadflds(state)
+    assert state.flds is not None
+    assert state.rules is not None
+
+    debug(f'the configuration was loaded from file "{state.cfg_file_name}"')
+    debug(f"discovered {len(state.flds)} dirs")
 
-    debug(f'the configuration was loaded from file "{cfg_file_name}"')
-    debug(f"discovered {len(flds)} dirs and {len(exts)} extensions")
+    revalidatecaches(state)
 
-    if len(flds) == 0:
+    if len(state.flds) == 0:
         debug(f"no directories to be scanned")
         return False
 
-    changed = False
-    wid = len(str(len(flds) - 1))
-    for i, fld in enumerate(flds, start=1):
-        # Invoke the function that checks each folder for file changes
-        debug(f'Processing directory {i:{wid}} of {len(flds)}: "{fld}"')
+    roots = dedupfolders(state.flds)
+    if scheduling(state):
+        due = scheduledfolders(state, roots)
+        state.counters["deferred"] = len(roots) - len(due)
+        roots = due
+        if len(roots) == 0:
+            debug(f"no directories are due to be scanned")
+            return False
 
-        r = checkfilechanges(fld, exts, ws)
-        debug(f"checkfilechanges(...) returned {r=}")
+    beginscan(state)
+    changed = scanfolders(state, roots, ws)
+    endscan(state)
 
-        if r:
-            changed = r
+    flushdb(state)
+    compactjournal(state)
 
     debug(f"returning {changed=}")
     return changed
 
 
-def tableexists() -> bool:
+@dbsynchronized
+def saveprogress(
+    state: State,
+    fname: str,
+    st: os.stat_result,
+    algorithm: str,
+    offset: int,
+    digests: bytes,
+) -> bool:
+    """Saves how far the hash of a large file got, or forgets it if offset is None"""
+
+    key = (os.path.dirname(fname), os.path.basename(fname))
+    if offset is None:
+        return runcmd(
+            state,
+            f"DELETE FROM {progress_table_name} WHERE dir = ({DIR_ID_QUERY}) AND name = ?",
+            key,
+        )
+
+    # the directory of a file hashed for the first time is not interned yet
+    runcmd(
+        state,
+        f"INSERT OR IGNORE INTO {dir_names_table_name} (path) VALUES (?)",
+        key[:1],
+    )
+    cmd = (
+        f"INSERT OR REPLACE INTO {progress_table_name} (dir, name, size, mtime_ns, inode, algorithm, offset, digests)"
+        f" VALUES (({DIR_ID_QUERY}), ?, ?, ?, ?, ?, ?, ?)"
+    )
+    return runcmd(
+        state,
+        cmd,
+        key + (st.st_size, st.st_mtime_ns, st.st_ino, algorithm, offset, digests),
+    )
+
+
+def scanfolders(state: State, roots: list, ws: object) -> bool:
+    """Checks the folders concurrently, at most per_mount at a time per device"""
+    trace(f"enter: {roots=}")
+
+    devices = dict()
+    for fld in roots:
+        try:
+            devices[fld] = os.stat(fld).st_dev
+        except OSError:
+            devices[fld] = None
+
+    todo = list(roots)
+    busy = dict()
+    cond = threading.Condition()
+
+    def nextfolder() -> str:
+        # the first folder whose device still has a free slot, waiting for
+        # one to be released if necessary; None when nothing is left
+        with cond:
+            while len(todo) > 0 and not stopped(state):
+                for fld in todo:
+                    if busy.get(devices[fld], 0) < state.per_mount:
+                        todo.remove(fld)
+                        busy[devices[fld]] = busy.get(devices[fld], 0) + 1
+                        return fld
+                cond.wait()
+        return None
+
+    def worker() -> bool:
+        changed = False
+        while (fld := nextfolder()) is not None:
+            debug(f'Processing directory "{fld}"')
+            start = time.perf_counter()
+            try:
+                # Invoke the function that checks each folder for file changes
+                r = checkfilechanges(state, fld, state.rules, ws)
+                debug(f"checkfilechanges(...) returned {r=}")
+            finally:
+                state.timings[fld] = time.perf_counter() - start
+                with cond:
+                    busy[devices[fld]] -= 1
+                    cond.notify_all()
+            if r:
+                changed = True
+        return changed
+
+    changed = False
+    nthreads = min(state.folder_workers, len(roots))
+    pool = ThreadPoolExecutor(max_workers=nthreads)
+    try:
+        for future in [pool.submit(worker) for _ in range(nthreads)]:
+            if future.result():
+                changed = True
+    except KeyboardInterrupt:
+        # Ctrl-C reaches this thread only, the folder threads notice the
+        # stop between files, or between buffers of a file being hashed
+        info("stopping the folder checks")
+        if state.stopping is None:
+            state.stopping = threading.Event()
+        state.stopping.set()
+        with cond:
+            cond.notify_all()
+        raise
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    return changed
+
+
+def statmatches(row: list, st: os.stat_result) -> bool:
+    """Checks if a stored (fname, md5, size, mtime_ns, inode, ...) row matches a stat result"""
+    return row[2] == st.st_size and row[3] == st.st_mtime_ns and row[4] == st.st_ino
+
+
+def scheduledfolders(state: State, roots: list) -> list:
+    """Returns the folders due for a check in this pass, most overdue first
+
+    Folders never checked come first, then the others by how late they are
+    relative to their interval. Folders are then taken while the files and
+    bytes their last check cost fit in budget_files and budget_bytes, but
+    at least one is always taken. The others are left for a later pass.
+    """
+    trace(f"enter: {roots=}")
+
+    history = loadschedule(state)
+    now = time.time()
+    due = list()
+    for fld in roots:
+        entry = history.get(fld)
+        if entry is None:
+            due.append((float("inf"), fld))
+        elif now >= entry.checked + entry.interval:
+            late = now - entry.checked - entry.interval
+            due.append((late / max(entry.interval, SCHEDULE_MIN_SECS), fld))
+    due.sort(key=lambda d: d[0], reverse=True)
+
+    taken = list()
+    files = nbytes = 0
+    for _, fld in due:
+        entry = history.get(fld)
+        cost = (entry.files, entry.bytes) if entry is not None else (0, 0)
+        if len(taken) > 0 and (
+            (state.budget_files is not None and files + cost[0] > state.budget_files)
+            or (
+                state.budget_bytes is not None and nbytes + cost[1] > state.budget_bytes
+            )
+        ):
+            debug('deferring folder "%s" costing %r over the budget', fld, cost)
+            continue
+        taken.append(fld)
+        files += cost[0]
+        nbytes += cost[1]
+
+    debug(f"returning {len(taken)} of {len(roots)} folders")
+    return taken
+
+
+def scheduling(state: State) -> bool:
+    """Checks if folders are checked on their own schedule rather than every pass"""
+    return (
+        state.max_interval is not None
+        or state.budget_files is not None
+        or state.budget_bytes is not None
+    )
+
+
+def stopped(state: State) -> bool:
+    """Checks if the caller asked the scan or watch in progress to stop"""
+    return state.stopping is not None and state.stopping.is_set()
+
+
+@dbsynchronized
+def tableexists(state: State) -> bool:
     """Checks if a SQLite DB Table exists"""
     trace("enter")
 
     result = None
 
     try:
-        conn = connectdb()
+        conn = connectdb(state)
 
         query = (
             # f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'"
@@ -631,63 +3704,721 @@ def tableexists() -> bool:
     except sqlite3.OperationalError as err:
         error(str(err))
 
-    finally:
-        conn.close()
-
     debug(f"tableexists() returning {result}")
     return result
 
 
-def updatehashtable(fname: str, md5: str) -> bool:
+def writemetrics(state: State, json_file_name: str, prom_file_name: str) -> None:
+    """Exports the counters and metrics of the last pass, if requested
+
+    A line of JSON is appended to json_file_name, and prom_file_name is
+    replaced atomically so a Prometheus textfile collector never reads a
+    partly written file.
+    """
+    trace(f"enter: {json_file_name=}, {prom_file_name=}")
+
+    if json_file_name is not None:
+        with open(json_file_name, "at") as f:
+            print(state.metrics.tojson(state.counters), file=f)
+
+    if prom_file_name is not None:
+        tmp_file_name = prom_file_name + ".tmp"
+        with open(tmp_file_name, "wt") as f:
+            f.write(state.metrics.toprometheus(state.counters))
+        os.replace(tmp_file_name, prom_file_name)
+
+
+def verifydue(state: State, row: tuple, st: os.stat_result) -> bool:
+    """Checks if a large file is due for a full hash, however unchanged it looks"""
+    if state.large_size is None or st.st_size < state.large_size:
+        return False
+    return row[7] is None or time.time() - row[7] >= state.verify_days * 24 * 60 * 60
+
+
+def walkfiles(
+    folder: str,
+    rules: dict,
+    counts: dict,
+    followlinks: bool = False,
+    dirindex: dict = None,
+    dirstats: dict = None,
+    m: Metrics = None,
+):
+    """Yields (real path, stat) for every file to be checked under a folder
+
+    Built on os.scandir so that directories are recognised from the cached
+    entry type, the Rules of the innermost configured folder are applied
+    before any stat, so skipped directories are never descended, and each
+    remaining file costs a single stat call. Symlinked directories are only
+    descended when followlinks is set, and never twice.
+
+    When a dirindex (as returned by loaddirindex) is given, a directory whose
+    mtime still matches its row is not listed again: the files recorded in it
+    are stat'ed directly and its recorded subdirectories are descended. The
+    mtime and listed files of each directory are added to dirstats.
+
+    Time spent in file stat calls is added to the "stat" phase of m, and the
+    rest of the time spent in the generator to its "walk" phase.
+    """
+    trace("enter: folder=%r, followlinks=%r", folder, followlinks)
+
+    root = os.path.realpath(folder)
+    base, ruleset = findrules(root, rules)
+    if base is None:
+        base, ruleset = root, Rules()
+    reldir = os.path.relpath(root, base).replace(os.sep, "/")
+    # each directory is stacked with its path relative to the folder whose
+    # rules apply to it, and those rules
+    stack = [(root, "" if reldir == "." else reldir, ruleset)]
+    visited = set()
+
+    if m is None:
+        m = Metrics()
+    phase = m.seconds
+    mark = time.perf_counter()
+
+    while len(stack) > 0:
+        subdir, reldir, ruleset = stack.pop()
+        if subdir in rules:
+            # a configured folder nested in this one brings its own rules
+            reldir, ruleset = "", rules[subdir]
+        try:
+            dst = os.stat(subdir)
+        except OSError as ex:
+            debug('skipping unreadable dir "%s": %s', subdir, ex)
+            continue
+        if followlinks:
+            if (dst.st_dev, dst.st_ino) in visited:
+                debug('skipping already visited dir "%s"', subdir)
+                continue
+            visited.add((dst.st_dev, dst.st_ino))
+
+        cached = dirindex.get(subdir) if dirindex is not None else None
+        if cached is not None and cached.mtime_ns == dst.st_mtime_ns:
+            # the listing has not changed, but file contents still may have
+            debug('reusing the recorded listing of dir "%s"', subdir)
+            for sub in cached.subdirs:
+                name = os.path.basename(sub)
+                stack.append((sub, f"{reldir}/{name}" if reldir else name, ruleset))
+            files = list()
+            for origin in cached.files:
+                counts["checked"] += 1
+                # the file index may still hold files excluded since then
+                if ruleset.skipfile(reldir, os.path.basename(origin)):
+                    debug('skipping excluded file "%s"', origin)
+                    counts["skipped"] += 1
+                    continue
+                now = time.perf_counter()
+                phase["walk"] += now - mark
+                try:
+                    st = os.stat(origin)
+                except OSError as ex:
+                    debug('skipping vanished file "%s": %s', origin, ex)
+                    counts["skipped"] += 1
+                    continue
+                finally:
+                    mark = time.perf_counter()
+                    phase["stat"] += mark - now
+                files.append(origin)
+                phase["walk"] += time.perf_counter() - mark
+                yield origin, st
+                mark = time.perf_counter()
+            if dirstats is not None:
+                dirstats[subdir] = (dst.st_mtime_ns, cached.entries, tuple(files))
+            continue
+
+        try:
+            it = os.scandir(subdir)
+        except OSError as ex:
+            debug('skipping unreadable dir "%s": %s', subdir, ex)
+            continue
+
+        # a listing can only be reused when every entry in it is a plain
+        # directory, a regular file or an excluded file
+        cacheable = True
+        entries = 0
+        files = list()
+
+        with it:
+            for entry in it:
+                entries += 1
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if ruleset.skipdir(reldir, entry.name):
+                        debug('skipping excluded dir "%s"', entry.path)
+                        continue
+                    relsub = f"{reldir}/{entry.name}" if reldir else entry.name
+                    if not entry.is_symlink():
+                        stack.append((entry.path, relsub, ruleset))
+                    elif followlinks:
+                        stack.append((os.path.realpath(entry.path), relsub, ruleset))
+                        cacheable = False
+                    continue
+
+                counts["checked"] += 1
+
+                # entries below the real root have real paths already,
+                # except for symlinks
+                if entry.is_symlink():
+                    origin = os.path.realpath(entry.path)
+                    cacheable = False
+                else:
+                    origin = entry.path
+
+                # check the file against the rules by the name it was
+                # found under
+                if ruleset.skipfile(reldir, entry.name):
+                    debug('skipping excluded file "%s"', origin)
+                    counts["skipped"] += 1
+                    continue
+
+                now = time.perf_counter()
+                phase["walk"] += now - mark
+                try:
+                    st = entry.stat()
+                except OSError as ex:
+                    debug('skipping vanished file "%s": %s', origin, ex)
+                    counts["skipped"] += 1
+                    cacheable = False
+                    continue
+                finally:
+                    mark = time.perf_counter()
+                    phase["stat"] += mark - now
+                if not stat.S_ISREG(st.st_mode):
+                    debug('skipping non-file "%s"', origin)
+                    counts["skipped"] += 1
+                    cacheable = False
+                    continue
+
+                files.append(origin)
+                phase["walk"] += time.perf_counter() - mark
+                yield origin, st
+                mark = time.perf_counter()
+
+        # entries added within the same mtime tick would go unnoticed
+        if time.time_ns() - dst.st_mtime_ns < DIR_MTIME_SETTLE_NS:
+            cacheable = False
+
+        if dirstats is not None:
+            dirstats[subdir] = (
+                dst.st_mtime_ns if cacheable else None,
+                entries,
+                tuple(files),
+            )
+
+    phase["walk"] += time.perf_counter() - mark
+
+
+@dbsynchronized
+def updatedirtable(state: State, folder: str, index: dict, dirstats: dict) -> None:
+    """Rewrites the directory rows under a folder after it was checked
+
+    index is the folder's file index, as returned by getindex, and dirstats
+    maps each directory seen by walkfiles to its (mtime_ns, entries, files)
+    tuple. Only the rows that differ from the previous pass are written. The aggregate hash of a directory is computed bottom-up
+    from the recorded hashes of its files and the aggregate hashes of its
+    subdirectories. A listing is only marked reusable when all of its files
+    made it into the table, so files that could not be read are retried.
+    """
+    trace(f"enter: {folder=}, {len(dirstats)=}")
+
+    # the files must be in the table before any listing of them is
+    flushdb(state)
+
+    root = os.path.realpath(folder)
+    prefix = os.path.join(root, "")
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    children = collections.defaultdict(list)
+    for path in dirstats:
+        if path != root:
+            children[os.path.dirname(path)].append(path)
+
+    files = collections.defaultdict(list)
+    for origin, row in index.items():
+        files[os.path.dirname(origin)].append((os.path.basename(origin), row[1]))
+
+    hashes = dict()
+    rows = list()
+    # a subdirectory always has a longer path than its parent
+    for path in sorted(dirstats, key=len, reverse=True):
+        mtime_ns, entries, listed = dirstats[path]
+        if mtime_ns is not None and not all(origin in index for origin in listed):
+            mtime_ns = None
+
+        md = HASH_ALGORITHMS[state.algorithm]()
+        for name, digest in sorted(files[path]):
+            md.update(f"f {name}\0{digest}\n".encode(errors="surrogateescape"))
+        for sub in sorted(children[path]):
+            name = os.path.basename(sub)
+            md.update(f"d {name}\0{hashes[sub]}\n".encode(errors="surrogateescape"))
+        hashes[path] = md.hexdigest()
+
+        parent = os.path.dirname(path) if path != root else None
+        rows.append((path, parent, mtime_ns, entries, hashes[path]))
+
+    # the rows of the previous pass are known, so only the differences
+    # need to be written
+    old = state.dirrows.pop(root, None)
+    new = {row[0]: row for row in rows}
+    if old is not None:
+        rows = [row for path, row in new.items() if old.get(path) != row]
+        gone = [(path,) for path in old.keys() - new.keys()]
+
+    cursor = connectdb(state).cursor()
+    try:
+        cursor.execute("BEGIN TRANSACTION")
+        if old is None:
+            cursor.execute(
+                f"DELETE FROM {dir_table_name} WHERE path = ? OR (path >= ? AND path < ?)",
+                (root, prefix, upper),
+            )
+        else:
+            cursor.executemany(f"DELETE FROM {dir_table_name} WHERE path = ?", gone)
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {dir_table_name} (path, parent, mtime_ns, entries, hash) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        cursor.execute("END TRANSACTION")
+        state.dirrows[root] = new
+    except (sqlite3.IntegrityError, sqlite3.OperationalError) as err:
+        error(str(err))
+        if cursor.connection.in_transaction:
+            cursor.execute("ROLLBACK TRANSACTION")
+    finally:
+        cursor.close()
+
+    debug(f"recorded {len(rows)} dirs, {hashes.get(root)=}")
+
+
+def updatehashtable(
+    state: State,
+    fname: str,
+    md5: str,
+    st: os.stat_result = None,
+    sample: str = None,
+    verified: int = None,
+) -> bool:
     """Update the SQLite File Table"""
 
-    cmd = f"UPDATE {table_name} SET md5='{md5}', moddate={int(getmoddate(fname))} WHERE fname = '{fname}'"
-    debug(f"update command = {cmd}")
+    if st is None:
+        st = os.stat(fname)
 
-    hits = list()
-    result = runcmd(cmd, hits=hits)  # , args)
-    debug(f"QQRXQ runcmd UPDATE returned {result=}, {hits=}")
+    cmd = (
+        f"UPDATE {table_name} SET digest = ?, moddate = ?, size = ?, mtime_ns = ?, inode = ?, algorithm = ?, sample = ?, verified = ?"
+        f" WHERE dir = ({DIR_ID_QUERY}) AND name = ?"
+    )
+    args = (
+        bytes.fromhex(md5),
+        int(st.st_mtime),
+        st.st_size,
+        st.st_mtime_ns,
+        st.st_ino,
+        algorithmfor(state, st),
+        bytes.fromhex(sample) if sample is not None else None,
+        verified,
+        os.path.dirname(fname),
+        os.path.basename(fname),
+    )
+    debug("update command = %s, args=%r", cmd, args)
+
+    cacherow(
+        state,
+        fname,
+        (
+            fname,
+            md5,
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_ino,
+            algorithmfor(state, st),
+            sample,
+            verified,
+        ),
+    )
+    return queuecmd(state, cmd, args, fname)
 
-    return result
+
+class Tracker:
+    """Tracks the folders of one configuration file in one database
+
+    A tracker owns the State its calls work on, i.e. its own configuration,
+    connection, caches and counters, so several of them can be used in one
+    process, e.g.
+
+        with Tracker("filechanges.ini", algorithm="sha256") as tracker:
+            for change in tracker.scan():
+                print(change.kind, change.fname)
+
+    Trackers share nothing, so they can run at the same time, and the calls
+    on one tracker only take turns while they use its connection. Its
+    passes take turns with each other.
+    """
+
+    # the state read straight through, e.g. tracker.counters
+    STATE = State.OPTIONS + (
+        "cfg_file_name",
+        "db_file_name",
+        "counters",
+        "timings",
+        "metrics",
+        "scan_id",
+    )
+
+    def __init__(self, cfg_file_name: str, db_file_name: str = None, **options):
+        """Options are named after the State attributes they set, e.g. paranoid=True"""
+        unknown = options.keys() - set(State.OPTIONS)
+        if unknown:
+            raise TypeError(f"unknown options {sorted(unknown)}")
+
+        self.state = State(
+            cfg_file_name, db_file_name or os.path.splitext(cfg_file_name)[0] + ".db"
+        )
+        for option, value in options.items():
+            setattr(self.state, option, value)
+
+        self.running = threading.Lock()
+        self.changed = None
+
+        preparedb(self.state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name: str):
+        # counters, timings, metrics and the like read straight through
+        state = self.__dict__.get("state")
+        if state is None or name not in Tracker.STATE:
+            raise AttributeError(name)
+        return getattr(state, name)
+
+    async def aevents(self, target, maxsize: int):
+        """Runs target in a thread as a pass of this tracker, yielding its changes
+
+        At most maxsize changes are queued, past that the thread waits for
+        the caller to catch up. When the caller stops early, or is
+        cancelled, the thread is asked to stop and is waited for, so
+        whatever it found so far is recorded before this returns.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        changes = asyncio.Queue()
+        room = threading.Semaphore(maxsize)
+        stop = threading.Event()
+
+        def put(change):
+            while not room.acquire(timeout=STOP_POLL_SECS):
+                if stop.is_set():
+                    return
+            loop.call_soon_threadsafe(changes.put_nowait, change)
+
+        def run():
+            try:
+                self.hook(target, put, stop)
+            finally:
+                loop.call_soon_threadsafe(changes.put_nowait, None)
+
+        future = loop.run_in_executor(None, run)
+        try:
+            while (change := await changes.get()) is not None:
+                room.release()
+                yield change
+            await future
+        finally:
+            stop.set()
+            await asyncio.wait([future])
+
+    async def ascan(self, maxsize: int = DEFAULT_CHANGE_QUEUE_SIZE):
+        """Runs a full pass without blocking the event loop, see scan()
+
+        Meant for async for; the pass stops early, keeping whatever it has
+        recorded so far, when the loop is left or the task is cancelled.
+        Use aclosing to have that happen straight away when leaving the loop
+        with break.
+        """
+
+        def target():
+            self.changed = runfilechanges(self.state)
+
+        async with aclosing(self.aevents(target, maxsize)) as changes:
+            async for change in changes:
+                yield change
+
+    def changes(self, since_scan: int = None, since_time: float = None):
+        """Yields the journalled changes, see journalchanges"""
+        yield from journalchanges(self.state, since_scan, since_time)
+
+    def close(self) -> None:
+        """Shuts down the hashing pool and closes the connection"""
+        closeexecutor(self.state)
+        closedb(self.state)
+
+    def diff(self, old: str, new: str = None):
+        """Yields the files that differ between two snapshot or DB files, see diffentries
+
+        Without new, the files recorded by this tracker are compared with old.
+        """
+        if new is None:
+            # read through a connection of its own, so a pass can carry on
+            flushdb(self.state)
+            new = self.state.db_file_name
+        yield from diffentries(openentries(old), openentries(new))
+
+    def dirhash(self, folder: str) -> str:
+        """Returns the aggregate hash of everything under a folder, see getdirhash"""
+        return getdirhash(self.state, folder)
+
+    def duplicates(self) -> list:
+        """Returns the groups of files sharing the same content, see findduplicates"""
+        return findduplicates(self.state)
+
+    def export(self, fname: str) -> int:
+        """Writes the recorded files to a snapshot file, see exportsnapshot"""
+        flushdb(self.state)
+        return exportsnapshot(fname, openentries(self.state.db_file_name))
+
+    def hook(self, target, put, stop) -> None:
+        """Calls target as a pass of this tracker, with onchange and stopping set"""
+        with self.running:
+            self.state.onchange, self.state.stopping = put, stop
+            try:
+                target()
+            finally:
+                self.state.onchange = self.state.stopping = None
+
+    def scan(self):
+        """Runs a full pass, yielding each Change as soon as it is found
+
+        The pass runs in a thread of its own, so it carries on to the end
+        even if the caller stops early. Its result is left in changed, and
+        its counters, timings and metrics in the attributes of those names.
+        """
+        import queue
+
+        events = queue.Queue()
+        failure = list()
+
+        def target():
+            self.changed = runfilechanges(self.state)
+
+        def run():
+            try:
+                self.hook(target, events.put, None)
+            except BaseException as ex:
+                failure.append(ex)
+            finally:
+                events.put(None)
+
+        thread = threading.Thread(target=run, name="tracker-scan", daemon=True)
+        thread.start()
+        try:
+            while True:
+                change = events.get()
+                if change is None:
+                    break
+                yield change
+        finally:
+            thread.join()
+
+        if failure:
+            raise failure[0]
+
+    async def watch(
+        self,
+        handler=None,
+        reconcile: int = DEFAULT_RECONCILE_SECS,
+        delay: int = DEFAULT_LOOP_DELAY_TIME_SECS,
+        maxsize: int = DEFAULT_CHANGE_QUEUE_SIZE,
+    ) -> None:
+        """Watches the folders until cancelled, passing every Change to handler
+
+        The handler may be a plain function or a coroutine function. Files
+        are checked as inotify reports them touched, with a full pass every
+        reconcile seconds, or where inotify is not available with a full
+        pass every delay seconds.
+        """
+        import asyncio
+
+        state = self.state
+
+        def target():
+            notifier = openinotify()
+            if notifier is None:
+                while not stopped(state):
+                    runfilechanges(state)
+                    state.stopping.wait(delay)
+                return
+            try:
+                watchfilechanges(
+                    state, notifier, reconcile, lambda: runfilechanges(state)
+                )
+            finally:
+                notifier.close()
+
+        async with aclosing(self.aevents(target, maxsize)) as changes:
+            async for change in changes:
+                if handler is not None:
+                    result = handler(change)
+                    if asyncio.iscoroutine(result):
+                        await result
 
 
 def main(argv: list) -> None:
     """Main function - does all of the control logic"""
+    _logging_.basicConfig(
+        format=LOG_FORMAT,
+        level=_logging_.DEBUG if os.getenv("DEBUG", "N") == "Y" else _logging_.INFO,
+    )
     trace("enter")
 
-    global cfg_file_name, db_file_name, counters
-
     def execute(args):
-        any_changes = runfilechanges()
+        any_changes = runfilechanges(state, report)
         debug(f"main: {any_changes=}")
 
+        counters = state.counters
         print("=== SUMMARY STATISTICS ===")
         print(f"Number of folders checked   = {counters['folders']}")
+        print(f"Number of folders deferred  = {counters['deferred']}")
         print(f"Number of files   checked   = {counters['checked']}")
         print(f"Number of files   skipped   = {counters['skipped']}")
         print(f"Number of files   changed   = {counters['changed']}")
         print(f"Number of files   unchanged = {counters['unchanged']}")
+        print(f"Number of files   deleted   = {counters['deleted']}")
+        print(f"Number of files   hashed    = {counters['hashed']}")
+        print(f"Number of files   sampled   = {counters['sampled']}")
+        print(f"Number of bytes   hashed    = {counters['bytes']}")
         print(f"Files changed flag          = {any_changes}")
+        print(f"Scan id                     = {state.scan_id}")
+        print("=== FOLDER TIMINGS ===")
+        for fld, secs in sorted(state.timings.items()):
+            print(f"{secs:10.3f}s  {fld}")
+        print("=== PHASE TIMINGS ===")
+        for phase, secs in state.metrics.seconds.items():
+            print(f"{secs:10.3f}s  {phase}")
+
+        writemetrics(state, args.metrics_json, args.metrics_prom)
 
     basename = getbasefile()
     cfg_file_name = basename + ".ini"
     db_file_name = basename + ".db"
 
     args = parsecmdline(argv[1:])
+    if args.idle:
+        # before any thread is started, for all of them to inherit it
+        setidle()
 
     print(f'The configuration file  name is "{cfg_file_name}"')
     print(f'The database      file  name is "{db_file_name}"')
     print(f'The database      table name is "{table_name}"')
 
-    #
-    # check that the main table exists, and if not create it
-    #
-    if tableexists():
-        debug(f'table "{table_name}" exists')
-    else:
-        debug(f'table "{table_name}" does not exist and will be created')
-        createhashtable()
-        createhashtableidx()
+    tracker = Tracker(
+        cfg_file_name,
+        db_file_name,
+        paranoid=args.paranoid,
+        batch_size=args.batch_size,
+        algorithm=args.algorithm,
+        workers=args.workers,
+        processes=args.processes,
+        folder_workers=args.folder_workers,
+        per_mount=args.per_mount,
+        followlinks=args.follow_links,
+        journal_days=args.journal_days,
+        journal_rows=args.journal_rows,
+        large_size=args.large_size,
+        verify_days=args.verify_days,
+        max_interval=args.max_interval,
+        budget_files=args.budget_files,
+        budget_bytes=args.budget_bytes,
+        bytes_throttle=(
+            Throttle(args.max_bytes_rate) if args.max_bytes_rate is not None else None
+        ),
+        files_throttle=(
+            Throttle(args.max_files_rate) if args.max_files_rate is not None else None
+        ),
+        drop_cache=args.drop_cache,
+        noatime=args.noatime,
+    )
+    state = tracker.state
+
+    if args.dir_hash is not None:
+        dirhash = tracker.dirhash(args.dir_hash)
+        tracker.close()
+        if dirhash is None:
+            fatal(
+                f'no hash is recorded for "{args.dir_hash}", it has not been checked yet'
+            )
+        print(f"{dirhash}  {args.dir_hash}")
+        return
+
+    if args.duplicates:
+        reportduplicates(state)
+        tracker.close()
+        return
+
+    if args.export is not None:
+        count = tracker.export(args.export)
+        print(f'Number of files   exported  = {count} to "{args.export}"')
+        tracker.close()
+        return
+
+    report = Report(args.report) if args.report is not None else None
+
+    if args.diff is not None:
+        try:
+            old, new = (args.diff + [None])[:2]
+            reportdiff(state, old, new, report)
+        except (OSError, ValueError, sqlite3.Error) as ex:
+            fatal(f"failed to compare the files: {ex}")
+        if report is not None:
+            report.close()
+        tracker.close()
+        return
+
+    if args.since_scan is not None or args.since_time is not None:
+        import datetime
+
+        try:
+            for change in tracker.changes(args.since_scan, args.since_time):
+                if report is not None:
+                    report.append(change)
+                    continue
+                scan, when, kind, fname, old, new = change
+                when = datetime.datetime.fromtimestamp(when).isoformat(
+                    timespec="seconds"
+                )
+                print(f"{scan:>6} {when} {kind:<8} {fname} {old or '-'} {new or '-'}")
+        except ValueError as ex:
+            fatal(f"{ex}, a full scan is needed instead")
+        if report is not None:
+            report.close()
+        tracker.close()
+        return
+
+    if args.watch:
+        notifier = openinotify()
+        if notifier is None:
+            info("inotify is not available, falling back to polling")
+            args.loop = True
+            args.time = args.time or DEFAULT_LOOP_DELAY_TIME_SECS
+        else:
+            info(
+                f"program watching with a reconcile time of {args.reconcile} seconds is starting"
+            )
+            try:
+                watchfilechanges(
+                    state, notifier, args.reconcile, lambda: execute(args), report
+                )
+            except KeyboardInterrupt as e:
+                info("program watching has been interrupted")
+            finally:
+                notifier.close()
 
     if args.loop:
         num_loops = 0
@@ -703,9 +4434,15 @@ def main(argv: list) -> None:
             except KeyboardInterrupt as e:
                 info("program looping has been interrupted")
                 break
-    else:
+    elif not args.watch:
         execute(args)
 
+    if report is not None:
+        report.close()
+    tracker.close()
+
 
+# "python -m filechanges" starts faster than "python filechanges.py", as it
+# runs from the cached bytecode rather than compiling this file every time
 if __name__ == "__main__":
     main(sys.argv)
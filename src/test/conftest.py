@@ -0,0 +1,45 @@
+import os.path
+
+import pytest
+
+import filechanges
+
+
+@pytest.fixture
+def datadir():
+    """Returns the directory holding the config files used by the tests"""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+@pytest.fixture
+def srcdir():
+    """Returns the directory the program is run from, which the config files refer to"""
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def tracker(tmp_path):
+    """Returns a function making Trackers with their DB in tmp_path, closed afterwards"""
+    made = list()
+
+    def make(cfg_file_name, **options):
+        t = filechanges.Tracker(
+            str(cfg_file_name), str(tmp_path / "filechanges.db"), **options
+        )
+        made.append(t)
+        return t
+
+    yield make
+
+    for t in made:
+        t.close()
+
+
+@pytest.fixture
+def folder(tmp_path):
+    """Returns the (config file, folder) of an empty folder to be checked"""
+    root = tmp_path / "folder"
+    root.mkdir()
+    cfg = tmp_path / "filechanges.ini"
+    cfg.write_text(f"{root}\n")
+    return cfg, root
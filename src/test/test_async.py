@@ -0,0 +1,79 @@
+import asyncio
+import contextlib
+
+import filechanges
+
+
+def populate(root, count):
+    for i in range(count):
+        (root / f"f{i:04}.txt").write_text(str(i))
+
+
+async def collect(t):
+    return [c async for c in t.ascan(maxsize=4)]
+
+
+def test_ascan(tracker, folder):
+    cfg, root = folder
+    populate(root, 20)
+    t = tracker(cfg)
+
+    changes = asyncio.run(collect(t))
+    assert sorted(c.kind for c in changes) == ["added"] * 20
+    assert t.changed
+    assert asyncio.run(collect(t)) == []
+    assert t.counters["unchanged"] == 20
+
+
+def test_loop_keeps_running(tracker, folder):
+    cfg, root = folder
+    populate(root, 200)
+    t = tracker(cfg)
+    ticks = [0]
+
+    async def ticker():
+        while True:
+            ticks[0] += 1
+            await asyncio.sleep(0)
+
+    async def run():
+        task = asyncio.create_task(ticker())
+        seen = 0
+        async for change in t.ascan(maxsize=1):
+            seen += 1
+        task.cancel()
+        return seen
+
+    assert asyncio.run(run()) == 200
+    assert ticks[0] > 0
+
+
+def test_cancelled_scan_keeps_its_progress(tracker, folder):
+    cfg, root = folder
+    populate(root, 200)
+    t = tracker(cfg)
+
+    async def run():
+        seen = list()
+
+        async def consume():
+            async with filechanges.aclosing(t.ascan(maxsize=1)) as changes:
+                async for change in changes:
+                    seen.append(change)
+                    if len(seen) == 10:
+                        await asyncio.Event().wait()
+
+        task = asyncio.create_task(consume())
+        while len(seen) < 10:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        return len(seen)
+
+    assert asyncio.run(run()) == 10
+
+    # whatever was recorded before the cancellation is not found again
+    changes = asyncio.run(collect(t))
+    assert 0 < len(changes) < 200
+    assert asyncio.run(collect(t)) == []
@@ -0,0 +1,41 @@
+import os.path
+
+import filechanges
+
+
+def test_caches_follow_other_writers(tmp_path):
+    root = tmp_path / "folder"
+    root.mkdir()
+    (root / "a.txt").write_text("a")
+    cfg = tmp_path / "filechanges.ini"
+    cfg.write_text(f"{root}\n")
+
+    with filechanges.Tracker(str(cfg)) as one, filechanges.Tracker(str(cfg)) as two:
+        assert len(list(one.scan())) == 1
+        assert list(two.scan()) == []
+
+        # the other tracker records the change, so it is not reported twice
+        (root / "a.txt").write_text("changed")
+        (root / "b.txt").write_text("b")
+        assert len(list(two.scan())) == 2
+        assert list(one.scan()) == []
+        assert one.counters["hashed"] == 0
+
+        (root / "b.txt").unlink()
+        assert [(c.kind, os.path.basename(c.fname)) for c in two.scan()] == [
+            ("deleted", "b.txt")
+        ]
+        assert list(one.scan()) == []
+        assert one.counters["deleted"] == 0
+
+
+def test_own_writes_keep_the_caches(tracker, folder):
+    cfg, root = folder
+    (root / "a.txt").write_text("a")
+    t = tracker(cfg)
+    list(t.scan())
+    index = t.state.indexes[os.path.realpath(root)]
+
+    (root / "b.txt").write_text("b")
+    list(t.scan())
+    assert t.state.indexes[os.path.realpath(root)] is index
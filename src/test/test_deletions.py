@@ -0,0 +1,47 @@
+import os.path
+
+import filechanges
+
+
+def kinds(changes):
+    return sorted((c.kind, os.path.basename(c.fname)) for c in changes)
+
+
+def test_deleted_files(tracker, folder):
+    cfg, root = folder
+    (root / "sub").mkdir()
+    for name in ("a.txt", "b.txt", "sub/c.txt", "sub/d.txt"):
+        (root / name).write_text(name)
+    t = tracker(cfg)
+    list(t.scan())
+
+    (root / "a.txt").unlink()
+    (root / "sub" / "c.txt").unlink()
+    assert kinds(t.scan()) == [("deleted", "a.txt"), ("deleted", "c.txt")]
+    assert t.counters["deleted"] == 2
+
+    # they are gone from the table, so they are not reported again
+    assert list(t.scan()) == []
+    (root / "sub" / "d.txt").unlink()
+    (root / "sub").rmdir()
+    assert kinds(t.scan()) == [("deleted", "d.txt")]
+    entries = filechanges.openentries(t.db_file_name)
+    assert [os.path.join(e.dir, e.name) for e in entries] == [
+        os.path.realpath(root / "b.txt")
+    ]
+
+
+def test_index_is_loaded_with_one_query(tracker, folder):
+    cfg, root = folder
+    for i in range(50):
+        (root / f"f{i}.txt").write_text(str(i))
+    list(tracker(cfg).scan())
+
+    # a new tracker has nothing cached, and reads the rows of the folder
+    # in one go rather than looking each file up
+    t = tracker(cfg)
+    queries = list()
+    filechanges.connectdb(t.state).set_trace_callback(queries.append)
+    assert list(t.scan()) == []
+    assert t.counters["unchanged"] == 50
+    assert len([q for q in queries if " status " in q]) == 1
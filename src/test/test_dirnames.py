@@ -0,0 +1,93 @@
+import hashlib
+import os.path
+import sqlite3
+
+import filechanges
+
+
+def test_migrates_baseline_db(tracker, folder):
+    cfg, root = folder
+    (root / "sub").mkdir()
+    contents = {"a.txt": b"a", "sub/b.txt": b"bb"}
+    for name, content in contents.items():
+        (root / name).write_bytes(content)
+
+    # the table as the first version created and filled it
+    conn = sqlite3.connect(cfg.parent / "filechanges.db")
+    conn.execute(
+        "CREATE TABLE status (id integer primary key, fname text, md5 text, moddate integer)"
+    )
+    conn.execute("CREATE UNIQUE INDEX idx_status_fname ON status (fname)")
+    for name, content in contents.items():
+        fname = os.path.realpath(root / name)
+        conn.execute(
+            "INSERT INTO status (fname, md5, moddate) VALUES (?, ?, ?)",
+            (fname, hashlib.md5(content).hexdigest(), int(os.path.getmtime(fname))),
+        )
+    conn.commit()
+    conn.close()
+
+    t = tracker(cfg)
+    assert filechanges.getschemaversion(t.state) == filechanges.SCHEMA_VERSION
+
+    rows = filechanges.connectdb(t.state).execute(
+        "SELECT d.path, s.name, s.digest FROM dirnames d JOIN status s ON s.dir = d.id"
+    )
+    assert {(d, n): digest for d, n, digest in rows} == {
+        os.path.split(os.path.realpath(root / name)): hashlib.md5(content).digest()
+        for name, content in contents.items()
+    }
+
+    # the old rows have no stat to compare with, so the files are hashed
+    # once more and found unchanged
+    assert list(t.scan()) == []
+    assert t.counters["hashed"] == 2
+    assert t.counters["changed"] == 0
+
+    (root / "a.txt").write_bytes(b"changed")
+    changes = list(t.scan())
+    assert [(c.kind, os.path.basename(c.fname)) for c in changes] == [
+        ("modified", "a.txt")
+    ]
+    assert changes[0].old == hashlib.md5(b"a").hexdigest()
+
+
+def test_new_db_is_current(tracker, folder):
+    cfg, root = folder
+    t = tracker(cfg)
+    t.close()
+
+    # a current DB is recognised from its version alone
+    t = tracker(cfg)
+    tables = {
+        row[0]
+        for row in filechanges.connectdb(t.state).execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    }
+    assert {"status", "dirnames", "dirs", "roots", "scans", "journal"} <= tables
+    assert filechanges.getschemaversion(t.state) == filechanges.SCHEMA_VERSION
+
+
+def test_writers_sharing_the_db(tracker, tmp_path):
+    t1, t2 = [tracker(tmp_path / f"{name}.ini") for name in ("one", "two")]
+    for t in (t1, t2):
+        t.state.batch_size = 100
+
+    # both queue a row in a directory neither has interned yet, and the
+    # second writer commits first
+    fnames = [str(tmp_path / name / "f.txt") for name in ("one", "two")]
+    for t, fname in zip((t1, t2), fnames):
+        os.makedirs(os.path.dirname(fname))
+        with open(fname, "wt") as f:
+            f.write(fname)
+        filechanges.inserthashtable(t.state, fname, hashlib.md5(b"").hexdigest())
+    assert filechanges.flushdb(t2.state)
+    assert filechanges.flushdb(t1.state)
+
+    rows = filechanges.connectdb(t1.state).execute(
+        "SELECT d.id, d.path, s.name FROM dirnames d JOIN status s ON s.dir = d.id"
+    )
+    rows = sorted(rows)
+    assert [os.path.join(path, name) for id, path, name in rows] == fnames[::-1]
+    assert rows[0][0] != rows[1][0]
@@ -0,0 +1,49 @@
+import os
+import os.path
+
+LARGE = 1024 * 1024
+
+
+def names(groups):
+    return [[os.path.basename(f) for f in fnames] for size, _, _, fnames in groups]
+
+
+def test_duplicates(tracker, folder):
+    cfg, root = folder
+    (root / "sub").mkdir()
+    for name, content in (
+        ("a.txt", "same"),
+        ("sub/b.txt", "same"),
+        ("c.txt", "diff"),
+        ("d.txt", "longer"),
+        ("e.txt", "longer"),
+        ("empty1", ""),
+        ("empty2", ""),
+    ):
+        (root / name).write_text(content)
+    t = tracker(cfg)
+    list(t.scan())
+
+    # the largest waste comes first, and empty files are left out
+    assert names(t.duplicates()) == [["d.txt", "e.txt"], ["a.txt", "b.txt"]]
+
+    # a file changed since the pass is not trusted
+    (root / "e.txt").write_text("LONGER")
+    assert names(t.duplicates()) == [["a.txt", "b.txt"]]
+
+
+def test_sampled_large_files_are_rehashed(tracker, folder):
+    cfg, root = folder
+    data = bytes(range(256)) * (4 * LARGE // 256)
+    for name in ("a.bin", "b.bin"):
+        (root / name).write_bytes(data)
+    t = tracker(cfg, large_size=LARGE)
+    list(t.scan())
+    assert names(t.duplicates()) == [["a.bin", "b.bin"]]
+
+    # a byte changed between the sampled blocks keeps the sample as it was
+    with open(root / "b.bin", "r+b") as f:
+        f.seek(150_000)
+        f.write(b"\xff")
+    list(t.scan())
+    assert t.duplicates() == []
@@ -0,0 +1,66 @@
+import os
+import os.path
+
+
+def populate(root):
+    for name in ("a.txt", "b.txt", "sub/c.txt"):
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(name)
+
+
+def test_unchanged_files_are_not_hashed(tracker, folder):
+    cfg, root = folder
+    populate(root)
+    t = tracker(cfg)
+
+    assert len(list(t.scan())) == 3
+    assert t.counters["hashed"] == 3
+
+    assert list(t.scan()) == []
+    assert t.counters["checked"] == 3
+    assert t.counters["unchanged"] == 3
+    assert t.counters["hashed"] == 0
+    assert t.counters["bytes"] == 0
+
+
+def test_touched_file_is_hashed_once(tracker, folder):
+    cfg, root = folder
+    populate(root)
+    t = tracker(cfg)
+    list(t.scan())
+
+    st = os.stat(root / "a.txt")
+    os.utime(root / "a.txt", ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+
+    # the content is the same, so nothing is reported
+    assert list(t.scan()) == []
+    assert t.counters["hashed"] == 1
+
+    # but the new stat was recorded, so it is not hashed again
+    assert list(t.scan()) == []
+    assert t.counters["hashed"] == 0
+
+
+def test_modified_file(tracker, folder):
+    cfg, root = folder
+    populate(root)
+    t = tracker(cfg)
+    list(t.scan())
+
+    (root / "sub" / "c.txt").write_text("changed")
+    changes = list(t.scan())
+    assert [(c.kind, os.path.basename(c.fname)) for c in changes] == [
+        ("modified", "c.txt")
+    ]
+    assert t.counters["hashed"] == 1
+
+
+def test_paranoid_hashes_everything(tracker, folder):
+    cfg, root = folder
+    populate(root)
+    list(tracker(cfg).scan())
+
+    t = tracker(cfg, paranoid=True)
+    assert list(t.scan()) == []
+    assert t.counters["hashed"] == 3
+    assert t.counters["unchanged"] == 3
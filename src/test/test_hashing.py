@@ -0,0 +1,58 @@
+import contextlib
+import hashlib
+import io
+
+import pytest
+
+import filechanges
+
+
+class Trickle(io.RawIOBase):
+    """A file returning at most size bytes per read, as NFS or FUSE may"""
+
+    def __init__(self, data: bytes, size: int):
+        self.data = data
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.size, len(self.data) - self.pos)
+        b[:n] = self.data[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+
+@pytest.mark.parametrize("algorithm", ["md5", "sha256", "blake2b"])
+def test_algorithms(tmp_path, algorithm):
+    fname = tmp_path / "f"
+    data = bytes(range(256)) * (filechanges.HASH_BUFFER_SIZE // 100)
+    fname.write_bytes(data)
+
+    digest = filechanges.hashfile(filechanges.State(), str(fname), algorithm)
+    assert digest == hashlib.new(algorithm, data).hexdigest()
+
+
+@pytest.mark.parametrize("size", [0, 1, filechanges.HASH_BUFFER_SIZE])
+def test_boundaries(tmp_path, size):
+    fname = tmp_path / "f"
+    data = b"x" * size
+    fname.write_bytes(data)
+
+    digest = filechanges.hashfile(filechanges.State(), str(fname))
+    assert digest == hashlib.md5(data).hexdigest()
+
+
+def test_short_reads(monkeypatch):
+    data = bytes(range(256)) * 10000
+
+    @contextlib.contextmanager
+    def openfile(state, fname):
+        yield Trickle(data, 1000)
+
+    # every short read is followed by another one until the end of the file
+    monkeypatch.setattr(filechanges, "openfile", openfile)
+    digest = filechanges.hashfile(filechanges.State(), "trickle")
+    assert digest == hashlib.md5(data).hexdigest()
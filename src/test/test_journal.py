@@ -0,0 +1,68 @@
+import hashlib
+import os.path
+
+import pytest
+
+import filechanges
+
+
+def threescans(t, root):
+    """Adds two files, modifies one and deletes the other, a scan each"""
+    (root / "a.txt").write_text("a")
+    (root / "b.txt").write_text("b")
+    list(t.scan())
+    (root / "a.txt").write_text("changed")
+    list(t.scan())
+    (root / "b.txt").unlink()
+    list(t.scan())
+
+
+def kinds(changes):
+    return [(c.kind, os.path.basename(c.fname)) for c in changes]
+
+
+def test_since_scan(tracker, folder):
+    cfg, root = folder
+    t = tracker(cfg)
+    threescans(t, root)
+
+    assert t.scan_id == 3
+    # the files of one scan come in the order they were found
+    assert sorted(kinds(t.changes(0))) == [
+        ("added", "a.txt"),
+        ("added", "b.txt"),
+        ("deleted", "b.txt"),
+        ("modified", "a.txt"),
+    ]
+    changes = list(t.changes(1))
+    assert kinds(changes) == [("modified", "a.txt"), ("deleted", "b.txt")]
+    assert [c.scan for c in changes] == [2, 3]
+    assert changes[0].old == hashlib.md5(b"a").hexdigest()
+    assert changes[0].new == hashlib.md5(b"changed").hexdigest()
+    assert list(t.changes(3)) == []
+
+
+def test_since_time(tracker, folder):
+    cfg, root = folder
+    t = tracker(cfg)
+    threescans(t, root)
+
+    changes = list(t.changes(0))
+    assert kinds(t.changes(since_time=changes[-1].time)) == [("deleted", "b.txt")]
+
+
+def test_compaction(tracker, folder):
+    cfg, root = folder
+    t = tracker(cfg, journal_rows=1)
+    threescans(t, root)
+
+    # only the scan holding the last entry is kept
+    assert (
+        filechanges.connectdb(t.state)
+        .execute("SELECT count(*) FROM journal")
+        .fetchone()[0]
+        == 1
+    )
+    assert kinds(t.changes(2)) == [("deleted", "b.txt")]
+    with pytest.raises(ValueError, match="no longer goes back"):
+        list(t.changes(1))
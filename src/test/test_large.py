@@ -0,0 +1,73 @@
+import os
+import os.path
+
+import filechanges
+
+LARGE = 1024 * 1024
+
+
+def recorded(t, fname):
+    """Returns the (digest, mtime_ns, verified) recorded for a file"""
+    return (
+        filechanges.connectdb(t.state)
+        .execute(
+            "SELECT s.digest, s.mtime_ns, s.verified FROM status s"
+            " JOIN dirnames d ON s.dir = d.id WHERE d.path = ? AND s.name = ?",
+            os.path.split(fname),
+        )
+        .fetchone()
+    )
+
+
+def test_touched_large_file_is_sampled(tracker, folder):
+    cfg, root = folder
+    fname = str(root / "big.bin")
+    with open(fname, "wb") as f:
+        f.write(bytes(range(256)) * (4 * LARGE // 256))
+    t = tracker(cfg, large_size=LARGE)
+    list(t.scan())
+    assert t.counters["hashed"] == 1
+    before = recorded(t, fname)
+
+    st = os.stat(fname)
+    os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    for _ in range(2):
+        assert list(t.scan()) == []
+        assert t.counters["sampled"] == 1
+        assert t.counters["hashed"] == 0
+        # the digest was not checked against the new stat, so the old one
+        # is kept with it
+        assert recorded(t, fname) == before
+
+
+def test_sampled_change_is_found(tracker, folder):
+    cfg, root = folder
+    fname = str(root / "big.bin")
+    with open(fname, "wb") as f:
+        f.write(bytes(range(256)) * (4 * LARGE // 256))
+    t = tracker(cfg, large_size=LARGE)
+    list(t.scan())
+
+    with open(fname, "r+b") as f:
+        f.write(b"\xff")
+    changes = list(t.scan())
+    assert [(c.kind, os.path.basename(c.fname)) for c in changes] == [
+        ("modified", "big.bin")
+    ]
+    assert t.counters["hashed"] == 1
+    assert recorded(t, fname)[1] == os.stat(fname).st_mtime_ns
+
+
+def test_verified_once_due(tracker, folder):
+    cfg, root = folder
+    fname = str(root / "big.bin")
+    with open(fname, "wb") as f:
+        f.write(bytes(range(256)) * (4 * LARGE // 256))
+    list(tracker(cfg, large_size=LARGE).scan())
+
+    st = os.stat(fname)
+    os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    t = tracker(cfg, large_size=LARGE, verify_days=0)
+    assert list(t.scan()) == []
+    assert t.counters["hashed"] == 1
+    assert recorded(t, fname)[1] == st.st_mtime_ns + 1000
@@ -0,0 +1,92 @@
+import os
+import os.path
+
+import filechanges
+
+
+def populate(root):
+    for name in ("a.txt", "sub/b.txt", "sub/deep/c.txt"):
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(name)
+
+
+def backdate(root):
+    """Ages every directory past DIR_MTIME_SETTLE_NS, so its listing may be reused"""
+    when = os.stat(root).st_mtime_ns - 3600 * 10**9
+    for path in [root] + [p for p in root.rglob("*") if p.is_dir()]:
+        os.utime(path, ns=(when, when))
+
+
+def countscandir(monkeypatch):
+    """Counts the directories listed from now on"""
+    listed = list()
+    scandir = os.scandir
+
+    def counting(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(filechanges.os, "scandir", counting)
+    return listed
+
+
+def test_unchanged_listings_are_reused(tracker, folder, monkeypatch):
+    cfg, root = folder
+    populate(root)
+    backdate(root)
+    t = tracker(cfg)
+    list(t.scan())
+
+    listed = countscandir(monkeypatch)
+    assert list(t.scan()) == []
+    assert listed == []
+    assert t.counters["unchanged"] == 3
+
+    # a new file changes the mtime of its directory, which is listed again
+    (root / "sub" / "new.txt").write_text("new")
+    changes = list(t.scan())
+    assert [(c.kind, os.path.basename(c.fname)) for c in changes] == [
+        ("added", "new.txt")
+    ]
+    assert listed == [str(root / "sub")]
+
+
+def test_modified_file_in_reused_listing(tracker, folder, monkeypatch):
+    cfg, root = folder
+    populate(root)
+    backdate(root)
+    t = tracker(cfg)
+    list(t.scan())
+
+    # rewriting a file leaves the mtime of its directory as it was
+    listed = countscandir(monkeypatch)
+    (root / "sub" / "deep" / "c.txt").write_text("changed")
+    changes = list(t.scan())
+    assert [(c.kind, os.path.basename(c.fname)) for c in changes] == [
+        ("modified", "c.txt")
+    ]
+    assert listed == []
+
+
+def test_dirhash(tracker, folder):
+    cfg, root = folder
+    populate(root)
+    t = tracker(cfg)
+    assert t.dirhash(str(root)) is None
+
+    list(t.scan())
+    top, sub = t.dirhash(str(root)), t.dirhash(str(root / "sub"))
+    assert top is not None and sub is not None and top != sub
+
+    list(t.scan())
+    assert t.dirhash(str(root)) == top
+
+    # a change deep down is seen by every folder above it
+    (root / "sub" / "deep" / "c.txt").write_text("changed")
+    list(t.scan())
+    assert t.dirhash(str(root)) != top
+    assert t.dirhash(str(root / "sub")) != sub
+
+    (root / "sub" / "deep" / "c.txt").write_text("sub/deep/c.txt")
+    list(t.scan())
+    assert t.dirhash(str(root)) == top
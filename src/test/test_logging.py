@@ -0,0 +1,16 @@
+import logging
+
+import filechanges
+
+
+def test_own_logger(tracker, folder, caplog):
+    cfg, root = folder
+    (root / "a.txt").write_text("a")
+    t = tracker(cfg)
+
+    # debugging this module leaves the level of other loggers alone
+    caplog.set_level(logging.DEBUG, logger=filechanges.logger.name)
+    list(t.scan())
+    assert {record.name for record in caplog.records} == {"filechanges"}
+    assert any("TRACE" in record.getMessage() for record in caplog.records)
+    assert not logging.getLogger().isEnabledFor(logging.DEBUG)
@@ -0,0 +1,54 @@
+import csv
+import os.path
+
+import pytest
+
+import filechanges
+
+
+def runreport(t, path):
+    report = filechanges.Report(str(path))
+    try:
+        filechanges.runfilechanges(t.state, report)
+    finally:
+        report.close()
+    return report
+
+
+def test_csv_report(tracker, folder, tmp_path):
+    cfg, root = folder
+    (root / "a.txt").write_text("a")
+    (root / "b.txt").write_text("b")
+    t = tracker(cfg)
+    runreport(t, tmp_path / "first.csv")
+
+    (root / "a.txt").write_text("changed")
+    (root / "b.txt").unlink()
+    report = runreport(t, tmp_path / "second.csv")
+    assert report.rows == 2
+
+    with open(tmp_path / "second.csv", newline="") as f:
+        rows = list(csv.reader(f))
+    assert tuple(rows[0]) == filechanges.Report.HEADER
+    rows = sorted(rows[1:], key=lambda row: row[2])
+    assert [(row[0], row[2], os.path.basename(row[3])) for row in rows] == [
+        ("2", "deleted", "b.txt"),
+        ("2", "modified", "a.txt"),
+    ]
+    assert rows[0][5] == ""
+    assert rows[1][4] != rows[1][5]
+
+
+def test_xlsx_report(tracker, folder, tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    cfg, root = folder
+    (root / "a.txt").write_text("a")
+    t = tracker(cfg)
+    runreport(t, tmp_path / "report.xlsx")
+
+    sheet = openpyxl.load_workbook(tmp_path / "report.xlsx")["Changes"]
+    rows = list(sheet.values)
+    assert rows[0] == filechanges.Report.HEADER
+    assert [(row[2], os.path.basename(row[3])) for row in rows[1:]] == [
+        ("added", "a.txt")
+    ]
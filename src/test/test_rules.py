@@ -0,0 +1,136 @@
+import os
+import os.path
+
+import pytest
+
+import filechanges
+
+
+def loadrules(tracker, cfg, line):
+    """Returns the Rules of the folder of a single config line"""
+    cfg.write_text(line + "\n")
+    state = tracker(cfg).state
+    filechanges.loadflds(state)
+    return state.rules[os.path.realpath(line.split("|")[0])]
+
+
+def test_escaped_commas(tracker, folder):
+    cfg, root = folder
+    rules = loadrules(tracker, cfg, f"{root}|-a\\,b.txt,.log")
+    assert rules.skipfile("", "a,b.txt")
+    assert not rules.skipfile("", "b.txt")
+    assert rules.skipfile("", "x.log")
+
+
+def test_extensions(tracker, folder):
+    cfg, root = folder
+    rules = loadrules(tracker, cfg, f"{root}|.pyc,tmp")
+    assert rules.skipfile("sub", "x.pyc")
+    assert rules.skipfile("", "x.tmp")
+    assert not rules.skipfile("", "x.py")
+
+
+def test_include_and_exclude_globs(tracker, folder):
+    cfg, root = folder
+    rules = loadrules(tracker, cfg, f"{root}|+*.py,-test_*")
+    assert not rules.skipfile("", "main.py")
+    assert not rules.skipfile("pkg/sub", "util.py")
+    assert rules.skipfile("", "README.md")
+    assert rules.skipfile("", "test_main.py")
+
+
+def test_path_globs(tracker, folder):
+    cfg, root = folder
+    rules = loadrules(tracker, cfg, f"{root}|-docs/*.md,+src/*")
+    assert rules.skipfile("docs", "readme.md")
+    assert rules.skipfile("", "readme.md")
+    assert not rules.skipfile("src", "readme.md")
+    assert not rules.skipfile("src", "main.c")
+
+
+def test_regular_expressions(tracker, folder):
+    cfg, root = folder
+    rules = loadrules(tracker, cfg, f"{root}|-~\\.bak$,-~^cache/")
+    assert rules.skipfile("a/b", "x.bak")
+    assert not rules.skipfile("", "x.bak.txt")
+    assert rules.skipfile("cache", "x.txt")
+    assert not rules.skipfile("", "cache.txt")
+
+
+def test_prunes(tracker, folder):
+    cfg, root = folder
+    rules = loadrules(tracker, cfg, f"{root}|-node_modules/,-*.tmp")
+    assert rules.skipdir("", "node_modules")
+    assert rules.skipdir("a/b", "node_modules")
+    assert not rules.skipfile("", "node_modules")
+    # excludes apply to directories as well as files
+    assert rules.skipdir("", "x.tmp")
+    assert rules.skipfile("", "x.tmp")
+
+
+def test_per_root_rules(tracker, monkeypatch, datadir, srcdir):
+    monkeypatch.chdir(srcdir)
+    state = tracker(os.path.join(datadir, "posix_style.ini")).state
+    filechanges.loadflds(state)
+
+    assert len(state.flds) == 3
+    # a folder listed twice gets the rules of both lines
+    demo2 = os.path.realpath("test/files/static/Projects/Manning/TrackingFiles/demo2")
+    assert state.rules[demo2].exts == {
+        ".py",
+        ".ini",
+        ".db",
+        ".xlsx",
+        ".a",
+        ".b",
+        ".c",
+        ".d",
+    }
+    # and the others none of them
+    docexpire = os.path.realpath(
+        "test/files/static/Projects/AngularDart/demo/docexpire"
+    )
+    assert not state.rules[docexpire].skipfile("", "x.py")
+    assert state.rules[docexpire].signature == ""
+
+
+def test_invalid_pattern(tracker, folder):
+    cfg, root = folder
+    with pytest.raises(ValueError, match="invalid pattern"):
+        loadrules(tracker, cfg, f"{root}|-~[")
+
+
+def test_too_many_separators(tracker, folder):
+    cfg, root = folder
+    with pytest.raises(ValueError, match="too many"):
+        loadrules(tracker, cfg, f"{root}|.a|.b")
+
+
+def test_mixed_path_styles(tracker, folder):
+    cfg, root = folder
+    cfg.write_text(f"C:\\data\\docs\n{root}\n")
+    state = tracker(cfg).state
+    with pytest.raises(ValueError, match="cannot be mixed"):
+        filechanges.loadflds(state)
+
+
+def test_files_excluded_after_they_were_recorded(tracker, folder):
+    cfg, root = folder
+    (root / "a.txt").write_text("a")
+    (root / "b.log").write_text("b")
+    when = os.stat(root).st_mtime_ns - 3600 * 10**9
+    os.utime(root, ns=(when, when))
+    t = tracker(cfg)
+    assert len(list(t.scan())) == 2
+
+    # the row of the excluded file is kept, and the file is skipped both
+    # when the folder is listed again and when its listing is reused
+    cfg.write_text(f"{root}|.log\n")
+    for _ in range(2):
+        assert list(t.scan()) == []
+        assert t.counters["skipped"] == 1
+
+    (root / "b.log").write_text("changed")
+    assert list(t.scan()) == []
+    assert t.counters["skipped"] == 1
+    assert t.counters["hashed"] == 0
@@ -0,0 +1,35 @@
+def test_quiet_folder_is_deferred(tracker, folder):
+    cfg, root = folder
+    (root / "a.txt").write_text("a")
+    t = tracker(cfg, max_interval=3600)
+
+    # a folder with changes is checked again on the next pass, one without
+    # is left alone for a while
+    list(t.scan())
+    list(t.scan())
+    assert t.counters["folders"] == 1
+    assert t.scan_id == 2
+
+    assert list(t.scan()) == []
+    assert t.counters["folders"] == 0
+    assert t.counters["deferred"] == 1
+    assert t.scan_id is None
+
+
+def test_budget(tracker, tmp_path):
+    cfg = tmp_path / "filechanges.ini"
+    roots = [tmp_path / name for name in ("one", "two")]
+    for root in roots:
+        root.mkdir()
+        for i in range(3):
+            (root / f"{i}.txt").write_text(str(i))
+    cfg.write_text("".join(f"{root}\n" for root in roots))
+    t = tracker(cfg, budget_files=4)
+
+    # folders never checked cost nothing, then each costs 3 files
+    list(t.scan())
+    assert t.counters["folders"] == 2
+    for _ in range(2):
+        list(t.scan())
+        assert t.counters["folders"] == 1
+        assert t.counters["deferred"] == 1
@@ -0,0 +1,108 @@
+import hashlib
+import os.path
+import sqlite3
+
+import pytest
+
+import filechanges
+from filechanges import Entry
+
+
+def scanned(tracker, folder, contents):
+    """Returns a Tracker that checked a folder holding the given files"""
+    cfg, root = folder
+    for name, content in contents.items():
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(content)
+    t = tracker(cfg)
+    list(t.scan())
+    return t
+
+
+def test_round_trip(tracker, folder, tmp_path):
+    t = scanned(tracker, folder, {"a.txt": "a", "b.txt": "b", "sub/c.txt": "c"})
+    snapshot = str(tmp_path / "snapshot")
+
+    assert t.export(snapshot) == 3
+    entries = list(filechanges.openentries(t.db_file_name))
+    assert len(entries) == 3
+    assert list(filechanges.readsnapshot(snapshot)) == entries
+    assert list(filechanges.openentries(snapshot)) == entries
+
+
+def test_diff_against_snapshot(tracker, folder, tmp_path):
+    cfg, root = folder
+    t = scanned(tracker, folder, {"a.txt": "a", "b.txt": "b", "sub/c.txt": "c"})
+    snapshot = str(tmp_path / "snapshot")
+    t.export(snapshot)
+
+    (root / "a.txt").write_text("changed")
+    (root / "b.txt").unlink()
+    (root / "sub" / "d.txt").write_text("d")
+    list(t.scan())
+
+    changes = sorted((c.kind, os.path.basename(c.fname)) for c in t.diff(snapshot))
+    assert changes == [("added", "d.txt"), ("deleted", "b.txt"), ("modified", "a.txt")]
+    assert list(t.diff(snapshot, snapshot)) == []
+
+
+def test_diff_against_original_db(tracker, folder, tmp_path):
+    root = folder[1]
+    t = scanned(tracker, folder, {"a.txt": "a", "b.txt": "b"})
+
+    # a DB as the first version wrote it, read as it is
+    old = tmp_path / "old.db"
+    conn = sqlite3.connect(old)
+    conn.execute(
+        "CREATE TABLE status (id integer primary key, fname text, md5 text, moddate integer)"
+    )
+    for name, content in (("a.txt", "a"), ("b.txt", "old")):
+        conn.execute(
+            "INSERT INTO status (fname, md5, moddate) VALUES (?, ?, ?)",
+            (str(root / name), hashlib.md5(content.encode()).hexdigest(), 0),
+        )
+    conn.commit()
+    conn.close()
+
+    changes = [(c.kind, os.path.basename(c.fname)) for c in t.diff(str(old))]
+    assert changes == [("modified", "b.txt")]
+
+
+def test_not_a_snapshot(tmp_path):
+    fname = tmp_path / "other"
+    fname.write_text("neither a snapshot nor a database")
+    with pytest.raises(ValueError):
+        list(filechanges.openentries(str(fname)))
+
+
+def test_diffentries():
+    old = [
+        Entry("/d", "a", "aa", 1, 0, 0, "md5"),
+        Entry("/d", "b", "bb", 1, 0, 0, "md5"),
+        Entry("/d", "c", "cc", 1, 0, 0, "md5"),
+        Entry("/d/e", "f", "ff", 1, 0, 0, None),
+    ]
+    new = [
+        Entry("/d", "a", "aa", 1, 0, 0, "md5"),
+        Entry("/d", "c", "c2", 2, 0, 0, "md5"),
+        Entry("/d", "d", "dd", 1, 0, 0, "md5"),
+        # recorded with another algorithm, so only the size is compared
+        Entry("/d/e", "f", "f2", 1, 0, 0, "sha256"),
+    ]
+    changes = [
+        (c.kind, c.fname, c.old, c.new) for c in filechanges.diffentries(old, new)
+    ]
+    assert changes == [
+        ("deleted", "/d/b", "bb", None),
+        ("modified", "/d/c", "cc", "c2"),
+        ("added", "/d/d", None, "dd"),
+    ]
+
+
+def test_diffentries_unsorted():
+    old = [
+        Entry("/d", "b", "bb", 1, 0, 0, "md5"),
+        Entry("/d", "a", "aa", 1, 0, 0, "md5"),
+    ]
+    with pytest.raises(ValueError, match="not sorted"):
+        list(filechanges.diffentries(old, []))
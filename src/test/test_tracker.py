@@ -0,0 +1,27 @@
+import os.path
+
+import filechanges
+
+
+def test_trackers_are_independent(tmp_path):
+    for name, files in (("one", 1), ("two", 2)):
+        (tmp_path / name).mkdir()
+        for i in range(files):
+            (tmp_path / name / f"{i}.txt").write_text(str(i))
+        (tmp_path / f"{name}.ini").write_text(f"{tmp_path / name}\n")
+
+    with filechanges.Tracker(str(tmp_path / "one.ini")) as one:
+        with filechanges.Tracker(str(tmp_path / "two.ini"), paranoid=True) as two:
+            assert len(list(one.scan())) == 1
+            assert len(list(two.scan())) == 2
+            assert one.counters["checked"] == 1
+            assert two.counters["checked"] == 2
+
+            # the options of one tracker are not seen by the other
+            assert list(one.scan()) == []
+            assert list(two.scan()) == []
+            assert one.counters["hashed"] == 0
+            assert two.counters["hashed"] == 2
+
+    assert os.path.exists(tmp_path / "one.db")
+    assert os.path.exists(tmp_path / "two.db")
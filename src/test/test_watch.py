@@ -0,0 +1,79 @@
+import asyncio
+import contextlib
+import os.path
+import time
+
+import pytest
+
+import filechanges
+
+
+async def waitfor(events, count, timeout=10):
+    deadline = time.monotonic() + timeout
+    while len(events) < count and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+
+def test_touched_files_are_reported(tracker, folder):
+    notifier = filechanges.openinotify()
+    if notifier is None:
+        pytest.skip("inotify is not available")
+    notifier.close()
+
+    cfg, root = folder
+    (root / "old.txt").write_text("old")
+    t = tracker(cfg)
+    events = list()
+
+    async def run():
+        watch = asyncio.create_task(t.watch(events.append, reconcile=60))
+        # the first full pass records the files already there
+        await waitfor(events, 1)
+        (root / "sub").mkdir()
+        (root / "sub" / "new.txt").write_text("new")
+        (root / "old.txt").write_text("changed")
+        await waitfor(events, 3)
+        watch.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await watch
+
+    asyncio.run(run())
+
+    found = sorted((e.kind, os.path.basename(e.fname)) for e in events)
+    assert found == [
+        ("added", "new.txt"),
+        ("added", "old.txt"),
+        ("modified", "old.txt"),
+    ]
+
+
+def test_debounced(tracker, folder):
+    notifier = filechanges.openinotify()
+    if notifier is None:
+        pytest.skip("inotify is not available")
+    notifier.close()
+
+    cfg, root = folder
+    t = tracker(cfg)
+    events = list()
+
+    async def run():
+        watch = asyncio.create_task(t.watch(events.append, reconcile=60))
+        await asyncio.sleep(0.5)
+        # a file written in a burst is hashed once
+        with open(root / "burst.txt", "w") as f:
+            for i in range(10):
+                f.write(str(i))
+                f.flush()
+                await asyncio.sleep(0.01)
+        await waitfor(events, 1)
+        await asyncio.sleep(filechanges.WATCH_DEBOUNCE_SECS * 2)
+        watch.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await watch
+
+    asyncio.run(run())
+
+    assert [(e.kind, os.path.basename(e.fname)) for e in events] == [
+        ("added", "burst.txt")
+    ]